@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Check the blend mode kernels of gimpformats against blendmodes.
+
+Blends seeded random layers, with opaque, transparent and partly transparent
+pixels, in every mode that `blendKernels.hasKernel` covers at several
+opacities, as 8-bit and as high precision pixels. The check fails if any
+result is more than a level away from blendmodes.blendLayersArray.
+
+blendmodes has no addition in its table of blend functions and draws it as
+normal, so addition (modes 7 and 33) is the one exception: it is checked
+against blendmodes' own `additive`, composited the same way blendLayersArray
+composites every other mode.
+
+Example: python benchmarks/blend_kernels.py --tolerance 1
+"""
+import sys
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import blendmodes.blend
+from blendmodes.blend import BlendType
+
+from gimpformats import blendKernels
+from gimpformats.gimpXcfDocument import blendLookup
+
+
+
+# Opacities are checked in the 1/255 steps XCF stores them in
+OPACITIES = (1.0, 0.8, 0.6, 0.4, 0.2)
+
+# XCF layer modes blendmodes draws as normal, see `additive_blend`
+ADDITION_MODES = (7, 33)
+
+
+
+def random_layer(rng: np.random.Generator, size: int) -> np.ndarray:
+	"""Make straight alpha RGBA pixels, a third each opaque, transparent and in between."""
+	pixels = rng.integers(0, 256, (size, size, 4), dtype=np.uint8)
+	alpha = pixels[..., 3]
+	choice = rng.integers(0, 3, alpha.shape)
+	alpha[choice == 0] = 255
+	alpha[choice == 1] = 0
+	return pixels
+
+
+
+@contextmanager
+def additive_blend():
+	"""Make blendmodes draw BlendType.ADDITIVE with its `additive` function."""
+	blend = blendmodes.blend.blend
+
+	def blend_with_additive(background, foreground, blendType):
+		if blendType == BlendType.ADDITIVE:
+			return blendmodes.blend.additive(background, foreground)
+		return blend(background, foreground, blendType)
+
+	blendmodes.blend.blend = blend_with_additive
+	try:
+		yield
+	finally:
+		blendmodes.blend.blend = blend
+
+
+
+def kernel(background: np.ndarray, foreground: np.ndarray, blendmode: int, opacity: float, dtype) -> np.ndarray:
+	"""Blend straight alpha pixels with `blendKernels`, as pixels of `dtype`."""
+	composite = blendKernels.blendLayers(
+		blendKernels.premultiply(background.astype(dtype)),
+		blendKernels.premultiply(foreground.astype(dtype)),
+		blendmode,
+		opacity,
+	)
+	return np.around(np.clip(blendKernels.unpremultiply(composite), 0, 255)).astype(np.int16)
+
+
+
+def reference(background: np.ndarray, foreground: np.ndarray, blendmode: int, opacity: float) -> np.ndarray:
+	"""Blend straight alpha pixels with blendmodes."""
+	blended = blendmodes.blend.blendLayersArray(
+		background.astype(np.float64), foreground.astype(np.float64), blendLookup()[blendmode], opacity
+	)
+	return np.around(np.clip(blended, 0, 255)).astype(np.int16)
+
+
+
+def difference(result: np.ndarray, expected: np.ndarray) -> int:
+	"""Get the largest difference in levels, ignoring the colour of transparent pixels."""
+	drawn = expected[..., 3] > 0
+	colour = np.abs(result[..., :3] - expected[..., :3])[drawn]
+	alpha = np.abs(result[..., 3] - expected[..., 3])
+	return int(max(colour.max(initial=0), alpha.max()))
+
+
+
+if __name__ == '__main__':
+	parser = ArgumentParser(description="Check the gimpformats blend mode kernels against blendmodes.")
+	parser.add_argument("--size", default=128, type=int, help="Width and height of the layers (DEFAULT: 128)")
+	parser.add_argument("--seed", default=0, type=int, help="Random seed for the layers (DEFAULT: 0)")
+	parser.add_argument("--tolerance", default=1, type=int, help="Largest difference allowed, in levels (DEFAULT: 1)")
+	args = parser.parse_args()
+
+	rng = np.random.default_rng(args.seed)
+	background = random_layer(rng, args.size)
+	foreground = random_layer(rng, args.size)
+
+	modes = sorted(blendKernels.NORMAL_MODES | blendKernels.BLEND_FUNCTIONS.keys())
+	failed = False
+
+	for blendmode in modes:
+		differences = {}
+		for opacity in OPACITIES:
+			if blendmode in ADDITION_MODES:
+				with additive_blend():
+					expected = reference(background, foreground, blendmode, opacity)
+			else:
+				expected = reference(background, foreground, blendmode, opacity)
+
+			for dtype in (np.uint8, np.float64):
+				result = kernel(background, foreground, blendmode, opacity, dtype)
+				differences[(opacity, np.dtype(dtype).name)] = difference(result, expected)
+
+		worst = max(differences.values())
+		print(f"{blendmode:3} {blendLookup()[blendmode].name:12} within {worst} level{'' if worst == 1 else 's'}")
+
+		for (opacity, dtype), levels in differences.items():
+			if levels > args.tolerance:
+				print(f"FAIL: mode {blendmode} at opacity {opacity} ({dtype}) is {levels} levels from blendmodes")
+				failed = True
+
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""End-to-end build benchmark for xcftotexture.
+
+Builds a fixed synthetic corpus (see synthetic_corpus.py) with xcftotexture.py
+in a fresh interpreter, first into an empty output directory (cold) and then
+again over the up to date output (warm). The wall time, CPU time, peak RSS and
+textures per second of each are reported.
+
+With --baseline the results are compared with a stored run and the benchmark
+fails if any of them is worse by more than --threshold, so CI can block
+regressions. --save-baseline stores the results of this run.
+
+Timings only compare on the same machine, so no baseline is kept in the repo.
+CI makes one first, on the runner that will compare against it, e.g. from the
+base branch:
+
+	python benchmarks/build_time.py --save-baseline build_baseline.json
+
+and then checks the change with:
+
+	python benchmarks/build_time.py --baseline build_baseline.json
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from synthetic_corpus import DOCUMENTS, TEXTURES, make_corpus
+
+
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# The corpus every run is measured against, changing it invalidates baselines.
+# It has as many textures per document as the real project.
+CORPUS = {
+	'documents': 24,
+	'textures': round(24 * TEXTURES / DOCUMENTS),
+	'seed': 0,
+	'size': (256, 256),
+	'layers': 6,
+	'groups': 1,
+	'mask_density': 0.25,
+	'max_offset': 16,
+	'blend_modes': (28, 30, 31, 23, 33, 32, 35, 36, 46, 47),
+	'compression': 1,
+}
+
+# Metrics where a larger number is better, all others should go down
+HIGHER_IS_BETTER = {
+	'textures_per_second',
+}
+
+
+
+def prepare_corpus(directory: Path) -> Path:
+	"""Generate the corpus in `directory` unless it is already there."""
+	parameters_file = directory.joinpath('corpus.json')
+	parameters = json.dumps(CORPUS, sort_keys=True)
+
+	if not parameters_file.exists() or parameters_file.read_text() != parameters:
+		shutil.rmtree(directory, ignore_errors=True)
+		make_corpus(directory, **CORPUS)
+		parameters_file.write_text(parameters)
+
+	return directory
+
+
+
+def build(corpus: Path, output: Path, jobs: int | None = None) -> dict[str, float]:
+	"""Run a build of the corpus and measure it."""
+	command = [
+		sys.executable,
+		str(REPO_ROOT.joinpath('xcftotexture.py')),
+		str(corpus.joinpath('xcftotexture.yml')),
+		str(output),
+		'--src', str(corpus.joinpath('src')),
+		'--log-level', 'warning',
+	]
+	if jobs is not None:
+		command += ['--jobs', str(jobs)]
+
+	log_filepath = output.parent.joinpath('build.log')
+	with open(log_filepath, 'w') as log_file:
+		start = time.perf_counter()
+		process = subprocess.Popen(command, cwd=REPO_ROOT, stdout=log_file, stderr=log_file)
+		# wait4 gives the resource usage of this child alone
+		_, status, usage = os.wait4(process.pid, 0)
+		wall = time.perf_counter() - start
+		process.returncode = os.waitstatus_to_exitcode(status)
+
+	if process.returncode:
+		raise RuntimeError(f"Build failed with exit code {process.returncode}, see {log_filepath}")
+
+	# ru_maxrss is in kilobytes on Linux but bytes on macOS
+	rss_scale = 1 if sys.platform == 'darwin' else 1024
+
+	return {
+		'wall_seconds': wall,
+		'cpu_seconds': usage.ru_utime + usage.ru_stime,
+		'peak_rss_mb': usage.ru_maxrss * rss_scale / 1e6,
+		'textures_per_second': CORPUS['textures'] / wall,
+	}
+
+
+
+def best(runs: list[dict[str, float]]) -> dict[str, float]:
+	"""Combine several runs, keeping the best value of each metric."""
+	return {
+		metric: (max if metric in HIGHER_IS_BETTER else min)(run[metric] for run in runs)
+		for metric in runs[0]
+	}
+
+
+
+def benchmark(corpus: Path, output: Path, runs: int = 3, jobs: int | None = None) -> dict:
+	"""Measure cold and warm builds of the corpus."""
+	cold, warm = [], []
+
+	for _ in range(runs):
+		shutil.rmtree(output, ignore_errors=True)
+		output.mkdir(parents=True)
+		cold.append(build(corpus, output, jobs))
+		warm.append(build(corpus, output, jobs))
+
+	return {
+		'cold': best(cold),
+		'warm': best(warm),
+	}
+
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+	"""List the metrics that are worse than the baseline by more than `threshold`."""
+	regressions = []
+
+	for scenario, metrics in results.items():
+		for metric, value in metrics.items():
+			reference = baseline.get(scenario, {}).get(metric)
+			if not reference:
+				continue
+
+			if metric in HIGHER_IS_BETTER:
+				change = (reference - value) / reference
+			else:
+				change = (value - reference) / reference
+
+			if change > threshold:
+				regressions.append(f"{scenario} {metric}: {value:.3f} vs {reference:.3f} ({change:+.1%})")
+
+	return regressions
+
+
+
+if __name__ == '__main__':
+	parser = ArgumentParser(description="Measure cold and warm xcftotexture builds of a synthetic corpus.")
+	parser.add_argument("-w", "--workdir", default=Path("/tmp/xcftotexture-benchmark"), type=Path, help="Directory for the corpus and output (DEFAULT: %(default)s)")
+	parser.add_argument("-r", "--runs", default=3, type=int, help="Number of runs, the best is reported (DEFAULT: 3)")
+	parser.add_argument("-j", "--jobs", default=None, type=int, help="Passed on to xcftotexture.py")
+	parser.add_argument("-b", "--baseline", default=None, type=Path, help="Baseline JSON to compare with")
+	parser.add_argument("-t", "--threshold", default=0.10, type=float, help="Allowed fraction a metric may be worse than the baseline (DEFAULT: 0.10)")
+	parser.add_argument("--save-baseline", default=None, type=Path, help="Write the results to this file as the new baseline")
+	args = parser.parse_args()
+
+	corpus = prepare_corpus(args.workdir.joinpath('corpus'))
+	results = benchmark(corpus, args.workdir.joinpath('output'), args.runs, args.jobs)
+
+	for scenario, metrics in results.items():
+		print(
+			f"{scenario:4}  wall {metrics['wall_seconds']:7.2f}s"
+			f"  cpu {metrics['cpu_seconds']:7.2f}s"
+			f"  peak rss {metrics['peak_rss_mb']:7.1f}MB"
+			f"  {metrics['textures_per_second']:7.2f} textures/s"
+		)
+
+	record = {
+		'corpus': CORPUS,
+		'results': results,
+	}
+
+	if args.save_baseline is not None:
+		args.save_baseline.write_text(json.dumps(record, indent='\t') + '\n')
+
+	if args.baseline is not None:
+		baseline = json.loads(args.baseline.read_text())
+		if baseline['corpus'] != json.loads(json.dumps(CORPUS)):
+			print("FAIL: the baseline was measured on a different corpus")
+			sys.exit(1)
+
+		regressions = compare(results, baseline['results'], args.threshold)
+		for regression in regressions:
+			print(f"FAIL: {regression}")
+		sys.exit(1 if regressions else 0)
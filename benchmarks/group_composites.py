@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Check that variants drawing the same layers of a group share its composite.
+
+Writes a document with a group, like the bump groups of the real sources, and
+renders variants of it with xcftotexture. The check fails unless a variant
+drawing the same layers of the group as an earlier one reuses the group's
+composite, or if any variant differs by more than a level from flattening the
+flat list of layers, which draws the layers of groups as if they weren't in a
+group.
+
+Example: python benchmarks/group_composites.py
+"""
+import sys
+import tempfile
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from synthetic_corpus import blend_mode, random_pixels
+
+from gimpformats.gimpXcfDocument import GimpDocument, flattenAll
+from xcftotexture import Document, TextureVariant
+
+
+
+# Layers of the document, top to bottom, as (name, blend mode, opacity, item path)
+LAYERS = (
+	('dirt', 'Multiply', 1.0, [0]),
+	('bump', 'Pass through', 1.0, [1]),
+	('bump scratches', 'Multiply', 1.0, [1, 0]),
+	('bump rivets', 'Normal', 0.6, [1, 1]),
+	('bump base', 'Normal', 1.0, [1, 2]),
+	('Background', 'Normal', 1.0, [2]),
+)
+
+# Variants rendered in turn, and whether each should reuse the composite of
+# the group made for an earlier one
+VARIANTS = (
+	(['bump rivets', 'bump base'], False),
+	(['bump rivets', 'bump base', 'dirt'], True),
+	# the multiply layer is drawn straight on to what is below the group
+	(['bump scratches', 'bump rivets', 'bump base'], False),
+)
+
+
+
+class CountingComposites(dict):
+	"""Composites that count how often each is reused, by the group it is of."""
+
+	def __init__(self):
+		super().__init__()
+		self.hits = Counter()
+
+	def __getitem__(self, key):
+		self.hits[key[0]] += 1
+		return super().__getitem__(key)
+
+
+
+def make_document(filepath: Path, size: tuple[int, int] = (128, 96), seed: int = 0):
+	rng = np.random.default_rng(seed)
+	width, height = size
+	document = GimpDocument()
+	document.width, document.height = width, height
+
+	for name, mode, opacity, item_path in LAYERS:
+		is_group = name == 'bump'
+		if is_group:
+			image = Image.new('RGBA', size)
+		else:
+			image = random_pixels(rng, width, height, 'RGB' if name == 'Background' else 'RGBA')
+		layer = document.newLayer(name, image, len(document.layers))
+		layer.visible = True
+		layer.isGroup = is_group
+		layer.itemPath = item_path
+		layer.blendMode = blend_mode(mode)
+		layer.opacity = opacity
+		if not is_group:
+			layer.xOffset = int(rng.integers(-8, 9))
+			layer.yOffset = int(rng.integers(-8, 9))
+
+	document.save(str(filepath))
+
+
+
+if __name__ == '__main__':
+	parser = ArgumentParser(description="Check that xcftotexture reuses the composites of groups.")
+	parser.add_argument("--seed", default=0, type=int, help="Random seed for the layers (DEFAULT: 0)")
+	args = parser.parse_args()
+
+	failed = False
+
+	with tempfile.TemporaryDirectory() as directory:
+		filepath = Path(directory, 'groups.xcf')
+		make_document(filepath, seed=args.seed)
+		document = Document(filepath)
+
+		document.composites = CountingComposites()
+		group = next(
+			group for index, group in document.pass_through_groups.items()
+			if document.layers[index].name == 'bump'
+		)
+
+		for definition, reused in VARIANTS:
+			variant = TextureVariant(document, definition)
+			hits = document.composites.hits[group]
+			rendered = np.asarray(variant.render(), dtype=np.int16)
+
+			flat = flattenAll(
+				document.masked_layers,
+				(document.width, document.height),
+				visibleLayers={document.masked_layers[index] for index in variant.visible_indices()},
+			)
+			difference = int(np.abs(rendered - np.asarray(flat, dtype=np.int16)).max())
+
+			hit = document.composites.hits[group] > hits
+			print(f"{', '.join(definition)}: group composite {'reused' if hit else 'made'}, within {difference} of the flat layers")
+
+			if hit != reused:
+				print(f"FAIL: the group composite was {'' if hit else 'not '}reused for {definition}")
+				failed = True
+			if difference > 1:
+				print(f"FAIL: {definition} differs from the flat layers by {difference} levels")
+				failed = True
+
+	sys.exit(1 if failed else 0)
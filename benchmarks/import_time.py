@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Import-time benchmark for xcftotexture.
+
+Imports the module in a fresh interpreter with `-X importtime`, reports the
+slowest imports and fails if any of the heavy, lazily-loaded dependencies were
+pulled in at startup or if the total import time exceeds the budget.
+
+Example: python benchmarks/import_time.py --max-ms 150
+"""
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Modules that must only be imported once they are actually needed
+LAZY_MODULES = (
+	'cv2',
+	'numpy',
+	'blendmodes',
+	'PIL.ImageGrab',
+)
+
+
+
+def measure(module: str, runs: int = 5) -> tuple[float, dict[str, int], set[str]]:
+	"""Import `module` in `runs` fresh interpreters.
+
+	Returns the best total import time in milliseconds, the per-module
+	cumulative times (microseconds) of that run and the set of modules that
+	were loaded.
+	"""
+	best = None
+
+	for _ in range(runs):
+		result = subprocess.run(
+			[
+				sys.executable,
+				'-X', 'importtime',
+				'-c', f"import sys, {module}; print('\\n'.join(sys.modules))",
+			],
+			cwd=REPO_ROOT,
+			env={**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'},
+			capture_output=True,
+			text=True,
+			check=True,
+		)
+
+		timings = {}
+		for line in result.stderr.splitlines():
+			if not line.startswith('import time:') or 'cumulative' in line:
+				continue
+			_, cumulative, name = line[len('import time:'):].split('|')
+			timings[name.strip()] = int(cumulative)
+
+		total = timings.get(module, 0) / 1000
+		if best is None or total < best[0]:
+			best = (total, timings, set(result.stdout.split()))
+
+	return best
+
+
+
+if __name__ == '__main__':
+	parser = ArgumentParser(description="Measure how long it takes to import xcftotexture.")
+	parser.add_argument("-m", "--module", default="xcftotexture", help="Module to import (DEFAULT: xcftotexture)")
+	parser.add_argument("-r", "--runs", default=5, type=int, help="Number of runs, the fastest is reported (DEFAULT: 5)")
+	parser.add_argument("--max-ms", default=None, type=float, help="Fail if the import takes longer than this")
+	parser.add_argument("--top", default=10, type=int, help="Number of slowest imports to list (DEFAULT: 10)")
+	args = parser.parse_args()
+
+	total, timings, loaded = measure(args.module, args.runs)
+
+	print(f"import {args.module}: {total:.1f}ms (best of {args.runs})")
+	for name, cumulative in sorted(timings.items(), key=lambda t: t[1], reverse=True)[:args.top]:
+		print(f"  {cumulative / 1000:8.1f}ms  {name}")
+
+	failed = False
+
+	eager = [name for name in LAZY_MODULES if name in loaded]
+	if eager:
+		print(f"FAIL: imported at startup: {', '.join(eager)}")
+		failed = True
+
+	if args.max_ms is not None and total > args.max_ms:
+		print(f"FAIL: {total:.1f}ms exceeds the {args.max_ms:.1f}ms budget")
+		failed = True
+
+	sys.exit(1 if failed else 0)
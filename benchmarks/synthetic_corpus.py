@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Synthetic XCF corpus generator for load testing.
+
+The real sources in src/ are Git LFS pointers, so this writes seeded stand-ins
+built with `GimpDocument.newLayer`: a directory of XCF documents with layers,
+groups, masks, offsets and blend modes, and a matching xcftotexture.yml that
+references them. The same seed always produces the same corpus, and each
+document only depends on the seed and its own number, so a larger corpus
+starts with the documents of a smaller one.
+
+The defaults are the size of the real project, counted from the documents in
+src/ and the definitions in xcftotexture.yml; --scale multiplies the number of
+documents and textures for load tests at 10x or 100x.
+
+Example: python benchmarks/synthetic_corpus.py /tmp/corpus --scale 10
+"""
+import logging
+import math
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import yaml
+from PIL import Image
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+sys.path.insert(0, str(REPO_ROOT))
+
+from gimpformats.GimpChannel import GimpChannel
+from gimpformats.gimpXcfDocument import GimpDocument
+from gimpformats.GimpIOBase import GimpIOBase
+
+logging.disable(logging.CRITICAL)
+
+
+
+def project_size(directory: Path = REPO_ROOT) -> tuple[int, int]:
+	"""Count the source documents and texture definitions of the real project."""
+	documents = len(list(directory.joinpath('src').glob('*.xcf')))
+	with open(directory.joinpath('xcftotexture.yml')) as yaml_file:
+		textures = len(yaml.safe_load(yaml_file))
+	return documents, textures
+
+
+
+# Number of source documents and textures in the real project
+DOCUMENTS, TEXTURES = project_size()
+
+# Layers are named after the variant they belong to so the definitions can find them
+ROLES = (
+	'diffuse',
+	'bump',
+	'gloss',
+	'glow',
+)
+
+BLEND_MODES = (
+	'Normal',
+	'Multiply',
+	'Screen',
+	'Overlay',
+	'Addition',
+	'Difference',
+	'Darken only',
+	'Lighten only',
+	'Grain extract',
+	'Grain merge',
+)
+
+COMPRESSIONS = {
+	'none': 0,
+	'rle': 1,
+	'zlib': 2,
+}
+
+
+
+def blend_mode(name: str) -> int:
+	"""Get the XCF number of a (non legacy) blend mode from its name."""
+	names = [mode.lower() for mode in GimpIOBase.BLEND_MODES]
+	return names.index(name.strip().lower())
+
+
+
+def random_pixels(rng: np.random.Generator, width: int, height: int, mode: str = 'RGBA') -> Image.Image:
+	"""Make an image of a gradient with a noisy patch, like a painted texture layer."""
+	channels = len(mode)
+	start = rng.integers(0, 256, channels)
+	end = rng.integers(0, 256, channels)
+	ramp = np.linspace(0.0, 1.0, width)[None, :, None]
+	pixels = np.broadcast_to(start + (end - start) * ramp, (height, width, channels)).astype(np.uint8)
+
+	# a noisy patch somewhere in the layer
+	pw, ph = rng.integers(1, width + 1), rng.integers(1, height + 1)
+	px, py = rng.integers(0, width - pw + 1), rng.integers(0, height - ph + 1)
+	pixels[py : py + ph, px : px + pw] = rng.integers(0, 256, (ph, pw, channels), dtype=np.uint8)
+
+	if mode == 'RGBA':
+		# mostly opaque, with a transparent border
+		pixels[..., 3] = 255
+		border = rng.integers(0, max(1, min(width, height) // 8))
+		if border:
+			pixels[:border, :, 3] = 0
+			pixels[-border:, :, 3] = 0
+
+	if channels == 1:
+		pixels = pixels[..., 0]
+	return Image.fromarray(np.ascontiguousarray(pixels), mode)
+
+
+
+def make_document(
+	rng: np.random.Generator,
+	size: tuple[int, int],
+	layers: int = 6,
+	groups: int = 1,
+	mask_density: float = 0.25,
+	max_offset: int = 16,
+	blend_modes: tuple[int, ...] = (28,),
+	compression: int = 1,
+) -> tuple[GimpDocument, dict[str, list[str]]]:
+	"""Create a document of `layers` layers, some of them in `groups` groups.
+
+	Returns the document and the names of the layers and groups of each role.
+	"""
+	width, height = size
+	document = GimpDocument()
+	document.width, document.height = width, height
+	document.compression = compression
+
+	# a tree of (role, name, children) in document order (top to bottom)
+	tree = []
+	for number in range(groups):
+		tree.append((ROLES[number % len(ROLES)], f"{ROLES[number % len(ROLES)]} group {number}", []))
+	for number in range(layers):
+		role = ROLES[number % len(ROLES)]
+		item = (role, f"{role} {number}", None)
+		groupsOfRole = [group for group in tree if group[0] == role and group[2] is not None]
+		if groupsOfRole and rng.random() < 0.5:
+			groupsOfRole[rng.integers(len(groupsOfRole))][2].append(item)
+		else:
+			tree.insert(rng.integers(len(tree) + 1), item)
+
+	names = {role: [] for role in ROLES}
+
+	def add_items(items, parentPath):
+		for index, (role, name, children) in enumerate(items):
+			itemPath = [*parentPath, index]
+			names[role].append(name)
+			if children is None:
+				layerWidth = int(rng.integers(max(1, width // 4), width + 1))
+				layerHeight = int(rng.integers(max(1, height // 4), height + 1))
+				image = random_pixels(rng, layerWidth, layerHeight)
+			else:
+				image = Image.new('RGBA', (width, height))
+			layer = document.newLayer(name, image, len(document.layers))
+			layer.visible = True
+			layer.isGroup = children is not None
+			layer.itemPath = itemPath
+			layer.blendMode = int(rng.choice(blend_modes))
+			if max_offset and children is None:
+				layer.xOffset = int(rng.integers(-max_offset, max_offset + 1))
+				layer.yOffset = int(rng.integers(-max_offset, max_offset + 1))
+			if rng.random() < mask_density:
+				layer.mask = GimpChannel(layer, f"{name} mask", random_pixels(rng, image.width, image.height, 'L'))
+				layer.applyMask = True
+			if children is not None:
+				add_items(children, itemPath)
+
+	add_items(tree, [])
+
+	background = document.newLayer('Background', random_pixels(rng, width, height, 'RGB'), len(document.layers))
+	background.visible = True
+	background.blendMode = blend_mode('Normal')
+	background.itemPath = [len(tree)]
+
+	return document, names
+
+
+
+def make_corpus(
+	directory: Path,
+	documents: int = DOCUMENTS,
+	textures: int = TEXTURES,
+	seed: int = 0,
+	**document_options,
+) -> dict:
+	"""Write `documents` XCF files to `directory`/src and `textures` definitions using them.
+
+	Returns the texture definitions, which are also written to
+	`directory`/xcftotexture.yml.
+	"""
+	source_directory = Path(directory, 'src')
+	source_directory.mkdir(parents=True, exist_ok=True)
+
+	layer_names = []
+	for number in range(documents):
+		rng = np.random.default_rng([seed, number])
+		document, names = make_document(rng, **document_options)
+		document.save(str(source_directory.joinpath(f"synthetic{number:05d}.xcf")))
+		layer_names.append(names)
+
+	definitions = {}
+	for number in range(textures):
+		document_number = number % documents
+		definition = {'src': f"synthetic{document_number:05d}"}
+		for role, names in layer_names[document_number].items():
+			if names:
+				definition[role] = list(names)
+		definitions[f"synthetic{number:05d}"] = definition
+
+	with open(Path(directory, 'xcftotexture.yml'), 'w') as yaml_file:
+		yaml.safe_dump(definitions, yaml_file, sort_keys=False)
+
+	return definitions
+
+
+
+def parse_size(size: str) -> tuple[int, int]:
+	"""Parse a size given as WIDTHxHEIGHT or a single number for a square."""
+	width, _, height = size.lower().partition('x')
+	return int(width), int(height or width)
+
+
+
+if __name__ == '__main__':
+	parser = ArgumentParser(description="Generate a seeded corpus of XCF documents and texture definitions.")
+	parser.add_argument("outdir", type=Path, help="Directory to write src/*.xcf and xcftotexture.yml to")
+	parser.add_argument("--scale", default=1.0, type=float, help="Multiply the number of documents and textures (DEFAULT: 1)")
+	parser.add_argument("-n", "--documents", default=DOCUMENTS, type=int, help=f"Number of XCF documents (DEFAULT: {DOCUMENTS})")
+	parser.add_argument("-t", "--textures", default=TEXTURES, type=int, help=f"Number of texture definitions (DEFAULT: {TEXTURES})")
+	parser.add_argument("--seed", default=0, type=int, help="Random seed (DEFAULT: 0)")
+	parser.add_argument("--size", default="256", type=parse_size, help="Canvas size, WIDTHxHEIGHT or a single number (DEFAULT: 256)")
+	parser.add_argument("--layers", default=6, type=int, help="Number of layers per document, not counting the background (DEFAULT: 6)")
+	parser.add_argument("--groups", default=1, type=int, help="Number of layer groups per document (DEFAULT: 1)")
+	parser.add_argument("--mask-density", default=0.25, type=float, help="Fraction of layers and groups with a mask (DEFAULT: 0.25)")
+	parser.add_argument("--max-offset", default=16, type=int, help="Largest layer offset in pixels (DEFAULT: 16)")
+	parser.add_argument("--blend-modes", default=",".join(BLEND_MODES), type=str, help="Comma-separated blend mode names to choose from (DEFAULT: %(default)s)")
+	parser.add_argument("--compression", default="rle", choices=COMPRESSIONS, help="Tile compression (DEFAULT: rle)")
+	args = parser.parse_args()
+
+	definitions = make_corpus(
+		args.outdir,
+		documents=max(1, math.ceil(args.documents * args.scale)),
+		textures=max(1, math.ceil(args.textures * args.scale)),
+		seed=args.seed,
+		size=args.size,
+		layers=args.layers,
+		groups=args.groups,
+		mask_density=args.mask_density,
+		max_offset=args.max_offset,
+		blend_modes=tuple(blend_mode(name) for name in args.blend_modes.split(',')),
+		compression=COMPRESSIONS[args.compression],
+	)
+
+	print(f"Wrote {len({d['src'] for d in definitions.values()})} documents and {len(definitions)} textures to {args.outdir}")
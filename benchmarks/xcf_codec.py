@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""XCF tile codec throughput benchmark.
+
+Saves documents with each tile compression and loads them back, reporting the
+encode and decode throughput (megabytes of pixel data per second) and failing
+if any document does not round-trip exactly.
+
+Without any files a synthetic document of flat areas, gradients and noise is
+used, so the benchmark does not depend on the LFS tracked sources.
+
+Example: python benchmarks/xcf_codec.py --size 2048 --layers 4
+"""
+import logging
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gimpformats.gimpXcfDocument import GimpDocument
+
+logging.disable(logging.CRITICAL)
+
+
+
+COMPRESSIONS = {
+	'none': 0,
+	'rle': 1,
+	'zlib': 2,
+}
+
+
+
+def synthetic_document(size: int, layers: int, seed: int = 0) -> GimpDocument:
+	"""Create a document of `layers` RGBA layers that are `size` pixels square."""
+	rng = np.random.default_rng(seed)
+	document = GimpDocument()
+	document.width = document.height = size
+
+	gradient = np.linspace(0, 255, size, dtype=np.uint8)
+	for number in range(layers):
+		pixels = np.zeros((size, size, 4), dtype=np.uint8)
+		pixels[..., 0] = gradient[None, :]
+		pixels[..., 1] = gradient[:, None]
+		pixels[..., 2] = number * 40
+		pixels[..., 3] = 255
+		# a noisy quarter, like a photographic texture
+		quarter = size // 2
+		pixels[:quarter, :quarter, :3] = rng.integers(0, 256, (quarter, quarter, 3), dtype=np.uint8)
+		layer = document.newLayer(f'layer {number}', Image.fromarray(pixels, 'RGBA'))
+		layer.visible = True
+
+	return document
+
+
+
+def layer_arrays(document: GimpDocument) -> list:
+	"""Decode every layer (and mask) of the document."""
+	arrays = []
+	for layer in document.layers:
+		arrays.append(layer.array)
+		if layer.mask is not None:
+			arrays.append(layer.mask.array)
+	return arrays
+
+
+
+def benchmark(document: GimpDocument, runs: int) -> dict[str, tuple[float, float, int]]:
+	"""Time encoding and decoding the document with each compression.
+
+	Returns the best encode and decode times in seconds and the encoded size,
+	keyed by compression name.
+	"""
+	reference = layer_arrays(document)
+	results = {}
+
+	for name, compression in COMPRESSIONS.items():
+		document.compression = compression
+		encodeTime = decodeTime = None
+
+		for _ in range(runs):
+			start = time.perf_counter()
+			data = bytes(document.encode())
+			encodeTime = min(encodeTime or float('inf'), time.perf_counter() - start)
+
+			start = time.perf_counter()
+			decoded = GimpDocument()
+			decoded.decode(data)
+			arrays = layer_arrays(decoded)
+			decodeTime = min(decodeTime or float('inf'), time.perf_counter() - start)
+
+		if len(arrays) != len(reference) or not all(
+			a.dtype == b.dtype and np.array_equal(a, b) for a, b in zip(arrays, reference)
+		):
+			raise RuntimeError(f"{name} compressed document does not round-trip")
+
+		results[name] = (encodeTime, decodeTime, len(data))
+
+	return results
+
+
+
+if __name__ == '__main__':
+	parser = ArgumentParser(description="Measure XCF tile encode and decode throughput.")
+	parser.add_argument("files", nargs="*", help="XCF files to benchmark (DEFAULT: a synthetic document)")
+	parser.add_argument("-s", "--size", default=1024, type=int, help="Width and height of the synthetic document (DEFAULT: 1024)")
+	parser.add_argument("-n", "--layers", default=4, type=int, help="Number of layers in the synthetic document (DEFAULT: 4)")
+	parser.add_argument("-r", "--runs", default=3, type=int, help="Number of runs, the fastest is reported (DEFAULT: 3)")
+	args = parser.parse_args()
+
+	if args.files:
+		documents = [(file, GimpDocument(file)) for file in args.files]
+	else:
+		documents = [(f'synthetic {args.size}x{args.size}x{args.layers}', synthetic_document(args.size, args.layers))]
+
+	for label, document in documents:
+		pixelBytes = sum(array.nbytes for array in layer_arrays(document))
+		megabytes = pixelBytes / 1e6
+		print(f"{label}: {megabytes:.1f}MB of pixels, {document.precision or 'default precision'}")
+		for name, (encodeTime, decodeTime, size) in benchmark(document, args.runs).items():
+			print(
+				f"  {name:5} encode {megabytes / encodeTime:8.1f}MB/s"
+				f"  decode {megabytes / decodeTime:8.1f}MB/s"
+				f"  ratio {size / pixelBytes:6.1%}"
+			)
@@ -0,0 +1,59 @@
+"""Read the names of the textures a Quake map uses from its BSP file.
+
+Only the header and the miptex lump, which holds the name, size and pixels of
+every texture in the map, are read. Quake (version 29), BSP2 and Half-Life
+(version 30) maps all keep the miptex lump third in the same header layout.
+"""
+from __future__ import annotations
+
+import struct
+from pathlib import Path
+
+
+
+BSP_VERSIONS = (29, 30)
+BSP_MAGICS = (b'BSP2', b'2PSB')
+
+LUMP_COUNT = 15
+LUMP_MIPTEX = 2
+
+# offset and length of each lump
+LUMP = struct.Struct('<ii')
+
+# name, width, height and offsets of the four mip levels of each texture
+MIPTEX_NAME_LENGTH = 16
+
+
+
+def miptex_names(filepath: Path) -> list[str]:
+	"""Get the names of the textures in the miptex lump of a BSP file, in the order they are stored."""
+	with open(filepath, 'rb') as bsp_file:
+		header = bsp_file.read(4 + LUMP_COUNT * LUMP.size)
+		if len(header) < 4 + LUMP_COUNT * LUMP.size:
+			raise ValueError(f"{filepath} is too short to be a BSP file")
+
+		magic = header[:4]
+		if magic not in BSP_MAGICS and struct.unpack('<i', magic)[0] not in BSP_VERSIONS:
+			raise ValueError(f"{filepath} isn't a Quake or Half-Life BSP file")
+
+		offset, length = LUMP.unpack_from(header, 4 + LUMP_MIPTEX * LUMP.size)
+		bsp_file.seek(offset)
+		lump = bsp_file.read(length)
+
+	if len(lump) < 4:
+		# a map without any textures
+		return []
+
+	(count,) = struct.unpack_from('<i', lump)
+	if count < 0 or 4 + count * 4 > len(lump):
+		raise ValueError(f"{filepath} has a broken miptex lump")
+
+	names = []
+	for texture_offset in struct.unpack_from(f'<{count}i', lump, 4):
+		# textures missing from the map have an offset of -1
+		if texture_offset < 0 or texture_offset + MIPTEX_NAME_LENGTH > len(lump):
+			continue
+		name = lump[texture_offset:texture_offset + MIPTEX_NAME_LENGTH].split(b'\0', 1)[0]
+		names.append(name.decode('latin-1'))
+
+	return names
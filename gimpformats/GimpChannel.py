@@ -5,6 +5,7 @@ from __future__ import annotations
 from binaryiotools import IO
 from PIL import Image
 
+from . import utils
 from .GimpImageHierarchy import GimpImageHierarchy
 from .GimpIOBase import GimpIOBase
 
@@ -12,6 +13,24 @@ from .GimpIOBase import GimpIOBase
 class GimpChannel(GimpIOBase):
 	"""Represents a single channel or mask in a gimp image."""
 
+	# the properties GIMP reads for a channel
+	ENCODED_PROPERTIES = (
+		GimpIOBase.PROP_ACTIVE_CHANNEL,
+		GimpIOBase.PROP_SELECTION,
+		GimpIOBase.PROP_OPACITY,
+		GimpIOBase.PROP_VISIBLE,
+		GimpIOBase.PROP_LINKED,
+		GimpIOBase.PROP_SHOW_MASKED,
+		GimpIOBase.PROP_COLOR,
+		GimpIOBase.PROP_TATTOO,
+		GimpIOBase.PROP_PARASITES,
+		GimpIOBase.PROP_LOCK_CONTENT,
+		GimpIOBase.PROP_LOCK_POSITION,
+		GimpIOBase.PROP_FLOAT_OPACITY,
+		GimpIOBase.PROP_COLOR_TAG,
+		GimpIOBase.PROP_FLOAT_COLOR,
+	)
+
 	def __init__(self, parent, name: str = "", image: Image.Image | None = None):
 		"""GimpChannel.
 
@@ -26,9 +45,9 @@ class GimpChannel(GimpIOBase):
 		self.name = name
 		self._imageHierarchy = None
 		self._imageHierarchyPtr = None
+		self._data = None
 		if image is not None:  # this is last because image can reset values
 			self.image = image
-		self._data = None
 
 	def decode(self, data: bytes, index: int = 0) -> int:
 		"""Decode a byte buffer.
@@ -50,17 +69,21 @@ class GimpChannel(GimpIOBase):
 		self._data = ioBuf.data
 		return ioBuf.index
 
-	def encode(self) -> bytearray:
-		"""Encode this object to a byte buffer."""
+	def encode(self, index: int = 0) -> bytearray:
+		"""Encode this object to a byte buffer.
+
+		Args:
+			index (int, optional): where the data will be placed in the file,
+			pointers are absolute file offsets. Defaults to 0.
+		"""
 		ioBuf = IO()
 		ioBuf.u32 = self.width
 		ioBuf.u32 = self.height
-		ioBuf.sz754 = self.name
+		utils.sz754Encode(ioBuf, self.name)
 		ioBuf.addBytes(self._propertiesEncode())
-		imgH = self._imageHierarchyPtr
-		if imgH is None:
-			imgH = 0
-		ioBuf.addBytes(self._pointerEncode(imgH))
+		dataAreaIndex = index + ioBuf.index + self.pointerSize // 8
+		ioBuf.addBytes(self._pointerEncode(dataAreaIndex))
+		ioBuf.addBytes(self.imageHierarchy.encode(dataAreaIndex))
 		return ioBuf.data
 
 	@property
@@ -78,6 +101,11 @@ class GimpChannel(GimpIOBase):
 			self.name = image.rsplit("\\", 1)[-1].rsplit("/", 1)[-1]
 		self._imageHierarchy = GimpImageHierarchy(self, image)
 
+	@property
+	def array(self):
+		"""Get the channel as a (height, width, 1) NumPy array in the document precision."""
+		return self.imageHierarchy.array
+
 	def forceFullyLoaded(self):
 		"""Make sure everything is fully loaded from the file."""
 		_ = self.image  # make sure the image is loaded so we can delete the hierarchy nonsense
@@ -91,10 +119,11 @@ class GimpChannel(GimpIOBase):
 		This is mainly used for decoding the image, so
 		not much use to you.
 		"""
-		if self._data and self._imageHierarchyPtr:
-			if self._imageHierarchy is None:
-				self._imageHierarchy = GimpImageHierarchy(self)
-				self._imageHierarchy.decode(self._data, self._imageHierarchyPtr)
+		if self._imageHierarchy is None and self._data and self._imageHierarchyPtr:
+			imageHierarchy = GimpImageHierarchy(self)
+			imageHierarchy.decode(self._data, self._imageHierarchyPtr)
+			self._imageHierarchy = imageHierarchy
+		if self._imageHierarchy is not None:
 			return self._imageHierarchy
 		raise RuntimeError("self._data or self._imageHierarchyPtr is None")
 
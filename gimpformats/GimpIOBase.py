@@ -3,12 +3,34 @@
 from __future__ import annotations
 
 import struct
+import threading
+from typing import TYPE_CHECKING
 
 from binaryiotools import IO
 
 from .GimpParasites import GimpParasite
 from .GimpVectors import GimpVector
 
+if TYPE_CHECKING:
+	import numpy as np
+
+# held while a deferred property is decoded, see `GimpIOBase.DEFERRED_PROPERTIES`
+_deferredLock = threading.RLock()
+
+
+def _deferredAttribute(propertyType: int, name: str) -> property:
+	"""Make an attribute that decodes its deferred property payload on first use."""
+
+	def getter(self):
+		self._decodeDeferred(propertyType)
+		return getattr(self, name)
+
+	def setter(self, value):
+		self._deferred.pop(propertyType, None)
+		setattr(self, name, value)
+
+	return property(getter, setter)
+
 
 class GimpIOBase:
 	"""A specialized binary file base for Gimp files."""
@@ -128,14 +150,34 @@ class GimpIOBase:
 	PROP_SAMPLE_POINTS = 39
 	PROP_NUM_PROPS = 40
 
+	# properties written by `_propertiesEncode`, None for all of them
+	ENCODED_PROPERTIES: tuple[int, ...] | None = None
+
+	# metadata properties that are only decoded when their attribute is used,
+	# unless the document is decoded with the "full" profile (see GimpDocument)
+	DEFERRED_PROPERTIES = frozenset((
+		PROP_COLORMAP,
+		PROP_GUIDES,
+		PROP_PARASITES,
+		PROP_USER_UNIT,
+		PROP_SAMPLE_POINTS,
+	))
+
+	colorMap = _deferredAttribute(PROP_COLORMAP, "_colorMap")
+	guidelines = _deferredAttribute(PROP_GUIDES, "_guidelines")
+	parasites = _deferredAttribute(PROP_PARASITES, "_parasites")
+	userUnits = _deferredAttribute(PROP_USER_UNIT, "_userUnits")
+	samplePoints = _deferredAttribute(PROP_SAMPLE_POINTS, "_samplePoints")
+
 	def __init__(self, parent):
 		"""A specialized binary file base for Gimp files."""
+		self._deferred: dict[int, bytes | None] = {}  # payloads of DEFERRED_PROPERTIES
 		self.parent = parent
 		self.parasites: list[GimpParasite] = []
 		self.guidelines: list[tuple[bool, int]] = []
 		self.itemPath: list[str] | None = None
 		self.vectors: list[GimpVector] = []
-		self.colorMap: list[tuple[int, int, int]] = []
+		self.colorMap: np.ndarray | list = []  # (number of colours, 3) array once decoded
 		self.userUnits: GimpUserUnits | None = None
 		self.samplePoints: list[tuple[int, int]] = []
 		self.selected: bool = False
@@ -244,6 +286,19 @@ class GimpIOBase:
 		"""Gimp nomenclature for the item's unique id."""
 		self.uniqueId = tattoo
 
+	def _decodeDeferred(self, propertyType: int):
+		"""Decode the payload of a property if it was deferred."""
+		if propertyType not in self._deferred:
+			return
+		with _deferredLock:
+			data = self._deferred.get(propertyType)
+			if data is None:  # decoded by another thread, or being decoded by this one
+				return
+			# other threads wait for the lock until the attribute is complete
+			self._deferred[propertyType] = None
+			self._propertyDecode(propertyType, data)
+			self._deferred.pop(propertyType, None)
+
 	def _parasitesDecode(self, data: bytes) -> int:
 		"""Decode list of parasites."""
 		index: int = 0
@@ -280,6 +335,10 @@ class GimpIOBase:
 			path.append(pathElem)
 		self.itemPath = path
 
+	def _itemPathEncode(self):
+		"""Encode item path."""
+		return struct.pack(f">{len(self.itemPath)}I", *self.itemPath)
+
 	def _vectorsDecode(self, data):
 		"""Decode vectors."""
 		index: int = 0
@@ -317,28 +376,33 @@ class GimpIOBase:
 
 		:param data: can be bytes or an IO object
 
-		decode colormap/palette
+		decode colormap/palette into a (number of colours, 3) NumPy array
 		"""
+		import numpy as np
+
 		ioObj = None
 		if isinstance(data, IO):
 			ioObj = data
 			index = data.index
 			data = data.data
-		_ = struct.unpack(">I", data[0:4])[0]  # number of colors
+		if index is None:
+			index = 0
+		numColors = struct.unpack(">I", data[index : index + 4])[0]
 		index += 4
-		colors = []
-		while index < len(data):
-			red = data[index]
-			index += 1
-			green = data[index]
-			index += 1
-			blue = data[index]
-			index += 1
-			colors.append((red, green, blue))
-		self.colorMap = colors
+		self.colorMap = np.frombuffer(
+			data, dtype=np.uint8, count=numColors * 3, offset=index
+		).reshape(numColors, 3)
+		index += numColors * 3
 		if ioObj is not None:
 			ioObj.index = index
 
+	def _colormapEncode(self):
+		"""Encode colormap/palette."""
+		import numpy as np
+
+		colorMap = np.asarray(self.colorMap, dtype=np.uint8).reshape(-1, 3)
+		return struct.pack(">I", len(colorMap)) + colorMap.tobytes()
+
 	def _userUnitsDecode(self, data):
 		"""Decode a set of user-defined measurement units."""
 		userUnits = GimpUserUnits()
@@ -479,15 +543,15 @@ class GimpIOBase:
 		"""
 		ioBuf = IO(boolSize=32)
 		if propertyType == self.PROP_COLORMAP:
-			if self.colorMap is not None and self.colorMap:
+			if self.colorMap is not None and len(self.colorMap):
 				ioBuf.u32 = self.PROP_COLORMAP
-				# ioBuf.addBytes(self._colormapEncode_())
+				ioBuf.addBytes(self._colormapEncode())
 		elif propertyType == self.PROP_ACTIVE_LAYER:
 			if self.selected is not None and self.selected:
 				ioBuf.u32 = self.PROP_ACTIVE_LAYER
 		elif propertyType == self.PROP_ACTIVE_CHANNEL:
 			if self.selected is not None and self.selected:
-				ioBuf.u32 = self.PROP_ACTIVE_LAYER
+				ioBuf.u32 = self.PROP_ACTIVE_CHANNEL
 		elif propertyType == self.PROP_SELECTION:
 			if self.isSelection is not None and self.isSelection:
 				ioBuf.u32 = self.PROP_SELECTION
@@ -550,7 +614,7 @@ class GimpIOBase:
 		elif propertyType == self.PROP_COMPRESSION:
 			if self.compression is not None:
 				ioBuf.u32 = self.PROP_COMPRESSION
-				ioBuf.u32 = self.compression
+				ioBuf.byte = self.compression
 		elif propertyType == self.PROP_GUIDES:
 			if self.guidelines is not None and self.guidelines:
 				pass
@@ -559,10 +623,11 @@ class GimpIOBase:
 		elif propertyType == self.PROP_RESOLUTION:
 			if self.horizontalResolution is not None and self.verticalResolution is not None:
 				ioBuf.u32 = self.PROP_RESOLUTION
-				ioBuf.u32 = int(self.horizontalResolution)
-				ioBuf.i32 = int(self.verticalResolution)
+				ioBuf.float32 = self.horizontalResolution
+				ioBuf.float32 = self.verticalResolution
 		elif propertyType == self.PROP_TATTOO:
 			if self.uniqueId is not None:
+				ioBuf.u32 = self.PROP_TATTOO
 				ioBuf.u32 = int(self.uniqueId, 16)
 		elif propertyType == self.PROP_PARASITES:
 			if self.parasites is not None and self.parasites:
@@ -605,9 +670,8 @@ class GimpIOBase:
 				ioBuf.u32 = self.PROP_GROUP_ITEM
 		elif propertyType == self.PROP_ITEM_PATH:
 			if self.itemPath is not None:
-				pass
-				# ioBuf.u32 = self.PROP_ITEM_PATH
-				# ioBuf.addBytes(self._itemPathEncode_())
+				ioBuf.u32 = self.PROP_ITEM_PATH
+				ioBuf.addBytes(self._itemPathEncode())
 		elif propertyType == self.PROP_GROUP_ITEM_FLAGS:
 			if self.groupItemFlags is not None:
 				ioBuf.u32 = self.PROP_GROUP_ITEM_FLAGS
@@ -657,7 +721,15 @@ class GimpIOBase:
 		return ioBuf.data
 
 	def _propertiesDecode(self, ioBuf: IO):
-		"""Decode a list of properties."""
+		"""Decode a list of properties.
+
+		Unless the document profile is "full" the payloads of
+		DEFERRED_PROPERTIES are kept as they are and only decoded when their
+		attribute is used.
+		"""
+		deferred = self.DEFERRED_PROPERTIES
+		if getattr(self.doc, "profile", "full") == "full":
+			deferred = ()
 		while True:
 			try:
 				propertyType = ioBuf.u32
@@ -666,16 +738,28 @@ class GimpIOBase:
 				break
 			if propertyType == 0:
 				break
+			if propertyType in deferred:
+				self._deferred[propertyType] = ioBuf.getBytes(dataLength)
+				continue
 			self._propertyDecode(propertyType, ioBuf.getBytes(dataLength))
 		return ioBuf.index
 
 	def _propertiesEncode(self):
-		"""Encode a list of properties."""
+		"""Encode a list of properties.
+
+		Each property is written as its type, the length of its payload and the
+		payload itself, and the list is terminated by PROP_END.
+		"""
 		ioBuf = IO()
-		for propertyType in range(1, self.PROP_NUM_PROPS):
+		propertyTypes = self.ENCODED_PROPERTIES or range(1, self.PROP_NUM_PROPS)
+		for propertyType in propertyTypes:
 			moData = self._propertyEncode(propertyType)
 			if moData:
-				ioBuf.addBytes(moData)
+				ioBuf.addBytes(moData[:4])
+				ioBuf.u32 = len(moData) - 4
+				ioBuf.addBytes(moData[4:])
+		ioBuf.u32 = self.PROP_END
+		ioBuf.u32 = 0
 		return ioBuf.data
 
 	def __repr__(self, indent: str = ""):
@@ -754,7 +838,7 @@ class GimpIOBase:
 			ret.append("Vectors: ")
 			for item in self.vectors:
 				ret.append(item.__repr__(indent + "\t"))
-		if self.colorMap:
+		if len(self.colorMap):
 			ret.append("Color Map: ")
 			for i, color in enumerate(self.colorMap):
 				ret.append(str(i) + f": ({color[0]}," + str(color[1]) + f",{color[2]})")
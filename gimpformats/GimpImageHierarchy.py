@@ -10,6 +10,7 @@ from PIL import Image
 
 from .GimpImageLevel import GimpImageLevel
 from .GimpIOBase import IO, GimpIOBase
+from .GimpPrecision import Precision
 
 
 class GimpImageHierarchy(GimpIOBase):
@@ -46,7 +47,8 @@ class GimpImageHierarchy(GimpIOBase):
 		self.width = ioBuf.u32
 		self.height = ioBuf.u32
 		self.bpp = ioBuf.u32
-		if self.bpp < 1 or self.bpp > 4:
+		bytesPerComponent = self.precision.bytesPerComponent
+		if self.bpp % bytesPerComponent or not 1 <= self.bpp // bytesPerComponent <= 4:
 			msg = (
 				"""'Unexpected bytes-per-pixel for image data ("""
 				+ str(self.bpp)
@@ -64,19 +66,21 @@ class GimpImageHierarchy(GimpIOBase):
 		self._data = data
 		return ioBuf.index
 
-	def encode(self):
-		"""Encode this object to a byte buffer."""
+	def encode(self, index: int = 0):
+		"""Encode this object to a byte buffer.
+
+		:param index: where the buffer will be placed in the file, the level
+			pointers are absolute file offsets
+		"""
 		dataioBuf = IO()
 		ioBuf = IO()
 		ioBuf.u32 = self.width
 		ioBuf.u32 = self.height
 		ioBuf.u32 = self.bpp
-		dataIndex = ioBuf.index + self.pointerSize * (len(self.levels) + 1)
+		dataIndex = index + ioBuf.index + self.pointerSize // 8 * (len(self.levels) + 1)
 		for level in self.levels:
-			ioBuf.addBytes(
-				self._pointerEncode(dataIndex + dataioBuf.index)
-			)  # TODO: This may be incorrect
-			dataioBuf.addBytes(level.encode())
+			ioBuf.addBytes(self._pointerEncode(dataIndex + dataioBuf.index))
+			dataioBuf.addBytes(level.encode(dataIndex + dataioBuf.index))
 		ioBuf.addBytes(self._pointerEncode(0))
 		ioBuf.addBytes(dataioBuf.data)
 		return ioBuf.data
@@ -89,12 +93,22 @@ class GimpImageHierarchy(GimpIOBase):
 		so this returns an array of one item
 		"""
 		if self._levels is None:
-			for ptr in self._levelPtrs:
+			levels = []
+			for ptr in self._levelPtrs or []:
 				level = GimpImageLevel(self)
 				level.decode(self._data, ptr)
-				self._levels = [level]
+				levels = [level]
+			self._levels = levels
 		return self._levels
 
+	@property
+	def precision(self) -> Precision:
+		"""Get the precision the pixels are stored in (that of the document)."""
+		precision = self.doc.precision
+		if precision is None:
+			return Precision()
+		return precision
+
 	@property
 	def image(self) -> Image.Image | None:
 		"""Get a final, compiled image."""
@@ -102,6 +116,13 @@ class GimpImageHierarchy(GimpIOBase):
 			return None
 		return self.levels[0].image
 
+	@property
+	def array(self):
+		"""Get the pixels as a NumPy array in the document precision."""
+		if not self.levels:
+			return None
+		return self.levels[0].array
+
 	@image.setter
 	def image(self, image: Image.Image):
 		"""Set the image."""
@@ -109,9 +130,11 @@ class GimpImageHierarchy(GimpIOBase):
 		self.height = image.height
 		if image.mode not in ["L", "LA", "RGB", "RGBA"]:
 			raise NotImplementedError("Unsupported PIL image type")
-		self.bpp = len(image.mode)
+		self.bpp = len(image.mode) * self.precision.bytesPerComponent
 		self._levelPtrs = None
-		# self._levels = [GimpImageLevel(self, image)]
+		level = GimpImageLevel(self)
+		level.image = image
+		self._levels = [level]
 
 	def __repr__(self, indent: str = ""):
 		"""Get a textual representation of this object."""
@@ -5,12 +5,12 @@ This represents a single level in an imageHierarchy
 """
 from __future__ import annotations
 
-import math
 import zlib
 
 import PIL.Image
 from PIL.Image import Image
 
+from . import utils
 from .GimpIOBase import IO, GimpIOBase
 
 # pylint:disable=invalid-name
@@ -26,15 +26,28 @@ class GimpImageLevel(GimpIOBase):
 		GimpIOBase.__init__(self, parent)
 		self.width = 0
 		self.height = 0
-		self._tiles = None  # tile PIL images
+		self._tiles = None  # tile NumPy arrays
+		self._array = None
 		self._image = None
 
 	def decode(self, data: bytes, index: int = 0):
 		"""Decode a byte buffer.
 
+		Each tile is decoded into a (height, width, channels) NumPy array of the
+		document precision, converted from the big-endian file order to native
+		order in a single step.
+
+		Tiles of a single colour, like flat fills, are stored as that one pixel
+		(see `utils.constantArray`). For RLE they are found from the run
+		headers alone without decoding the tile, otherwise by checking the
+		first row of the decoded tile before the rest of it. Other tiles are
+		shared with identical ones if the document has a `TileStore`.
+
 		:param data: data buffer to decode
 		:param index: index within the buffer to start at
 		"""
+		import numpy as np
+
 		ioBuf = IO(data, index)
 		# print 'Decoding image level at',ioBuf.index
 		self.width = ioBuf.u32
@@ -46,8 +59,14 @@ class GimpImageLevel(GimpIOBase):
 			raise RuntimeError(
 				"Image data size mismatch. " + currentSize + "!=" + expectedSize + msg
 			)
+		fileType = np.dtype(self.precision.dtype)
+		nativeType = fileType.newbyteorder("=")
+		channels = self.bpp // self.precision.bytesPerComponent
+		palette = self.palette
+		tileStore = getattr(self.doc, "tileStore", None)
 		self._tiles = []
 		self._image = None
+		self._array = None
 		for y in range(0, self.height, 64):
 			for x in range(0, self.width, 64):
 				ptr = self._pointerDecode(ioBuf)
@@ -55,34 +74,119 @@ class GimpImageLevel(GimpIOBase):
 				totalBytes = size[0] * size[1] * self.bpp
 				if self.doc.compression == 0:  # none
 					data = ioBuf.data[ptr : ptr + totalBytes]
+					pixel = self._constantRows(data, size, self.bpp)
 				elif self.doc.compression == 1:  # RLE
-					data = self._decodeRLE(ioBuf.data, size[0] * size[1], self.bpp, ptr)
+					pixel = self._constantRLE(ioBuf.data, size[0] * size[1], self.bpp, ptr)
+					if pixel is None:
+						data = self._decodeRLE(ioBuf.data, size[0] * size[1], self.bpp, ptr)
 				elif self.doc.compression == 2:  # zip
-					data = zlib.decompress(
-						ioBuf.data[ptr : ptr + totalBytes + 24]
-					)  # guess how many bytes are needed
+					# the stream length isn't stored so stop once the tile is complete
+					data = zlib.decompressobj().decompress(memoryview(ioBuf.data)[ptr:], totalBytes)
+					pixel = self._constantRows(data, size, self.bpp)
 				else:
 					raise RuntimeError(f"ERR: unsupported compression mode {self.doc.compression}")
-				subImage = PIL.Image.frombytes(self.mode, size, bytes(data), decoder_name="raw")
-				self._tiles.append(subImage)
+				if pixel is not None:
+					self._tiles.append(self._constantTile(pixel, size, fileType, nativeType, palette))
+					continue
+				tile = np.frombuffer(data, dtype=fileType, count=size[0] * size[1] * channels)
+				tile = tile.reshape(size[1], size[0], channels).astype(nativeType, copy=False)
+				if palette is not None:
+					tile = self._expandIndexed(tile, palette)
+				if tileStore is not None:
+					tile = tileStore.intern(tile)
+				self._tiles.append(tile)
 		_ = self._pointerDecode(ioBuf)  # list ends with nul character
 		return ioBuf.index
 
-	def encode(self):
-		"""Encode this object to a byte buffer."""
+	def _constantTile(self, pixel: bytes, size: tuple[int, int], fileType, nativeType, palette):
+		"""Make a constant tile of `size` from the bytes of its one pixel."""
+		import numpy as np
+
+		pixel = np.frombuffer(pixel, dtype=fileType).astype(nativeType).reshape(1, 1, -1)
+		if palette is not None:
+			pixel = self._expandIndexed(pixel, palette)
+		return utils.constantArray(pixel, (size[1], size[0], pixel.shape[2]))
+
+	@staticmethod
+	def _constantRLE(data, pixels, bpp, index=0) -> bytes | None:
+		"""Get the pixel of an RLE encoded tile of a single colour, or None if it isn't.
+
+		Only the run headers are read: a single colour tile is a repeat (or a
+		few repeats) of the same byte in every stream.
+		"""
+		pixel = bytearray()
+		for _chan in range(bpp):
+			value = None
+			count = 0
+			while count < pixels:
+				opcode = data[index]
+				if opcode <= 126:  # a short run of identical bytes
+					count += opcode + 1
+					byte = data[index + 1]
+					index += 2
+				elif opcode == 127:  # A long run of identical bytes
+					count += data[index + 1] * 256 + data[index + 2]
+					byte = data[index + 3]
+					index += 4
+				else:  # different bytes
+					return None
+				if value is not None and byte != value:
+					return None
+				value = byte
+			pixel.append(value)
+		return bytes(pixel)
+
+	@staticmethod
+	def _constantRows(data: bytes, size: tuple[int, int], bpp: int) -> bytes | None:
+		"""Get the pixel of decoded tile data of a single colour, or None if it isn't.
+
+		The first row is checked before the whole tile, so a tile that isn't a
+		single colour is usually rejected after one row.
+		"""
+		rowBytes = size[0] * bpp
+		if len(data) != rowBytes * size[1]:
+			# a truncated tile, left for decoding to fail on
+			return None
+		row = data[:rowBytes]
+		if row != row[:bpp] * size[0] or data != row * size[1]:
+			return None
+		return bytes(row[:bpp])
+
+	@staticmethod
+	def _expandIndexed(tile, palette):
+		"""Expand a tile of colour map indices (and alpha) to RGB(A)."""
+		import numpy as np
+
+		rgb = palette.take(tile[..., 0], axis=0)
+		if tile.shape[2] == 1:
+			return rgb
+		return np.concatenate((rgb, tile[..., 1:]), axis=2)
+
+	def encode(self, index: int = 0):
+		"""Encode this object to a byte buffer.
+
+		:param index: where the buffer will be placed in the file, the tile
+			pointers are absolute file offsets
+		"""
+		import numpy as np
+
 		dataioBuf = IO()
 		ioBuf = IO()
 		ioBuf.u32 = self.width
 		ioBuf.u32 = self.height
-		dataIndex = ioBuf.index + self.pointerSize * (len(self.tiles) + 1)
-		for tile in self.tiles:
+		tiles = self.tiles
+		dataIndex = index + ioBuf.index + self.pointerSize // 8 * (len(tiles) + 1)
+		fileType = np.dtype(self.precision.dtype)
+		palette = self.palette
+		for tile in tiles:
 			ioBuf.addBytes(self._pointerEncode(dataIndex + dataioBuf.index))
-			data = tile.tobytes()
+			if palette is not None:
+				tile = self._compressIndexed(tile, palette)
+			data = tile.astype(fileType, copy=False).tobytes()
 			if self.doc.compression == 0:  # none
 				pass
 			elif self.doc.compression == 1:  # RLE
 				data = self._encodeRLE(data, self.bpp)
-				# raise RuntimeError('RLE Compression is a work in progress!')
 			elif self.doc.compression == 2:  # zip
 				data = zlib.compress(data)
 			else:
@@ -92,189 +196,245 @@ class GimpImageLevel(GimpIOBase):
 		ioBuf.addBytes(dataioBuf.data)
 		return ioBuf.data
 
+	@staticmethod
+	def _compressIndexed(tile, palette):
+		"""Map a tile of RGB(A) pixels back to colour map indices (and alpha)."""
+		import numpy as np
+
+		# pack the colours into single integers so they can be searched for
+		keys = palette.astype(np.uint32) @ np.array([65536, 256, 1], dtype=np.uint32)
+		keys, first = np.unique(keys, return_index=True)
+		pixels = tile[..., :3].astype(np.uint32) @ np.array([65536, 256, 1], dtype=np.uint32)
+		indices = first[np.searchsorted(keys, pixels).clip(0, len(keys) - 1)]
+		indices = indices.astype(tile.dtype)[..., None]
+		if tile.shape[2] == 3:
+			return indices
+		return np.concatenate((indices, tile[..., 3:]), axis=2)
+
 	def _decodeRLE(self, data, pixels, bpp, index=0):
+		"""Decode RLE encoded image data.
+
+		Each byte of a pixel is stored as its own run-length encoded stream, so
+		the streams are decoded one after another and then interleaved.
+		"""
 		_ = self
-		"""Decode RLE encoded image data."""
-		ret = [[] for chan in range(bpp)]
-		for chan in range(bpp):
-			n = 0
-			while n < pixels:
+		import numpy as np
+
+		planes = bytearray()
+		for _chan in range(bpp):
+			end = len(planes) + pixels
+			while len(planes) < end:
 				opcode = data[index]
 				index += 1
 				if 0 <= opcode <= 126:  # a short run of identical bytes
-					val = data[index]
+					planes += data[index : index + 1] * (opcode + 1)
 					index += 1
-					for _ in range(opcode + 1):
-						ret[chan].append(val)
-						n += 1
 				elif opcode == 127:  # A long run of identical bytes
-					m = data[index]
-					index += 1
-					b = data[index]
-					index += 1
-					val = data[index]
-					index += 1
-					amt = m * 256 + b
-					for _ in range(amt):
-						ret[chan].append(val)
-						n += 1
+					amt = data[index] * 256 + data[index + 1]
+					planes += data[index + 2 : index + 3] * amt
+					index += 3
 				elif opcode == 128:  # A long run of different bytes
-					m = data[index]
-					index += 1
-					b = data[index]
-					index += 1
-					amt = m * 256 + b
-					for _ in range(amt):
-						val = data[index]
-						index += 1
-						ret[chan].append(val)
-						n += 1
-				elif 129 <= opcode <= 255:  # a short run of different bytes
+					amt = data[index] * 256 + data[index + 1]
+					index += 2
+					planes += data[index : index + amt]
+					index += amt
+				else:  # 129 <= opcode <= 255, a short run of different bytes
 					amt = 256 - opcode
-					for _ in range(amt):
-						val = data[index]
-						index += 1
-						ret[chan].append(val)
-						n += 1
-				else:
-					print("Unreachable branch", opcode)
-					raise RuntimeError()
-		# flatten/weave the individual channels into one strream
-		flat = bytearray()
-		for i in range(pixels):
-			for chan in range(bpp):
-				flat.append(ret[chan][i])
-		return flat
+					planes += data[index : index + amt]
+					index += amt
+			del planes[end:]
+		# flatten/weave the individual channels into one stream
+		return np.frombuffer(planes, dtype=np.uint8).reshape(bpp, pixels).T.tobytes()
 
 	def _encodeRLE(self, data, bpp):
-		"""Encode image to RLE image data."""
+		"""Encode image data as RLE streams.
+
+		The pixels are split into one stream per byte of the pixel and the runs
+		of all streams are found at once with array operations. Runs of three or
+		more identical bytes are stored as repeats, everything in between as
+		literal runs.
+		"""
 		_ = self
+		import numpy as np
+
+		streams = np.frombuffer(data, dtype=np.uint8).reshape(-1, bpp).T.ravel()
+		pixels = len(streams) // bpp
+		# runs start where the byte changes or a new stream begins
+		runStart = np.empty(len(streams), dtype=bool)
+		runStart[0] = True
+		np.not_equal(streams[1:], streams[:-1], out=runStart[1:])
+		runStart[::pixels] = True
+		runStarts = np.flatnonzero(runStart)
+		runLengths = np.diff(np.append(runStarts, len(streams)))
+		isRepeat = runLengths >= 3
+
+		# each repeat is a segment of its own, neighbouring short runs are merged
+		newSegment = isRepeat | (runStarts % pixels == 0)
+		newSegment[1:] |= isRepeat[:-1]
+		segment = np.flatnonzero(newSegment)
+		starts = runStarts[segment]
+		lengths = np.diff(np.append(starts, len(streams)))
+		repeat = isRepeat[segment]
+		long = lengths > 127
+
+		# repeats are an opcode (and 16-bit length) followed by the byte,
+		# literals are an opcode (and 16-bit length) followed by the bytes
+		headers = np.where(repeat, np.where(long, 4, 2), np.where(long, 3, 1))
+		sizes = headers + np.where(repeat, 0, lengths)
+		offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+		out = np.empty(sizes.sum(), dtype=np.uint8)
 
-		def countSame(data, startIdx):
-			"""Count how many times bytes are identical."""
-			idx = startIdx
-			l = len(data)
-			if idx >= l:
-				return 0
-			c = data[idx]
-			idx = startIdx + 1
-			while idx < l and data[idx] == c:
-				idx += 1
-			return idx - startIdx
-
-		def countDifferent(data, startIdx):
-			"""Count how many times bytes are different."""
-			idx = startIdx
-			l = len(data)
-			if idx >= l:
-				return 1
-			c = data[idx]
-			idx = startIdx + 1
-			while idx < (l - 1) and data[idx] != c:
-				idx += 1
-				c = data[idx]
-			return idx - startIdx
-
-		def rleEncodeChan(data):
-			"""Rle encode a single channel of data."""
-			ret = []
-			idx = 0
-			while idx < len(data):
-				nRepeats = countSame(data, 0)
-				if nRepeats == 1:  # different bytes
-					nDifferences = countDifferent(data, 1)
-					if nDifferences <= 127:  # short run of different bytes
-						ret.append(129 + nRepeats - 1)
-						ret.append(data[idx])
-						idx += nDifferences
-					else:  # long run of different bytes
-						ret.append(128)
-						ret.append(math.floor(nDifferences / 256.0))
-						ret.append(nDifferences % 256)
-						ret.append(data[idx])
-						idx += nDifferences
-				elif nRepeats <= 127:  # short run of same bytes
-					ret.append(nRepeats - 1)
-					ret.append(data[idx])
-					idx += nRepeats
-				else:  # long run of same bytes
-					ret.append(127)
-					ret.append(math.floor(nRepeats / 256.0))
-					ret.append(nRepeats % 256)
-					ret.append(data[idx])
-					idx += nRepeats
-			return ret
-
-		# if there is only one channel, encode and return it directly
-		if bpp == 1:
-			return rleEncodeChan(data)
-		# split into channels
-		dataByChannel = []
-		for chan in range(bpp):
-			chanData = []
-			for index in range(chan, bpp, len(data)):
-				chanData.append(data[index])
-			dataByChannel.append(chanData)
-		# encode each channel
-		for dbc in dataByChannel:  # iterate through 2d array
-			dbc = rleEncodeChan(dbc)
-		# join and return
-		return "".join("".join(str(x)) for x in dataByChannel)
+		shortRepeat = repeat & ~long
+		out[offsets[shortRepeat]] = lengths[shortRepeat] - 1
+		out[offsets[shortRepeat] + 1] = streams[starts[shortRepeat]]
+		longRepeat = repeat & long
+		out[offsets[longRepeat]] = 127
+		out[offsets[longRepeat] + 1] = lengths[longRepeat] >> 8
+		out[offsets[longRepeat] + 2] = lengths[longRepeat] & 0xFF
+		out[offsets[longRepeat] + 3] = streams[starts[longRepeat]]
+		shortLiteral = ~repeat & ~long
+		out[offsets[shortLiteral]] = 256 - lengths[shortLiteral]
+		longLiteral = ~repeat & long
+		out[offsets[longLiteral]] = 128
+		out[offsets[longLiteral] + 1] = lengths[longLiteral] >> 8
+		out[offsets[longLiteral] + 2] = lengths[longLiteral] & 0xFF
+
+		# copy the literal bytes in after their headers
+		segmentOf = np.repeat(np.arange(len(segment)), lengths)
+		literal = ~repeat[segmentOf]
+		segmentOf = segmentOf[literal]
+		positions = np.flatnonzero(literal)
+		out[positions - starts[segmentOf] + offsets[segmentOf] + headers[segmentOf]] = streams[literal]
+		return out.tobytes()
 
 	@property
 	def bpp(self):
 		"""Get bpp."""
 		return self.parent.bpp
 
+	@property
+	def precision(self):
+		"""Get the precision of the pixels."""
+		return self.parent.precision
+
+	@property
+	def channels(self) -> int:
+		"""Get the number of channels per pixel.
+
+		Indexed pixels are expanded to RGB(A) so have two more channels than
+		are stored in the file.
+		"""
+		channels = self.bpp // self.precision.bytesPerComponent
+		if self.isIndexed:
+			return channels + 2
+		return channels
+
+	@property
+	def isIndexed(self) -> bool:
+		"""Are the pixels indices into the document colour map."""
+		# only layers have a colorMode, 4 and 5 being "Indexed" with and without alpha
+		return getattr(self.parent.parent, "colorMode", None) in (4, 5)
+
+	@property
+	def palette(self):
+		"""Get the document colour map as a (256, 3) array for indexed pixels, otherwise None."""
+		if not self.isIndexed:
+			return None
+		import numpy as np
+
+		palette = np.zeros((256, 3), dtype=np.uint8)  # out of range indices are black
+		colorMap = self.doc.colorMap
+		palette[: len(colorMap)] = colorMap
+		return palette
+
+	@property
+	def colourChannels(self) -> int:
+		"""Get the number of channels that hold colour rather than coverage."""
+		from .GimpChannel import GimpChannel
+
+		if isinstance(self.parent.parent, GimpChannel):
+			return 0
+		return self.channels - (self.channels in (2, 4))
+
 	@property
 	def mode(self):
 		"""Get mode."""
 		MODES = [None, "L", "LA", "RGB", "RGBA"]
-		return MODES[self.bpp]
+		return MODES[self.channels]
 
 	@property
 	def tiles(self):
 		"""Get tiles."""
 		if self._tiles is not None:
 			return self._tiles
-		if self.image is not None:
-			return self._imgToTiles(self.image)
+		if self._image is not None:
+			return self._imgToTiles(self.array)
 		return None
 
-	def _imgToTiles(self, image):
+	@property
+	def decodedTiles(self):
+		"""Get the tiles as they were decoded from the file.
+
+		Returns None if the level wasn't decoded, or once its PIL image has been
+		handed out as that may have been edited since.
 		"""
-		break an image into a series of tiles, each<=64x64
+		if self._image is not None:
+			return None
+		return self._tiles
+
+	def _imgToTiles(self, array):
+		"""
+		break an image array into a series of tiles, each<=64x64
 		"""
 		ret = []
 		for y in range(0, self.height, 64):
 			for x in range(0, self.width, 64):
-				bounds = (x, y, min(self.width - x, 64), min(self.height - y, 64))
-				ret.append(image.crop(bounds))
+				ret.append(array[y : y + 64, x : x + 64])
 		return ret
 
 	@property
-	def image(self) -> Image:
-		"""
-		Get a final, compiled image
+	def array(self):
+		"""Get the pixels as a (height, width, channels) NumPy array.
+
+		The array is in native byte order and keeps the document precision.
 		"""
-		if self._image is None:
-			self._image = PIL.Image.new(self.mode, (self.width, self.height), color=None)
+		if self._array is None:
+			import numpy as np
+
+			if self._tiles is None:
+				array = np.asarray(self._image).reshape(self.height, self.width, -1)
+				self._array = self.precision.fromUint8(array, self.colourChannels)
+				return self._array
+			# only publish the array once it is complete, other threads may be reading it
+			array = np.empty((self.height, self.width, self.channels), dtype=self._tiles[0].dtype)
 			tileNum = 0
 			for y in range(0, self.height, 64):
 				for x in range(0, self.width, 64):
-					subImage = self._tiles[tileNum]
+					tile = self._tiles[tileNum]
 					tileNum += 1
-					self._image.paste(subImage, (x, y))
-			# self._tiles = None
+					array[y : y + tile.shape[0], x : x + tile.shape[1]] = tile
+			self._array = array
+		return self._array
+
+	@property
+	def image(self) -> Image:
+		"""
+		Get a final, compiled image
+
+		Pixels of higher precision documents are quantized to 8 bits.
+		"""
+		if self._image is None:
+			pixels = self.precision.toUint8(self.array, self.colourChannels)
+			self._image = PIL.Image.frombytes(self.mode, (self.width, self.height), pixels.tobytes())
 		return self._image
 
 	@image.setter
 	def image(self, image: Image):
 		self._image = image
+		self._array = None
 		self._tiles = None
 		self.width = image.width
 		self.height = image.height
-		self.tiles = None
 
 	def __repr__(self, indent: str = ""):
 		"""Get a textual representation of this object."""
@@ -5,6 +5,7 @@ from __future__ import annotations
 from binaryiotools import IO
 from PIL.Image import Image
 
+from . import utils
 from .GimpChannel import GimpChannel
 from .GimpImageHierarchy import GimpImageHierarchy
 from .GimpIOBase import GimpIOBase
@@ -22,6 +23,33 @@ class GimpLayer(GimpIOBase):
 		"Indexed with alpha",
 	]
 	PIL_MODE_TO_LAYER_MODE = {"L": 2, "LA": 3, "RGB": 0, "RGBA": 1}
+	# the properties GIMP reads for a layer
+	ENCODED_PROPERTIES = (
+		GimpIOBase.PROP_ACTIVE_LAYER,
+		GimpIOBase.PROP_FLOATING_SELECTION,
+		GimpIOBase.PROP_OPACITY,
+		GimpIOBase.PROP_MODE,
+		GimpIOBase.PROP_VISIBLE,
+		GimpIOBase.PROP_LINKED,
+		GimpIOBase.PROP_LOCK_ALPHA,
+		GimpIOBase.PROP_APPLY_MASK,
+		GimpIOBase.PROP_EDIT_MASK,
+		GimpIOBase.PROP_SHOW_MASK,
+		GimpIOBase.PROP_OFFSETS,
+		GimpIOBase.PROP_TATTOO,
+		GimpIOBase.PROP_PARASITES,
+		GimpIOBase.PROP_TEXT_LAYER_FLAGS,
+		GimpIOBase.PROP_LOCK_CONTENT,
+		GimpIOBase.PROP_GROUP_ITEM,
+		GimpIOBase.PROP_ITEM_PATH,
+		GimpIOBase.PROP_GROUP_ITEM_FLAGS,
+		GimpIOBase.PROP_LOCK_POSITION,
+		GimpIOBase.PROP_FLOAT_OPACITY,
+		GimpIOBase.PROP_COLOR_TAG,
+		GimpIOBase.PROP_COMPOSITE_MODE,
+		GimpIOBase.PROP_COMPOSITE_SPACE,
+		GimpIOBase.PROP_BLEND_SPACE,
+	)
 
 	def __init__(self, parent, name: str | None = None, image: Image | None = None):
 		"""Represents a single layer in a gimp image.
@@ -78,7 +106,7 @@ class GimpLayer(GimpIOBase):
 		# Return the offset
 		return ioBuf.index
 
-	def encode(self):
+	def encode(self, index: int = 0):
 		"""Encode to byte array.
 
 		Steps:
@@ -88,6 +116,10 @@ class GimpLayer(GimpIOBase):
 		Set the image hierarchy and mask pointers
 		Return the data
 
+		Args:
+			index (int, optional): where the data will be placed in the file,
+			pointers are absolute file offsets. Defaults to 0.
+
 		"""
 		# Create a new IO buffer (array of binary values)
 		dataAreaIO = IO()
@@ -96,18 +128,19 @@ class GimpLayer(GimpIOBase):
 		ioBuf.u32 = self.width
 		ioBuf.u32 = self.height
 		ioBuf.u32 = self.colorMode
-		ioBuf.sz754 = self.name
+		utils.sz754Encode(ioBuf, self.name)
 		# Layer properties
 		ioBuf.addBytes(self._propertiesEncode())
 		# Pointer to the image heirachy structure
-		dataAreaIndex = ioBuf.index + self.pointerSize * 2
+		dataAreaIndex = index + ioBuf.index + self.pointerSize // 8 * 2
 		ioBuf.addBytes(self._pointerEncode(dataAreaIndex))
-		dataAreaIO.addBytes(self.imageHierarchy.encode())
-		# ioBuf.addBytes(self._pointerEncode_(dataAreaIndex))
+		dataAreaIO.addBytes(self.imageHierarchy.encode(dataAreaIndex))
 		# Pointer to the layer mask
 		if self.mask is not None:
-			dataAreaIO.addBytes(self.mask.encode())
-		ioBuf.addBytes(self._pointerEncode(dataAreaIndex + dataAreaIO.index))
+			ioBuf.addBytes(self._pointerEncode(dataAreaIndex + dataAreaIO.index))
+			dataAreaIO.addBytes(self.mask.encode(dataAreaIndex + dataAreaIO.index))
+		else:
+			ioBuf.addBytes(self._pointerEncode(0))
 		ioBuf.addBytes(dataAreaIO)
 		# Return the data
 		return ioBuf.data
@@ -116,11 +149,20 @@ class GimpLayer(GimpIOBase):
 	def mask(self):
 		"""Get the layer mask."""
 		if self._mask is None and self._maskPtr is not None and self._maskPtr != 0:
-			self._mask = GimpChannel(self)
+			mask = GimpChannel(self)
 			if self._data:
-				self._mask.decode(self._data, self._maskPtr)
+				mask.decode(self._data, self._maskPtr)
+			self._mask = mask
 		return self._mask
 
+	@mask.setter
+	def mask(self, mask: GimpChannel | None):
+		"""Set the layer mask, which must be the same size as the layer."""
+		if mask is not None:
+			mask.parent = self
+		self._mask = mask
+		self._maskPtr = None
+
 	@property
 	def image(self) -> Image | None:
 		"""Get the layer image.
@@ -148,6 +190,18 @@ class GimpLayer(GimpIOBase):
 		self._imageHierarchy = GimpImageHierarchy(self)
 		self._imageHierarchy.image = image
 
+	@property
+	def array(self):
+		"""Get the layer pixels as a (height, width, channels) NumPy array.
+
+		Unlike `image` the pixels keep the document precision.
+
+		NOTE: can return None!
+		"""
+		if self.imageHierarchy is None:
+			return None
+		return self.imageHierarchy.array
+
 	@property
 	def imageHierarchy(self) -> GimpImageHierarchy:
 		"""Get the image hierarchy objects.
@@ -157,10 +211,12 @@ class GimpLayer(GimpIOBase):
 
 		NOTE: can return None if it has been fully read into an image
 		"""
-		if self._imageHierarchy is None and self._imageHierarchyPtr:
-			self._imageHierarchy = GimpImageHierarchy(self)
-		if self._imageHierarchy and self._data and self._imageHierarchyPtr:
-			self._imageHierarchy.decode(self._data, self._imageHierarchyPtr)
+		if self._imageHierarchy is None and self._data and self._imageHierarchyPtr:
+			# decode before publishing so other threads never see a half decoded hierarchy
+			imageHierarchy = GimpImageHierarchy(self)
+			imageHierarchy.decode(self._data, self._imageHierarchyPtr)
+			self._imageHierarchy = imageHierarchy
+		if self._imageHierarchy is not None:
 			return self._imageHierarchy
 		raise RuntimeError("self._imageHierarchy or self._data or self._imageHierarchyPtr is None")
 
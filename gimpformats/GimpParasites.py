@@ -10,6 +10,8 @@ from __future__ import annotations
 
 from binaryiotools import IO
 
+from . import utils
+
 # TODO: how to best use these for our puproses??
 KNOWN_DOCUMENT_PARASITES = [
 	"jpeg-save-defaults",
@@ -78,7 +80,7 @@ class GimpParasite:
 		:param index: index within the buffer to start at
 		"""
 		ioBuf = IO()
-		ioBuf.sz754 = self.name
+		utils.sz754Encode(ioBuf, self.name)
 		ioBuf.u32 = self.flags
 		ioBuf.u32 = len(self.data)
 		ioBuf.addBytes(self.data)
@@ -29,15 +29,16 @@ class Precision:
 				self.bits = (8, 16, 32, 16, 32)[code]
 				self.numberFormat = (int, int, int, float, float)[code]
 			elif gimpVersion in (5, 6):
+				# 100 is 8-bit linear, 150 8-bit gamma, 200 16-bit linear, ...
 				self.gamma = code % 100 != 0
-				code = int(code / 100)
+				code = code // 100 - 1
 				self.bits = (8, 16, 32, 16, 32)[code]
 				self.numberFormat = (int, int, int, float, float)[code]
-			else:  # gimpVersion 7 or above
+			else:  # gimpVersion 7 or above, half float moved from 400 to 500
 				self.gamma = code % 100 != 0
-				code = int(code / 100)
-				self.bits = (8, 16, 32, 16, 32, 64)[code]
-				self.numberFormat = (int, int, int, float, float, float)[code]
+				code = code // 100 - 1
+				self.bits = (8, 16, 32, None, 16, 32, 64)[code]
+				self.numberFormat = (int, int, int, None, float, float, float)[code]
 
 	def encode(self, gimpVersion: int, ioBuf: IO):
 		"""Encode this to the file.
@@ -55,25 +56,89 @@ class Precision:
 					raise RuntimeError(
 						f"Illegal precision ({self}" + f") for gimp version {gimpVersion}"
 					)
+				# gamma is implied by the precision in version 4
 				if self.numberFormat == int:
 					code = (8, 16, 32).index(self.bits)
 				else:
-					code = (16, 32).index(self.bits) + 2
-				code = code * 100
-				if self.gamma:
-					code += 50
+					code = (16, 32).index(self.bits) + 3
 			elif gimpVersion in (5, 6):
 				raise NotImplementedError(f"Cannot save to gimp developer version {gimpVersion}")
 			else:  # version 7 or above
 				if self.numberFormat == int:
-					code = (8, 16, 32).index(self.bits)
+					code = (8, 16, 32).index(self.bits) + 1
 				else:
-					code = (16, 32, 64).index(self.bits) + 2
+					code = (16, 32, 64).index(self.bits) + 5
 				code = code * 100
 				if self.gamma:
 					code += 50
 			ioBuf.u32 = code
 
+	@property
+	def bytesPerComponent(self) -> int:
+		"""Number of bytes used to store a single channel of a pixel."""
+		return self.bits // 8
+
+	@property
+	def dtype(self) -> str:
+		"""NumPy type string of a single channel of a pixel as stored in the file (big-endian)."""
+		kind = "u" if self.numberFormat is int else "f"
+		return f">{kind}{self.bytesPerComponent}"
+
+	@property
+	def isUint8(self) -> bool:
+		"""Is this the classic 8-bit gamma integer precision."""
+		return self.bits == 8 and self.gamma and self.numberFormat is int
+
+	def toFloat(self, array, colourChannels: int = 0):
+		"""Convert pixels in this precision to float64 on a 0-255 scale.
+
+		Integer formats are scaled by their maximum value. The first
+		`colourChannels` channels of linear light precisions are encoded to sRGB so
+		the result matches what an 8-bit gamma document would hold. Alpha, masks
+		and channels are coverage values and are never encoded.
+		"""
+		import numpy as np
+
+		pixels = array.astype(np.float64)
+		if self.numberFormat is int:
+			pixels *= 1.0 / (2**self.bits - 1)
+		if not self.gamma and colourChannels:
+			colour = np.clip(pixels[..., :colourChannels], 0.0, 1.0)
+			pixels[..., :colourChannels] = np.where(
+				colour <= 0.0031308,
+				colour * 12.92,
+				1.055 * colour ** (1 / 2.4) - 0.055,
+			)
+		pixels *= 255.0
+		return pixels
+
+	def toUint8(self, array, colourChannels: int = 0):
+		"""Quantize pixels in this precision to 8-bit gamma integers."""
+		import numpy as np
+
+		if self.isUint8:
+			return array.astype(np.uint8, copy=False)
+		return np.around(np.clip(self.toFloat(array, colourChannels), 0.0, 255.0)).astype(np.uint8)
+
+	def fromUint8(self, array, colourChannels: int = 0):
+		"""Convert 8-bit gamma integer pixels to this precision (the inverse of `toUint8`)."""
+		import numpy as np
+
+		nativeType = np.dtype(self.dtype).newbyteorder("=")
+		if self.isUint8:
+			return array.astype(nativeType, copy=False)
+		pixels = array.astype(np.float64) * (1.0 / 255.0)
+		if not self.gamma and colourChannels:
+			colour = pixels[..., :colourChannels]
+			pixels[..., :colourChannels] = np.where(
+				colour <= 0.04045,
+				colour / 12.92,
+				((colour + 0.055) / 1.055) ** 2.4,
+			)
+		if self.numberFormat is int:
+			pixels = np.around(pixels * (2**self.bits - 1))
+		return pixels.astype(nativeType)
+
 	def requiredGimpVersion(self):
 		"""Return the lowest gimp version that supports this precision."""
 		if self.bits == 8 and self.gamma and self.numberFormat == int:
@@ -87,5 +152,5 @@ class Precision:
 		ret = []
 		ret.append(str(self.bits) + "-bit")
 		ret.append("gamma" if self.gamma else "linear")
-		ret.append("integer" if self.numberFormat is int else float)
+		ret.append("integer" if self.numberFormat is int else "float")
 		return " ".join(ret)
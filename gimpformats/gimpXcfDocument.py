@@ -3,30 +3,36 @@
 
 Currently supports:
 	Loading xcf files
+	Saving xcf files
 	Getting image hierarchy and info
 	Getting image for each layer (PIL image)
+	Rendering a final, compositied image
 Currently not supporting:
-	Saving
 	Programatically alter documents (add layer, etc)
-	Rendering a final, compositied image
 """
 from __future__ import annotations
 
-import copy
+from collections.abc import Collection
+from functools import cache
 from io import BytesIO
+from typing import TYPE_CHECKING
 
-import PIL.ImageGrab
 from binaryiotools import IO
-from blendmodes.blend import BlendType, blendLayers
 from PIL import Image
 
-from . import utils
+from . import blendKernels, utils
 from .GimpChannel import GimpChannel
-from .GimpImageHierarchy import GimpImageHierarchy
 from .GimpIOBase import GimpIOBase
 from .GimpLayer import GimpLayer
 from .GimpPrecision import Precision
+from .layerTree import LayerTree
+from .tiledImage import TILE_SIZE, TiledImage, cropWOffset
+
+if TYPE_CHECKING:
+	import numpy as np
+	from blendmodes.blend import BlendType
 
+	from .tileStore import TileStore
 
 
 from time import time
@@ -67,9 +73,36 @@ class GimpDocument(GimpIOBase):
 		https://gitlab.gnome.org/GNOME/gimp/blob/master/devel-docs/xcf.txt
 	"""
 
-	def __init__(self, fileName=None):
+	# the properties GIMP reads for an image, the rest only apply to items
+	ENCODED_PROPERTIES = (
+		GimpIOBase.PROP_COLORMAP,
+		GimpIOBase.PROP_COMPRESSION,
+		GimpIOBase.PROP_RESOLUTION,
+		GimpIOBase.PROP_TATTOO,
+		GimpIOBase.PROP_PARASITES,
+		GimpIOBase.PROP_UNIT,
+	)
+
+	# how much of a document is decoded up front, see `__init__`
+	PROFILES = ("full", "pixels", "structure")
+
+	def __init__(self, fileName=None, profile: str = "full", tileStore: TileStore | None = None):
 		"""Pure python implementation of the gimp file format.
 
+		The profile chooses how much is decoded up front:
+		- "full" decodes everything when the document is loaded
+		- "pixels" defers metadata that isn't needed to get the pixels, like
+		parasites and guides (see `GimpIOBase.DEFERRED_PROPERTIES`), until it
+		is used
+		- "structure" is for reading the layers and their properties, it
+		defers the same metadata and memory maps the file so the tile data
+		isn't read unless pixels are asked for
+		Either way every attribute is available, deferred ones are decoded on
+		first use.
+
+		Decoded tiles are deduplicated by `tileStore` if one is given, which
+		may be shared with other documents.
+
 		Has a series of attributes including the following:
 		self._layers = None
 		self._layerPtr = []
@@ -85,6 +118,10 @@ class GimpDocument(GimpIOBase):
 		See:
 			https://gitlab.gnome.org/GNOME/gimp/blob/master/devel-docs/xcf.txt
 		"""
+		if profile not in self.PROFILES:
+			raise ValueError(f"Unknown decode profile {profile!r}, expected one of {self.PROFILES}")
+		self.profile = profile
+		self.tileStore = tileStore
 		GimpIOBase.__init__(self, self)
 		self._layers = []
 		self._layerPtr = []
@@ -96,6 +133,7 @@ class GimpDocument(GimpIOBase):
 		self.baseColorMode = 0
 		self.precision = None  # Precision object
 		self._data = None
+		self._layerTree = None
 		self.fileName = None
 		if fileName is not None:
 			self.load(fileName)
@@ -105,7 +143,10 @@ class GimpDocument(GimpIOBase):
 
 		:param fileName: can be a file name or a file-like object
 		"""
-		self.fileName, data = utils.fileOpen(fileName)
+		if self.profile == "structure":
+			self.fileName, data = utils.fileMap(fileName)
+		else:
+			self.fileName, data = utils.fileOpen(fileName)
 		self.decode(data)
 
 	def decode(self, data: bytes, index: int = 0) -> int:
@@ -163,6 +204,8 @@ class GimpDocument(GimpIOBase):
 			layer = GimpLayer(self)
 			layer.decode(ioBuf.data, ptr)
 			self._layers.append(layer)
+		# Index the groups now the item paths are known
+		self._layerTree = LayerTree(self._layers)
 		# Get the channels and add the pointers to them
 		self._channelPtr = []
 		self._channels = []
@@ -197,7 +240,10 @@ class GimpDocument(GimpIOBase):
 		# The file is a valid gimp xcf
 		ioBuf.addBytes("gimp xcf ")
 		# Set the file version
-		ioBuf.addBytes(f"v{self.version:03d}\0")
+		if self.version == 0:
+			ioBuf.addBytes("file\0")
+		else:
+			ioBuf.addBytes(f"v{self.version:03d}\0")
 		# Set other attributes as outlined in the spec
 		ioBuf.u32 = self.width
 		ioBuf.u32 = self.height
@@ -208,16 +254,20 @@ class GimpDocument(GimpIOBase):
 		self.precision.encode(self.version, ioBuf)
 		# List of properties
 		ioBuf.addBytes(self._propertiesEncode())
-		dataAreaIdx = ioBuf.index + self.pointerSize * (len(self.layers) + len(self._channels))
+		# Both pointer lists are nul terminated and followed by the data they point to
+		pointers = len(self.layers) + 1 + len(self._channels) + 1
+		dataAreaIdx = ioBuf.index + self.pointerSize // 8 * pointers
 		dataAreaIO = IO()
 		# Set the layers and add the pointers to them
 		for layer in self.layers:
-			ioBuf.index = dataAreaIdx + dataAreaIO.index
-			dataAreaIO.addBytes(layer.encode())
+			self._pointerEncode(dataAreaIdx + dataAreaIO.index, ioBuf)
+			dataAreaIO.addBytes(layer.encode(dataAreaIdx + dataAreaIO.index))
+		self._pointerEncode(0, ioBuf)
 		# Set the channels and add the pointers to them
 		for channel in self._channels:
-			ioBuf.index = dataAreaIdx + dataAreaIO.index
-			dataAreaIO.addBytes(channel.encode())
+			self._pointerEncode(dataAreaIdx + dataAreaIO.index, ioBuf)
+			dataAreaIO.addBytes(channel.encode(dataAreaIdx + dataAreaIO.index))
+		self._pointerEncode(0, ioBuf)
 		ioBuf.addBytes(dataAreaIO)
 		# Return the data
 		return ioBuf.data
@@ -239,21 +289,26 @@ class GimpDocument(GimpIOBase):
 
 		TODO: need to do the same thing with self.Channels
 		"""
-		if len(self._layers) == 0:
+		if len(self._layers) == 0 and self._data and self._layerPtr:
 			self._layers = []
 			for ptr in self._layerPtr:
 				layer = GimpLayer(self)
 				layer.decode(self._data, ptr)
 				self._layers.append(layer)
-			# add a reference back to this object so it doesn't go away while array is in use
-			self._layers.parent = self
-			# override some internal methods so we can do more with them
-			self._layers._actualDelitem_ = self._layers.__delitem__
-			self._layers.__delitem__ = self.deleteLayer
-			self._layers._actualSetitem_ = self._layers.__setitem__
-			self._layers.__setitem__ = self.setLayer
 		return self._layers
 
+	@property
+	def layerTree(self) -> LayerTree:
+		"""Get the index of how the layers are grouped, see `LayerTree`.
+
+		It is built when the document is decoded and again after layers are
+		added or replaced. Changing the item paths of layers already in the
+		document isn't noticed.
+		"""
+		if self._layerTree is None:
+			self._layerTree = LayerTree(self.layers)
+		return self._layerTree
+
 	def getLayer(self, index: int):
 		"""Return a given layer."""
 		return self.layers[index]
@@ -262,6 +317,7 @@ class GimpDocument(GimpIOBase):
 		"""Assign to a given layer."""
 		self.forceFullyLoaded()
 		self._layerPtr = None  # no longer try to use the pointers to get data
+		self._layerTree = None
 		self.layers._actualSetitem_(index, layer)
 
 	def newLayer(self, name: str, image: Image.Image, index: int = -1) -> GimpLayer:
@@ -276,7 +332,6 @@ class GimpDocument(GimpIOBase):
 			GimpLayer: newly created GimpLayer object
 		"""
 		layer = GimpLayer(self, name, image)
-		layer.imageHierarchy = GimpImageHierarchy(self, image=image)
 		self.insertLayer(layer, index)
 		return layer
 
@@ -293,6 +348,8 @@ class GimpDocument(GimpIOBase):
 		Returns:
 			GimpLayer: newly created GimpLayer object
 		"""
+		import PIL.ImageGrab
+
 		image = PIL.ImageGrab.grabclipboard()
 		if isinstance(image, Image.Image):
 			return self.newLayer(name, image, index)
@@ -319,6 +376,7 @@ class GimpDocument(GimpIOBase):
 		:param index: where to insert the new layer (default=top)
 		"""
 		self._layers.insert(index, layer)
+		self._layerTree = None
 
 	def deleteLayer(self, index: int) -> None:
 		"""Delete a layer."""
@@ -357,52 +415,43 @@ class GimpDocument(GimpIOBase):
 		self.appendLayer(amt)
 		return self
 
-	@property
-	def image(self):
-		"""Get a final, compiled image."""
-		# We need to preprocess the layers to sort them into a list of layers
-		# and groups. Where a group is a list of layers
-
-		# Example Layers [layer, layer, group, layer]
-		# Example Group [Layer(Group), [layer, layer, ...]]
-		layers = self.layers[:]  # Copy the attribute rather than write to it
-
-		layersOut = [None, []]  # Use None to create a dummy group for the entire hierarchy
-		for idx, layerOrGroup in enumerate(layers):
-			parent = layersOut
+	def composite(
+		self, ignoreHidden: bool = True, visibleLayers: Collection[GimpLayer] | None = None
+	) -> Image.Image:
+		"""Flatten the document into a single image.
 
-			# Find the parent list by walking down the itemPath values
-			if layerOrGroup.itemPath is not None:
-				for level_idx in layerOrGroup.itemPath[:-1]:
-					parent = parent[1][level_idx]
+		The layers are grouped by `layerTree` so nothing is copied, and nothing
+		is modified so several composites can run at the same time.
 
-			layerCopy = copy.deepcopy(layerOrGroup)
+		Args:
+			ignoreHidden (bool, optional): ignore layers that are hidden. Defaults
+			to True.
+			visibleLayers (Collection[GimpLayer], optional): the layers to treat
+			as visible instead of using their `visible` attribute. Defaults to None.
 
-			if layerOrGroup.isGroup:
-				parent[1].append([layerCopy, []])
-			else:
-				parent[1].append(layerCopy)
+		Returns:
+			PIL.Image: Flattened image
+		"""
+		return flattenAll(
+			self.layerTree.nested, (self.width, self.height), ignoreHidden, visibleLayers
+		)
 
-		return flattenAll(layersOut[1], (self.width, self.height))
+	@property
+	def image(self):
+		"""Get a final, compiled image."""
+		return self.composite()
 
 	def save(self, filename: str | BytesIO = None):
-		"""Save this gimp image to a file."""
-
-		# Save not yet implemented so for now throw
-		# an except so we don't corrupt the fole
-		raise NotImplementedError
+		"""Save this gimp image to a file.
 
-		# self.forceFullyLoaded()
-		# utils.save(self.encode(), filename or self.fileName)
+		The whole file is encoded before anything is written, so saving over
+		the file the document was loaded from is safe.
+		"""
+		utils.save(self.encode(), filename or self.fileName)
 
 	def saveNew(self, filename=None):
 		"""Save a new gimp image to a file."""
-
-		# Save not yet implemented so for now throw
-		# an except so we don't corrupt the fole
-		raise NotImplementedError
-
-		# utils.save(self.encode(), filename or self.fileName)
+		utils.save(self.encode(), filename or self.fileName)
 
 	def __repr__(self, indent="") -> str:
 		"""Get a textual representation of this object."""
@@ -426,36 +475,31 @@ class GimpDocument(GimpIOBase):
 		return "\n".join(ret)
 
 
-def blendModeLookup(
-	blendmode: int, blendLookup: dict[int, BlendType], default: BlendType = BlendType.NORMAL
-):
-	"""Get the blendmode from a lookup table."""
-	if blendmode not in blendLookup:
-		print(f"WARNING {blendmode} is not currently supported!")
-		return default
-	return blendLookup[blendmode]
+def groupLayers(layers: list[GimpLayer]) -> list:
+	"""Arrange a flat list of layers into groups using their item paths.
 
+	A layer is added as is and a group as a list of the group layer and a list
+	of its children, which is the structure `flattenAll` expects. For example
+	[layer, [groupLayer, [layer, layer]], layer]
 
-def flattenLayerOrGroup(
-	layerOrGroup: list[GimpLayer] | GimpLayer,
-	imageDimensions: tuple[int, int],
-	flattenedSoFar: Image.Image | None = None,
-	ignoreHidden: bool = True,
-) -> Image.Image:
-	"""Flatten a layer or group on to an image of what has already been	flattened.
+	The layers are neither copied nor modified. The layers of a document are
+	already grouped by `GimpDocument.layerTree`, which is only built once.
 
 	Args:
-		layerOrGroup (Layer,Group): A layer or a group of layers
-		imageDimensions (tuple[int, int]): size of the image
-		flattenedSoFar (PIL.Image, optional): the image of what has already
-		been flattened. Defaults to None.
-		ignoreHidden (bool, optional): ignore layers that are hidden. Defaults
-		to True.
+		layers (list[GimpLayer]): layers in document order (top to bottom)
 
 	Returns:
-		PIL.Image: Flattened image
+		list: the top level layers and groups
 	"""
-	blendLookup = {
+	return LayerTree(layers).nested
+
+
+@cache
+def blendLookup() -> dict[int, BlendType]:
+	"""Get the blendmodes BlendType of each XCF layer mode."""
+	from blendmodes.blend import BlendType
+
+	return {
 		0: BlendType.NORMAL,
 		3: BlendType.MULTIPLY,
 		4: BlendType.SCREEN,
@@ -504,113 +548,372 @@ def flattenLayerOrGroup(
 		49: BlendType.PINLIGHT,
 		52: BlendType.EXCLUSION,
 	}
-	log.debug('flattenLayerOrGroup()')
-	# Group
-	if isinstance(layerOrGroup, list):
-		log.debug('layerOrGroup is list')
-		if ignoreHidden and not layerOrGroup[0].visible:
-			foregroundComposite = Image.new("RGBA", imageDimensions)
-		else:  # A group is a list of layers
-			# (see flattenAll)
-			foregroundComposite = renderWOffset(
-				flattenAll(layerOrGroup[1], imageDimensions, ignoreHidden),
-				imageDimensions,
-			)
 
-			if layerOrGroup[0].mask is not None:
-				newFGComp = Image.new("RGBA", imageDimensions)
-				newFGComp.paste(
-					foregroundComposite,
-					None,
-					renderMaskWOffset(
-						layerOrGroup[0].mask.image,
-						imageDimensions,
-						(layerOrGroup[0].xOffset, layerOrGroup[0].yOffset),
-					),
-				)
-				foregroundComposite = newFGComp.convert("RGBA")
-
-		if flattenedSoFar is None:
-			log.debug('flattenedSoFar is None')
-			return foregroundComposite
-
-		return blendLayers(
-			flattenedSoFar,
-			foregroundComposite,
-			blendModeLookup(layerOrGroup[0].blendMode, blendLookup),
-			layerOrGroup[0].opacity,
-		)
 
-	# Layer
-	if ignoreHidden and not layerOrGroup.visible:
-		foregroundComposite = Image.new("RGBA", imageDimensions)
+def blendModeLookup(
+	blendmode: int, blendLookup: dict[int, BlendType], default: BlendType | None = None
+):
+	"""Get the blendmode from a lookup table."""
+	if default is None:
+		from blendmodes.blend import BlendType
+
+		default = BlendType.NORMAL
+	if blendmode not in blendLookup:
+		print(f"WARNING {blendmode} is not currently supported!")
+		return default
+	return blendLookup[blendmode]
+
+
+def isHighPrecision(layer: GimpLayer) -> bool:
+	"""Does the layer belong to a document that isn't 8-bit gamma integer."""
+	precision = layer.doc.precision
+	return precision is not None and not precision.isUint8
+
+
+def toRGBA(pixels, opaque=255):
+	"""Expand (height, width[, channels]) L, LA, RGB or RGBA pixels to RGBA."""
+	import numpy as np
+
+	pixels = pixels.reshape(pixels.shape[0], pixels.shape[1], -1)
+	channels = pixels.shape[2]
+	if channels == 4:
+		return pixels
+	rgba = np.empty(pixels.shape[:2] + (4,), dtype=pixels.dtype)
+	rgba[..., :3] = pixels[..., :3] if channels == 3 else pixels[..., :1]
+	rgba[..., 3] = pixels[..., 1] if channels == 2 else opaque
+	return rgba
+
+
+def layerTiles(layer: GimpLayer, imageDimensions: tuple[int, int]) -> TiledImage:
+	"""Get the tiles of the canvas a layer covers as premultiplied alpha RGBA, ready for compositing.
+
+	8-bit documents are composited as fixed-point uint16 arrays (see
+	`blendKernels.premultiply`). Every other precision is composited as float64
+	on a 0-255 scale. Either way nothing is lost until the final quantization
+	in `flattenAll`.
+
+	Layers placed on the tile grid are composited straight from their decoded
+	tiles, so constant tiles never take up more than a pixel.
+	"""
+	import numpy as np
+
+	offsets = (layer.xOffset, layer.yOffset)
+	level = layer.imageHierarchy.levels[0]
+	decodedTiles = level.decodedTiles
+	if isHighPrecision(layer):
+		precision, colourChannels = layer.doc.precision, level.colourChannels
+
+		def convert(pixels):
+			return blendKernels.premultiply(toRGBA(precision.toFloat(pixels, colourChannels), 255.0))
+
+		dtype = np.float64
 	else:
-		# Get a raster image and apply blending
-		foregroundComposite = renderWOffset(
-			layerOrGroup.image, imageDimensions, (layerOrGroup.xOffset, layerOrGroup.yOffset)
-		)
-		dbgimg(foregroundComposite, 'foregroundComposite1')
 
-		if layerOrGroup.mask is not None:
+		def convert(pixels):
+			return blendKernels.premultiply(toRGBA(pixels))
+
+		dtype = np.uint16
+
+	if decodedTiles is not None and offsets[0] % TILE_SIZE == 0 and offsets[1] % TILE_SIZE == 0:
+		return TiledImage.fromTiles(decodedTiles, level.width, imageDimensions, offsets, convert, dtype)
+	if dtype == np.uint16 and decodedTiles is None:
+		# the PIL image is the one to use once it exists, it may have been edited
+		pixels = np.asarray(layer.image)
+	else:
+		pixels = level.array
+	return TiledImage.fromPixels(pixels, imageDimensions, offsets, convert, dtype)
+
+
+def maskPixels(mask: GimpChannel, highPrecision: bool):
+	"""Get the pixels of a layer mask as a (height, width) array, see `layerTiles`."""
+	import numpy as np
+
+	if highPrecision:
+		return mask.doc.precision.toFloat(mask.array)[..., 0]
+	return np.asarray(mask.image)
+
+
+# XCF layer mode of groups drawn as if their layers weren't in a group
+PASS_THROUGH = 61
+
+
+def isVisible(layer: GimpLayer, visibleLayers: Collection[GimpLayer] | None = None) -> bool:
+	"""Is a layer visible, going by `visibleLayers` if they are given, see `flattenAll`."""
+	if visibleLayers is None:
+		return layer.visible
+	return layer in visibleLayers
+
+
+def visibilitySignature(
+	layers: list[GimpLayer],
+	ignoreHidden: bool = True,
+	visibleLayers: Collection[GimpLayer] | None = None,
+) -> tuple:
+	"""Get what a composite of layers and groups depends on for `composites`.
+
+	That is the layers and groups that are drawn, nested like `layers`: hidden
+	ones don't change the composite.
+
+	Args:
+		layers (list[GimpLayer]): A list of layers and groups
+		ignoreHidden (bool, optional): ignore layers that are hidden. Defaults
+		to True.
+		visibleLayers (Collection[GimpLayer], optional): the layers to treat as
+		visible instead of using their `visible` attribute. Defaults to None.
+
+	Returns:
+		tuple: the layers, and (group, signature of its children) of groups
+	"""
+	signature = []
+	for layerOrGroup in layers:
+		if isinstance(layerOrGroup, list):
+			layer, children = layerOrGroup
+		else:
+			layer, children = layerOrGroup, None
+		if ignoreHidden and not isVisible(layer, visibleLayers):
+			continue
+		if children is None:
+			signature.append(layer)
+		else:
+			signature.append((layer, visibilitySignature(children, ignoreHidden, visibleLayers)))
+	return tuple(signature)
+
+
+def drawsNormally(
+	layers: list[GimpLayer],
+	ignoreHidden: bool = True,
+	visibleLayers: Collection[GimpLayer] | None = None,
+) -> bool:
+	"""Are the drawn layers and groups all in normal mode, looking inside pass-through groups.
+
+	Compositing is associative for normal mode, so a pass-through group of
+	such layers can be flattened by itself and then drawn in normal mode.
+
+	Args:
+		layers (list[GimpLayer]): A list of layers and groups
+		ignoreHidden (bool, optional): ignore layers that are hidden. Defaults
+		to True.
+		visibleLayers (Collection[GimpLayer], optional): the layers to treat as
+		visible instead of using their `visible` attribute. Defaults to None.
+
+	Returns:
+		bool: True if every layer drawn is in normal mode
+	"""
+	for layerOrGroup in layers:
+		if isinstance(layerOrGroup, list):
+			layer, children = layerOrGroup
+		else:
+			layer, children = layerOrGroup, None
+		if ignoreHidden and not isVisible(layer, visibleLayers):
+			continue
+		if children is not None and layer.blendMode == PASS_THROUGH:
+			if not drawsNormally(children, ignoreHidden, visibleLayers):
+				return False
+		elif layer.blendMode not in blendKernels.NORMAL_MODES:
+			return False
+	return True
+
+
+def flattenLayerOrGroup(
+	layerOrGroup: list[GimpLayer] | GimpLayer,
+	imageDimensions: tuple[int, int],
+	flattenedSoFar: TiledImage | None = None,
+	ignoreHidden: bool = True,
+	visibleLayers: Collection[GimpLayer] | None = None,
+	composites: dict | None = None,
+) -> TiledImage:
+	"""Flatten a layer or group on to an image of what has already been	flattened.
+
+	Args:
+		layerOrGroup (Layer,Group): A layer or a group of layers
+		imageDimensions (tuple[int, int]): size of the image
+		flattenedSoFar (TiledImage, optional): the tiles of what has already
+		been flattened. Defaults to None.
+		ignoreHidden (bool, optional): ignore layers that are hidden. Defaults
+		to True.
+		visibleLayers (Collection[GimpLayer], optional): the layers to treat as
+		visible instead of using their `visible` attribute. Defaults to None.
+		composites (dict, optional): cache of group composites to use and add
+		to, see `flattenAll`. Defaults to None.
+
+	Returns:
+		TiledImage: Flattened premultiplied alpha RGBA tiles, see `layerTiles`
+	"""
+	# numpy is slow to import, so only import it once we actually composite
+	import numpy as np
+
+	log.debug('flattenLayerOrGroup()')
+	if isinstance(layerOrGroup, list):  # A group is a list of layers (see flattenAll)
+		layer, children = layerOrGroup
+	else:
+		layer, children = layerOrGroup, None
+	highPrecision = isHighPrecision(layer)
+
+	if ignoreHidden and not isVisible(layer, visibleLayers):
+		# Hidden layers don't change what has been flattened so far
+		if flattenedSoFar is not None:
+			return flattenedSoFar
+		return TiledImage(imageDimensions, np.float64 if highPrecision else np.uint16)
+
+	blendmode = layer.blendMode
+	if children is not None and blendmode == PASS_THROUGH:
+		if not drawsNormally(children, ignoreHidden, visibleLayers):
+			# Draw the layers straight on to what is below, the group's own
+			# opacity and mask aren't supported
+			return flattenAllTiles(
+				children, imageDimensions, ignoreHidden, visibleLayers, composites, flattenedSoFar
+			)
+		# Otherwise that is the same as drawing the group in normal mode
+		blendmode = 28
+
+	key = None
+	if children is not None and composites is not None:
+		key = (layer, imageDimensions, visibilitySignature(children, ignoreHidden, visibleLayers))
+	if key is not None and key in composites:
+		foregroundComposite = composites[key]
+	else:
+		if children is None:
+			foregroundComposite = layerTiles(layer, imageDimensions)
+		else:
+			# A group is flattened by itself, from nothing, like in GIMP
+			foregroundComposite = flattenAllTiles(
+				children,
+				imageDimensions,
+				ignoreHidden,
+				visibleLayers,
+				composites,
+				TiledImage(imageDimensions, np.float64 if highPrecision else np.uint16),
+			)
+
+		if layer.mask is not None:
 			log.debug('layerOrGroup.mask is not None')
-			newFGComp = Image.new("RGBA", imageDimensions)
-			newFGComp.paste(
-				foregroundComposite,
-				None,
-				renderMaskWOffset(
-					layerOrGroup.mask.image,
-					imageDimensions,
-					(layerOrGroup.xOffset, layerOrGroup.yOffset),
-				),
+			foregroundComposite = foregroundComposite.multiply(
+				maskPixels(layer.mask, highPrecision), (layer.xOffset, layer.yOffset)
 			)
-			foregroundComposite = newFGComp.convert("RGBA")
-	dbgimg(foregroundComposite, 'foregroundComposite2')
+
+		if key is not None:
+			composites[key] = foregroundComposite
+
 	if flattenedSoFar is None:
 		return foregroundComposite
 
-	# return blendLayers(
-	# 	flattenedSoFar,
-	# 	foregroundComposite,
-	# 	blendModeLookup(layerOrGroup.blendMode, blendLookup),
-	# 	layerOrGroup.opacity,
-	# )
-	log.debug(f'layerOrGroup.opacity == {layerOrGroup.opacity}')
-	blended = blendLayers(
-		flattenedSoFar,
-		foregroundComposite,
-		blendModeLookup(layerOrGroup.blendMode, blendLookup),
-		layerOrGroup.opacity,
-	)
-	dbgimg(blended, 'blended')
-	return blended
+	log.debug(f'layerOrGroup.opacity == {layer.opacity}')
+	if not blendKernels.hasKernel(blendmode):
+		blendmode = blendModeLookup(blendmode, blendLookup())
+	return flattenedSoFar.blend(foregroundComposite, blendmode, layer.opacity)
 
 
 def flattenAll(
-	layers: list[GimpLayer], imageDimensions: tuple[int, int], ignoreHidden: bool = True
+	layers: list[GimpLayer],
+	imageDimensions: tuple[int, int],
+	ignoreHidden: bool = True,
+	visibleLayers: Collection[GimpLayer] | None = None,
+	composites: dict | None = None,
 ) -> Image.Image:
 	"""Flatten a list of layers and groups.
 
 	Note the bottom layer is at the end of the list
 
+	Groups in pass-through mode are drawn as if their layers weren't in a
+	group. When the layers drawn in one are all in normal mode that is the
+	same as flattening the group by itself (see `drawsNormally`), which is
+	what lets its composite be reused.
+
+	The composites of groups, and of the whole list, can be kept in a dict
+	given as `composites`. They are keyed by the group and which layers in
+	it are visible (see `visibilitySignature`), so later calls with other
+	visible layers reuse every group whose visible layers are the same. Only
+	share a dict while the layers themselves don't change.
+
 	Args:
 		layers (list[GimpLayer]): A list of layers and groups
 		imageDimensions (tuple[int, int]): size of the image been flattened. Defaults to None.
 		ignoreHidden (bool, optional): ignore layers that are hidden. Defaults
 		to True.
+		visibleLayers (Collection[GimpLayer], optional): the layers to treat as
+		visible instead of using their `visible` attribute. Defaults to None.
+		composites (dict, optional): cache of composites to use and add to.
+		Defaults to None.
 
 	Returns:
 		PIL.Image: Flattened image
 	"""
+	import numpy as np
+
+	def toStraightUint8(tile):
+		# Compositing is done in premultiplied alpha, images are straight alpha
+		tile = blendKernels.unpremultiply(tile)
+		if tile.dtype != np.uint8:
+			# Like 8-bit documents, float pixels are only quantized once everything is composited
+			tile = np.around(np.clip(tile, 0.0, 255.0)).astype(np.uint8)
+		return tile
+
+	if composites is None:
+		tiles = flattenAllTiles(layers, imageDimensions, ignoreHidden, visibleLayers)
+	else:
+		# the list is cached like a group, None standing in for the group layer
+		key = (None, imageDimensions, visibilitySignature(layers, ignoreHidden, visibleLayers))
+		tiles = composites.get(key)
+		if tiles is None:
+			tiles = flattenAllTiles(layers, imageDimensions, ignoreHidden, visibleLayers, composites)
+			composites[key] = tiles
+	return Image.fromarray(tiles.toArray(toStraightUint8, np.uint8), "RGBA")
+
+
+def flattenAllTiles(
+	layers: list[GimpLayer],
+	imageDimensions: tuple[int, int],
+	ignoreHidden: bool = True,
+	visibleLayers: Collection[GimpLayer] | None = None,
+	composites: dict | None = None,
+	flattenedSoFar: TiledImage | None = None,
+) -> TiledImage:
+	"""Flatten a list of layers and groups into tiles of RGBA pixels.
+
+	Unlike `flattenAll` the result is premultiplied alpha and isn't
+	quantized, see `layerTiles`. Only the tiles some layer covers are stored.
+
+	Args:
+		layers (list[GimpLayer]): A list of layers and groups
+		imageDimensions (tuple[int, int]): size of the image been flattened.
+		ignoreHidden (bool, optional): ignore layers that are hidden. Defaults
+		to True.
+		visibleLayers (Collection[GimpLayer], optional): the layers to treat as
+		visible instead of using their `visible` attribute. Defaults to None.
+		composites (dict, optional): cache of group composites to use and add
+		to, see `flattenAll`. Defaults to None.
+		flattenedSoFar (TiledImage, optional): the tiles to flatten the layers
+		on to. Defaults to None, which starts from the bottom layer as it is.
+
+	Returns:
+		TiledImage: Flattened premultiplied alpha RGBA tiles
+	"""
+	import numpy as np
+
 	log.debug('flattenAll()')
 	log.debug(str([getattr(l, 'name', 'group') for l in layers]))
+	if len(layers) == 0:
+		if flattenedSoFar is not None:
+			return flattenedSoFar
+		return TiledImage(imageDimensions, np.uint16)
 	end = len(layers) - 1
-	flattenedSoFar = flattenLayerOrGroup(layers[end], imageDimensions, ignoreHidden=ignoreHidden)
-	dbgimg(flattenedSoFar, 'flattenedSoFar')
+	flattenedSoFar = flattenLayerOrGroup(
+		layers[end],
+		imageDimensions,
+		flattenedSoFar=flattenedSoFar,
+		ignoreHidden=ignoreHidden,
+		visibleLayers=visibleLayers,
+		composites=composites,
+	)
 	for layer in range(end - 1, -1, -1):
 		flattenedSoFar = flattenLayerOrGroup(
-			layers[layer], imageDimensions, flattenedSoFar=flattenedSoFar, ignoreHidden=ignoreHidden
+			layers[layer],
+			imageDimensions,
+			flattenedSoFar=flattenedSoFar,
+			ignoreHidden=ignoreHidden,
+			visibleLayers=visibleLayers,
+			composites=composites,
 		)
-	dbgimg(flattenedSoFar, 'flattenedSoFar')
 	return flattenedSoFar
 
 
@@ -640,25 +943,26 @@ def renderWOffset(
 
 
 def renderMaskWOffset(
-	image: Image.Image, size: tuple[int, int], offsets: tuple[int, int] = (0, 0)
-) -> Image.Image:
-	"""Render an image with offset and alpha to a given size.
+	image: Image.Image | np.ndarray, size: tuple[int, int], offsets: tuple[int, int] = (0, 0)
+) -> Image.Image | np.ndarray:
+	"""Render a single channel mask with offset to a given size.
+
+	The mask is sliced into place rather than pasted on a new canvas, and
+	anything it doesn't cover is 0.
 
 	Args:
-		image (Image.Image): pil image to draw
+		image (Image.Image | np.ndarray): mask to draw, a single channel pil
+		image or (height, width) array
 		size (tuple[int, int]): width, height as a tuple
-		alpha (float, optional): alpha transparency. Defaults to 1.0.
 		offsets (tuple[int, int], optional): x, y offsets as a tuple.
 		Defaults to (0, 0).
 
 	Returns:
-		Image.Image: new image
+		Image.Image | np.ndarray: new mask of the same kind as `image`, an
+		array may be a view of `image` if it already covers the canvas
 	"""
-	mode = image.mode
-	imageOffset = Image.new("RGBA", size)
-	imageOffset.paste(
-		image.convert("RGBA"),
-		offsets,
-		image.convert("RGBA"),
-	)
-	return imageOffset.convert(mode)
+	import numpy as np
+
+	if isinstance(image, np.ndarray):
+		return cropWOffset(image, (0, 0, *size), offsets)
+	return Image.fromarray(np.ascontiguousarray(cropWOffset(np.asarray(image), (0, 0, *size), offsets)), image.mode)
@@ -0,0 +1,129 @@
+"""An index of how the layers of a document are grouped.
+
+XCF stores layers as a flat list in document order (top to bottom) where each
+layer has an item path, the indices of the groups it is in followed by its own
+index in its group. LayerTree works out the groups once from the item paths
+and keeps the result in tuples and frozensets, so it can be shared by
+everything that needs to know about the groups without copying it and without
+anything changing it.
+"""
+from __future__ import annotations
+
+from types import MappingProxyType
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from .GimpLayer import GimpLayer
+
+
+class LayerTree:
+	"""The parent, children, names and group members of a list of layers.
+
+	Layers are referred to by their index in the list. Lookups by layer or
+	name are dictionary lookups.
+	"""
+
+	def __init__(self, layers: list[GimpLayer]):
+		"""Index a flat list of layers using their item paths.
+
+		Args:
+			layers (list[GimpLayer]): layers in document order (top to bottom),
+			which are neither copied nor modified
+		"""
+		self.layers: tuple[GimpLayer, ...] = tuple(layers)
+		# the index of the layer with each item path, to find parents with
+		byPath = {}
+		parents = []
+		children = [[] for _ in self.layers]
+		roots = []
+		names = {}
+		for index, layer in enumerate(self.layers):
+			path = tuple(layer.itemPath or ())
+			byPath[path] = index
+			parent = byPath.get(path[:-1]) if len(path) > 1 else None
+			parents.append(parent)
+			(roots if parent is None else children[parent]).append(index)
+			names.setdefault(layer.name, []).append(index)
+
+		self.parents: tuple[int | None, ...] = tuple(parents)
+		self.children: tuple[tuple[int, ...], ...] = tuple(tuple(indices) for indices in children)
+		self.roots: tuple[int, ...] = tuple(roots)
+		self.groups: tuple[int, ...] = tuple(
+			index for index, layer in enumerate(self.layers) if layer.isGroup
+		)
+		self._indices = MappingProxyType({layer: index for index, layer in enumerate(self.layers)})
+		self._names = MappingProxyType({name: tuple(indices) for name, indices in names.items()})
+
+		# every layer and group inside each group, children before parents so
+		# nested groups are ready when their parent is done
+		members = {}
+		for group in reversed(self.groups):
+			groupMembers = set(self.children[group])
+			for child in self.children[group]:
+				groupMembers |= members.get(child, frozenset())
+			members[group] = frozenset(groupMembers)
+		self._members = MappingProxyType(members)
+
+		self._nested = None
+
+	def index(self, layer: GimpLayer) -> int:
+		"""Get the index of a layer, raising KeyError if it isn't in the tree."""
+		return self._indices[layer]
+
+	def __contains__(self, layer: GimpLayer) -> bool:
+		return layer in self._indices
+
+	def __len__(self) -> int:
+		return len(self.layers)
+
+	def parent(self, layer: GimpLayer) -> GimpLayer | None:
+		"""Get the group a layer is in, None at the top level."""
+		parent = self.parents[self._indices[layer]]
+		return None if parent is None else self.layers[parent]
+
+	def childLayers(self, group: GimpLayer) -> tuple[GimpLayer, ...]:
+		"""Get the layers and groups directly in a group, top to bottom."""
+		return tuple(self.layers[index] for index in self.children[self._indices[group]])
+
+	def layer(self, name: str) -> GimpLayer | None:
+		"""Get the first (top most) layer called `name`, or None."""
+		indices = self._names.get(name)
+		return None if indices is None else self.layers[indices[0]]
+
+	def layersNamed(self, name: str) -> tuple[GimpLayer, ...]:
+		"""Get every layer called `name`, top to bottom."""
+		return tuple(self.layers[index] for index in self._names.get(name, ()))
+
+	def members(self, group: GimpLayer | int) -> frozenset[int]:
+		"""Get the indices of every layer and group inside a group, however deeply nested.
+
+		Args:
+			group (GimpLayer | int): the group or its index
+
+		Returns:
+			frozenset[int]: the indices, empty if `group` isn't a group
+		"""
+		if not isinstance(group, int):
+			group = self._indices[group]
+		return self._members.get(group, frozenset())
+
+	@property
+	def nested(self) -> list:
+		"""Get the layers as nested lists, the structure `flattenAll` expects.
+
+		A layer is added as is and a group as a list of the group layer and a
+		list of its children, for example [layer, [groupLayer, [layer, layer]], layer].
+		It is only built once and shared, so it must not be modified.
+		"""
+		if self._nested is None:
+
+			def nest(indices):
+				return [
+					[self.layers[index], nest(self.children[index])]
+					if self.layers[index].isGroup
+					else self.layers[index]
+					for index in indices
+				]
+
+			self._nested = nest(self.roots)
+		return self._nested
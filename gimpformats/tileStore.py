@@ -0,0 +1,79 @@
+"""Content addressed storage for decoded tiles.
+
+Documents often repeat the same content, like a background shared by several
+files or a layer copied within one. A TileStore given to `GimpDocument` keeps
+one buffer for each distinct decoded tile: every tile is hashed as it is
+decoded and a tile that is already in the store is replaced by the stored one.
+The store can be shared by any number of documents.
+
+Stored tiles are read-only since they may be in use by several layers. The
+store only holds weak references to them, so a tile is dropped from it once
+no document uses it any more.
+"""
+from __future__ import annotations
+
+import hashlib
+import threading
+import weakref
+from typing import TYPE_CHECKING
+
+from . import utils
+
+if TYPE_CHECKING:
+	import numpy as np
+
+
+class TileStore:
+	"""Deduplicates tile arrays by their content."""
+
+	def __init__(self):
+		self._tiles: weakref.WeakValueDictionary[tuple, np.ndarray] = weakref.WeakValueDictionary()
+		self._lock = threading.Lock()
+		# number of tiles given to `intern`, how many were already stored, and
+		# the bytes of every tile stored or deduplicated so far
+		self.lookups = 0
+		self.duplicates = 0
+		self.bytesStored = 0
+		self.bytesDeduplicated = 0
+
+	def intern(self, tile: np.ndarray) -> np.ndarray:
+		"""Get the stored tile with the same content as `tile`, storing it if there isn't one.
+
+		Constant tiles (see `utils.constantArray`) only hold one pixel so they
+		are returned as they are.
+
+		Args:
+			tile (np.ndarray): a decoded tile
+
+		Returns:
+			np.ndarray: a read-only tile equal to `tile`
+		"""
+		import numpy as np
+
+		if utils.isConstantArray(tile):
+			return tile
+		tile = np.ascontiguousarray(tile)
+		key = (tile.dtype.str, tile.shape, hashlib.blake2b(tile, digest_size=16).digest())
+		with self._lock:
+			self.lookups += 1
+			stored = self._tiles.get(key)
+			if stored is not None and np.array_equal(stored, tile):
+				self.duplicates += 1
+				self.bytesDeduplicated += tile.nbytes
+				return stored
+			if stored is None:
+				tile.flags.writeable = False
+				self._tiles[key] = tile
+				self.bytesStored += tile.nbytes
+		return tile
+
+	def __len__(self) -> int:
+		"""Get the number of distinct tiles stored that are still in use."""
+		return len(self._tiles)
+
+	def __repr__(self) -> str:
+		return (
+			f"TileStore: {len(self)} tiles, {self.bytesStored / 1e6:.1f}MB stored,"
+			f" {self.duplicates} of {self.lookups} tiles were duplicates"
+			f" ({self.bytesDeduplicated / 1e6:.1f}MB deduplicated)"
+		)
@@ -0,0 +1,282 @@
+"""Sparse tiled images for compositing layers that only cover part of the canvas.
+
+The canvas is split into TILE_SIZE square tiles on the same grid XCF uses for
+its tiles. Only tiles with something in them are stored, and each stored tile
+is flagged as opaque or partially transparent, so compositing can skip empty
+tiles and copy opaque ones. Memory is proportional to the tiles a layer covers
+rather than the size of the canvas.
+
+Tiles hold premultiplied alpha RGBA pixels, see `blendKernels.premultiply`.
+"""
+from __future__ import annotations
+
+from collections.abc import Callable, Iterator
+from typing import TYPE_CHECKING
+
+from . import blendKernels, utils
+
+if TYPE_CHECKING:
+	import numpy as np
+	from blendmodes.blend import BlendType
+
+
+# Width and height of a tile, the same as XCF
+TILE_SIZE = 64
+
+# Coverage of a tile
+EMPTY = 0
+OPAQUE = 1
+PARTIAL = 2
+
+
+def cropWOffset(
+	pixels: np.ndarray,
+	bounds: tuple[int, int, int, int],
+	offsets: tuple[int, int] = (0, 0),
+	convert: Callable[[np.ndarray], np.ndarray] | None = None,
+) -> np.ndarray:
+	"""Get part of the canvas with pixels drawn on it at an offset.
+
+	Anything not covered by the pixels is zero.
+
+	Args:
+		pixels (np.ndarray): (height, width[, channels]) array to draw
+		bounds (tuple[int, int, int, int]): left, top, right, bottom of the
+		part of the canvas to get
+		offsets (tuple[int, int], optional): x, y offsets of the pixels on the
+		canvas. Defaults to (0, 0).
+		convert (Callable, optional): applied to the covered pixels before they
+		are padded, e.g. to add an alpha channel. Defaults to None.
+
+	Returns:
+		np.ndarray: the pixels in bounds, a view of `pixels` where possible
+	"""
+	import numpy as np
+
+	left, top, right, bottom = bounds
+	x, y = offsets
+	coveredLeft, coveredTop = max(left, x), max(top, y)
+	coveredRight = max(min(right, x + pixels.shape[1]), coveredLeft)
+	coveredBottom = max(min(bottom, y + pixels.shape[0]), coveredTop)
+	covered = pixels[coveredTop - y : coveredBottom - y, coveredLeft - x : coveredRight - x]
+	if convert is not None:
+		covered = convert(covered)
+	if (coveredLeft, coveredTop, coveredRight, coveredBottom) == bounds:
+		return covered
+	part = np.zeros((bottom - top, right - left) + covered.shape[2:], dtype=covered.dtype)
+	part[coveredTop - top : coveredBottom - top, coveredLeft - left : coveredRight - left] = covered
+	return part
+
+
+def perPixel(function: Callable[..., np.ndarray], *tiles, **kwargs) -> np.ndarray:
+	"""Call `function(*tiles, **kwargs)` on the one pixel of constant tiles.
+
+	Arguments that aren't arrays are passed through. If any tile isn't
+	constant (see `utils.constantArray`) the function is called as normal.
+	"""
+	import numpy as np
+
+	arrays = [tile for tile in tiles if isinstance(tile, np.ndarray)]
+	if not all(utils.isConstantArray(tile) for tile in arrays):
+		return function(*tiles, **kwargs)
+	pixel = function(*(tile[:1, :1] if isinstance(tile, np.ndarray) else tile for tile in tiles), **kwargs)
+	return utils.constantArray(pixel, arrays[0].shape[:2] + pixel.shape[2:])
+
+
+class TiledImage:
+	"""Premultiplied RGBA pixels stored as the non-empty TILE_SIZE tiles of a canvas."""
+
+	def __init__(self, size: tuple[int, int], dtype):
+		"""Create a fully transparent image.
+
+		Args:
+			size (tuple[int, int]): width, height of the canvas
+			dtype: dtype of the pixels, uint16 or float64 (see `blendKernels.premultiply`)
+		"""
+		import numpy as np
+
+		self.width, self.height = size
+		self.dtype = np.dtype(dtype)
+		self.maxAlpha = blendKernels.MAX_ALPHA if self.dtype == np.uint16 else 255.0
+		self.tiles: dict[tuple[int, int], np.ndarray] = {}
+		self.opaque: set[tuple[int, int]] = set()
+
+	@classmethod
+	def fromPixels(
+		cls,
+		pixels: np.ndarray,
+		size: tuple[int, int],
+		offsets: tuple[int, int],
+		convert: Callable[[np.ndarray], np.ndarray],
+		dtype,
+	) -> TiledImage:
+		"""Split pixels drawn on a canvas at an offset into tiles.
+
+		Only the tiles the pixels overlap are converted, one at a time.
+
+		Args:
+			pixels (np.ndarray): (height, width[, channels]) array to draw
+			size (tuple[int, int]): width, height of the canvas
+			offsets (tuple[int, int]): x, y offsets of the pixels on the canvas
+			convert (Callable): converts part of the pixels to premultiplied RGBA
+			dtype: dtype `convert` gives
+
+		Returns:
+			TiledImage: the tiles the pixels cover
+		"""
+		image = cls(size, dtype)
+		x, y = offsets
+		for index in image.tileIndices((x, y, x + pixels.shape[1], y + pixels.shape[0])):
+			image[index] = cropWOffset(pixels, image.tileBounds(index), offsets, convert)
+		return image
+
+	@classmethod
+	def fromTiles(
+		cls,
+		tiles: list[np.ndarray],
+		layerWidth: int,
+		size: tuple[int, int],
+		offsets: tuple[int, int],
+		convert: Callable[[np.ndarray], np.ndarray],
+		dtype,
+	) -> TiledImage:
+		"""Place the XCF tiles of a layer on a canvas, see `fromPixels`.
+
+		The offsets must be multiples of TILE_SIZE so the tiles of the layer
+		line up with the tiles of the canvas. Constant tiles (see
+		`utils.constantArray`) are converted as a single pixel and stay
+		constant.
+
+		Args:
+			tiles (list[np.ndarray]): the tiles of the layer in XCF order, left
+			to right then top to bottom
+			layerWidth (int): width of the layer
+			size (tuple[int, int]): width, height of the canvas
+			offsets (tuple[int, int]): x, y offsets of the layer on the canvas
+			convert (Callable): converts part of a tile to premultiplied RGBA
+			dtype: dtype `convert` gives
+
+		Returns:
+			TiledImage: the tiles the layer covers
+		"""
+		image = cls(size, dtype)
+		x, y = offsets
+		left = top = 0
+		for tile in tiles:
+			height, width = tile.shape[:2]
+			origin = (x + left, y + top)
+			for index in image.tileIndices((origin[0], origin[1], origin[0] + width, origin[1] + height)):
+				bounds = image.tileBounds(index)
+				if utils.isConstantArray(tile) and bounds == (*origin, origin[0] + width, origin[1] + height):
+					pixel = convert(tile[:1, :1])
+					image[index] = utils.constantArray(pixel, (height, width, pixel.shape[2]))
+				else:
+					image[index] = cropWOffset(tile, bounds, origin, convert)
+			left += width
+			if left >= layerWidth:
+				left, top = 0, top + height
+		return image
+
+	def tileBounds(self, index: tuple[int, int]) -> tuple[int, int, int, int]:
+		"""Get the left, top, right, bottom of a tile, tiles on the right and bottom edges may be smaller."""
+		column, row = index
+		left, top = column * TILE_SIZE, row * TILE_SIZE
+		return left, top, min(left + TILE_SIZE, self.width), min(top + TILE_SIZE, self.height)
+
+	def tileIndices(self, bounds: tuple[int, int, int, int] | None = None) -> Iterator[tuple[int, int]]:
+		"""Iterate over the column, row of every tile that overlaps bounds (DEFAULT: the whole canvas)."""
+		left, top, right, bottom = bounds or (0, 0, self.width, self.height)
+		left, top = max(left, 0), max(top, 0)
+		right, bottom = min(right, self.width), min(bottom, self.height)
+		for row in range(top // TILE_SIZE, (bottom + TILE_SIZE - 1) // TILE_SIZE if bottom > top else 0):
+			for column in range(left // TILE_SIZE, (right + TILE_SIZE - 1) // TILE_SIZE if right > left else 0):
+				yield column, row
+
+	def coverage(self, index: tuple[int, int]) -> int:
+		"""Is a tile EMPTY, OPAQUE or PARTIAL(ly transparent)."""
+		if index not in self.tiles:
+			return EMPTY
+		return OPAQUE if index in self.opaque else PARTIAL
+
+	def __setitem__(self, index: tuple[int, int], tile: np.ndarray):
+		"""Store a tile, finding its coverage. Empty tiles are dropped."""
+		alpha = tile[..., 3]
+		self.tiles.pop(index, None)
+		self.opaque.discard(index)
+		if alpha.max() == 0:
+			return
+		self.tiles[index] = tile
+		if alpha.min() == self.maxAlpha:
+			self.opaque.add(index)
+
+	def copy(self) -> TiledImage:
+		"""Get a copy that shares the (never modified) tile arrays."""
+		image = TiledImage((self.width, self.height), self.dtype)
+		image.tiles = dict(self.tiles)
+		image.opaque = set(self.opaque)
+		return image
+
+	def multiply(self, mask: np.ndarray, offsets: tuple[int, int] = (0, 0)) -> TiledImage:
+		"""Mask every tile by a mask drawn at an offset, see `blendKernels.multiply`.
+
+		Args:
+			mask (np.ndarray): (height, width) uint8 mask, or float on a 0-255
+			scale for float images. Anything outside of it is masked out.
+			offsets (tuple[int, int], optional): x, y offsets of the mask on the
+			canvas. Defaults to (0, 0).
+
+		Returns:
+			TiledImage: the masked tiles
+		"""
+		import numpy as np
+
+		image = TiledImage((self.width, self.height), self.dtype)
+		for index, tile in self.tiles.items():
+			tileMask = cropWOffset(mask, self.tileBounds(index), offsets)
+			if tileMask.min() == 255:
+				image.tiles[index] = tile
+				if index in self.opaque:
+					image.opaque.add(index)
+			elif tileMask.max() != 0:
+				image[index] = blendKernels.multiply(tile, tileMask[..., np.newaxis])
+		return image
+
+	def blend(self, foreground: TiledImage, blendmode: int | BlendType, opacity: float = 1.0) -> TiledImage:
+		"""Blend a foreground on to this image, see `blendKernels.blendLayers`.
+
+		Only the tiles of the foreground are blended: every mode composites
+		to the foreground itself over an empty tile, and normal mode to the
+		foreground itself where it is opaque.
+		"""
+		image = self.copy()
+		if opacity <= 0.0:
+			return image
+		normal = blendmode in blendKernels.NORMAL_MODES
+		for index, tile in foreground.tiles.items():
+			if opacity < 1.0:
+				tile = perPixel(blendKernels.applyOpacity, tile, opacity)
+			if index not in self.tiles or (normal and index in foreground.opaque and opacity >= 1.0):
+				image[index] = tile
+			else:
+				image[index] = perPixel(blendKernels.blendLayers, self.tiles[index], tile, blendmode)
+		return image
+
+	def toArray(self, convert: Callable[[np.ndarray], np.ndarray] | None = None, dtype=None) -> np.ndarray:
+		"""Get the (height, width, 4) pixels of the whole canvas.
+
+		Args:
+			convert (Callable, optional): applied to each tile, e.g. to convert it
+			to straight alpha. Defaults to None (premultiplied pixels).
+			dtype (optional): dtype `convert` gives. Defaults to None (the
+			dtype of the tiles).
+
+		Returns:
+			np.ndarray: pixels, zero where there are no tiles
+		"""
+		import numpy as np
+
+		pixels = np.zeros((self.height, self.width, 4), dtype=dtype or self.dtype)
+		for index, tile in self.tiles.items():
+			left, top, right, bottom = self.tileBounds(index)
+			pixels[top:bottom, left:right] = tile if convert is None else convert(tile)
+		return pixels
@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import mmap
 from io import BytesIO
 
+from binaryiotools import IO
+
 
 def fileOpen(fileName: BytesIO | str) -> tuple[str, bytes]:
 	if isinstance(fileName, str):
@@ -14,6 +17,20 @@ def fileOpen(fileName: BytesIO | str) -> tuple[str, bytes]:
 	return fileName, data
 
 
+def fileMap(fileName: BytesIO | str) -> tuple[str, bytes]:
+	"""Like `fileOpen` but memory map files so only the parts that are used are read.
+
+	File-like objects, and empty files which can't be mapped, are read as normal.
+	"""
+	if not isinstance(fileName, str):
+		return fileOpen(fileName)
+	with open(fileName, "rb") as file:
+		try:
+			return fileName, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			return fileName, file.read()
+
+
 def save(data: bytes, tofileName: BytesIO | str):
 	"""Save this gimp image to a file."""
 	if isinstance(tofileName, str):
@@ -22,3 +39,36 @@ def save(data: bytes, tofileName: BytesIO | str):
 		file = tofileName
 	file.write(data)
 	file.close()
+
+
+def sz754Encode(ioBuf: IO, string: str | bytes):
+	"""Write a string as xcf files store them.
+
+	That is the number of bytes including the nul terminator, the UTF-8 data and
+	the terminator, or simply 0 for an empty string. (binaryiotools does not
+	count the terminator.)
+	"""
+	if isinstance(string, str):
+		string = string.encode("utf-8")
+	if not string:
+		ioBuf.u32 = 0
+		return
+	ioBuf.u32 = len(string) + 1
+	ioBuf.addBytes(string)
+	ioBuf.u8 = 0
+
+
+def constantArray(pixel, shape: tuple[int, ...]):
+	"""Get a read-only array of `shape` where every pixel is `pixel`.
+
+	Only the one pixel is stored, see `isConstantArray`.
+	"""
+	import numpy as np
+
+	pixel = np.asarray(pixel)
+	return np.broadcast_to(pixel.reshape((1,) * (len(shape) - pixel.ndim) + pixel.shape), shape)
+
+
+def isConstantArray(array) -> bool:
+	"""Is a (height, width, ...) array a single pixel repeated, see `constantArray`."""
+	return array.ndim >= 2 and array.strides[0] == 0 and array.strides[1] == 0
@@ -0,0 +1,228 @@
+"""Write zip archives, like PK3 files, with the entries compressed on worker threads.
+
+zipfile compresses each entry in the thread writing the archive and can only
+copy an entry from another archive by decompressing and compressing it again.
+ArchiveWriter compresses entries on an executor, writes them to the archive as
+they finish, and when an existing archive is updated copies the entries that
+weren't replaced without decompressing them.
+
+The archive is written next to the existing one and swapped in once it is
+complete, so engines never see half an archive. Zip64 isn't supported, which
+limits archives to 4GB and 65535 entries.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import struct
+import time
+import zipfile
+import zlib
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Executor
+from pathlib import Path
+
+
+
+log = logging.getLogger(__name__)
+
+
+
+# signature, version needed, flags, method, time, date, crc, compressed size,
+# size, name length and extra field length
+LOCAL_HEADER = struct.Struct('<4sHHHHHLLLHH')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+# signature, version made by, then as the local header, then comment length,
+# disk, internal attributes, external attributes and offset of the local header
+CENTRAL_HEADER = struct.Struct('<4sHHHHHHLLLHHHHHLL')
+CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+
+# signature, disk, disk of the central directory, entries on this disk,
+# entries, size and offset of the central directory and comment length
+END_OF_CENTRAL_DIRECTORY = struct.Struct('<4sHHHHLLH')
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = b'PK\x05\x06'
+
+ZIP_VERSION = 20
+
+# the sizes follow the data rather than being in the local header
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+ZIP_LIMIT = 0xFFFFFFFF
+ENTRY_LIMIT = 0xFFFF
+
+
+
+def dos_date_time(date_time: tuple) -> tuple[int, int]:
+	year, month, day, hour, minute, second = date_time[:6]
+	return (
+		(year - 1980) << 9 | month << 5 | day,
+		hour << 11 | minute << 5 | second // 2,
+	)
+
+
+
+def read_entries(filepath: Path) -> dict[str, zipfile.ZipInfo]:
+	"""Get the entries of an existing archive by name, raising ValueError if it isn't a zip archive."""
+	try:
+		with zipfile.ZipFile(filepath) as archive:
+			return {info.filename: info for info in archive.infolist()}
+	except zipfile.BadZipFile as e:
+		raise ValueError(f"{filepath} isn't a zip archive that can be updated: {e}") from e
+
+
+
+def compress(data: bytes, compresslevel: int) -> tuple[int, int, bytes]:
+	"""Deflate data for an entry, or store it if that doesn't make it smaller.
+
+	Returns the zip compression method, the CRC of the data and what to write.
+	"""
+	crc = zlib.crc32(data)
+	compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+	compressed = compressor.compress(data) + compressor.flush()
+	if len(compressed) >= len(data):
+		return zipfile.ZIP_STORED, crc, data
+	return zipfile.ZIP_DEFLATED, crc, compressed
+
+
+
+class ArchiveWriter:
+	"""Write a new version of a zip archive, replacing some of its entries.
+
+	Entries are added with `submit` from one thread, while their data is made
+	and compressed on the executor. Entries of the existing archive that
+	aren't submitted are kept as they are. Nothing changes until `close`, and
+	the archive isn't written at all if nothing was submitted.
+	"""
+
+	def __init__(self, filepath: Path, executor: Executor, compresslevel: int = zlib.Z_DEFAULT_COMPRESSION):
+		self.filepath = filepath
+		self.executor = executor
+		self.compresslevel = compresslevel
+
+		self.existing: dict[str, zipfile.ZipInfo] = {}
+		if filepath.exists():
+			self.existing = read_entries(filepath)
+
+		self.replaced = set()
+		self.pending = deque()
+		# central directory headers of the entries written so far, by name
+		self.entries = {}
+
+		self.temporary_filepath = filepath.with_name(filepath.name + '.tmp')
+		self.file = None
+
+	def __contains__(self, name: str) -> bool:
+		return name in self.replaced or name in self.existing
+
+	def date_time(self, name: str) -> tuple:
+		"""Get the modification time of an entry of the existing archive, raising KeyError if there isn't one."""
+		return self.existing[name].date_time
+
+	def submit(self, name: str, make_data: Callable[[], bytes]):
+		"""Add an entry, replacing any entry with the same name.
+
+		`make_data` is called on the executor and its result compressed there.
+		"""
+		if self.file is None:
+			self.file = open(self.temporary_filepath, 'wb')
+
+		self.replaced.add(name)
+		date_time = time.localtime()[:6]
+		self.pending.append((name, date_time, self.executor.submit(self._make_entry, make_data)))
+		self._write_finished()
+
+	def _make_entry(self, make_data: Callable[[], bytes]) -> tuple[int, int, int, bytes]:
+		data = make_data()
+		method, crc, compressed = compress(data, self.compresslevel)
+		return method, crc, len(data), compressed
+
+	def _write_finished(self, wait: bool = False):
+		"""Write the entries that have been compressed, in the order they were submitted."""
+		while self.pending and (wait or self.pending[0][2].done()):
+			name, date_time, future = self.pending.popleft()
+			try:
+				method, crc, size, compressed = future.result()
+			except Exception:
+				# leave the entry out, rather than keep an old version of it
+				log.exception(f"Couldn't make {name}, leaving it out of {self.filepath}")
+				continue
+			self._write_entry(name, date_time, method, crc, size, compressed)
+
+	def _write_entry(self, name: str, date_time: tuple, method: int, crc: int, size: int, data: bytes, flags: int = 0):
+		encoded_name = name.encode('utf-8')
+		if not name.isascii():
+			flags |= FLAG_UTF8
+
+		offset = self.file.tell()
+		if offset > ZIP_LIMIT or len(data) > ZIP_LIMIT or size > ZIP_LIMIT:
+			raise ValueError(f"{self.filepath} would need Zip64, which isn't supported")
+
+		date, dos_time = dos_date_time(date_time)
+		self.file.write(LOCAL_HEADER.pack(
+			LOCAL_HEADER_SIGNATURE, ZIP_VERSION, flags, method, dos_time, date,
+			crc, len(data), size, len(encoded_name), 0,
+		))
+		self.file.write(encoded_name)
+		self.file.write(data)
+
+		self.entries[name] = CENTRAL_HEADER.pack(
+			CENTRAL_HEADER_SIGNATURE, ZIP_VERSION, ZIP_VERSION, flags, method, dos_time, date,
+			crc, len(data), size, len(encoded_name), 0, 0, 0, 0, 0, offset,
+		) + encoded_name
+
+	def _copy_existing(self):
+		"""Copy the entries of the existing archive that weren't replaced, as they are."""
+		kept = [info for name, info in self.existing.items() if name not in self.replaced]
+		if not kept:
+			return
+
+		with open(self.filepath, 'rb') as archive_file:
+			for info in kept:
+				archive_file.seek(info.header_offset)
+				header = LOCAL_HEADER.unpack(archive_file.read(LOCAL_HEADER.size))
+				if header[0] != LOCAL_HEADER_SIGNATURE:
+					raise zipfile.BadZipFile(f"Bad local header for {info.filename} in {self.filepath}")
+				# skip the name and extra field, which may differ from the central directory
+				archive_file.seek(header[-2] + header[-1], os.SEEK_CUR)
+				data = archive_file.read(info.compress_size)
+
+				self._write_entry(
+					info.filename,
+					info.date_time,
+					info.compress_type,
+					info.CRC,
+					info.file_size,
+					data,
+					info.flag_bits & ~(FLAG_DATA_DESCRIPTOR | FLAG_UTF8),
+				)
+
+	def close(self):
+		"""Finish writing the archive and replace the existing one with it."""
+		if self.file is None:
+			return
+
+		try:
+			self._write_finished(wait=True)
+			self._copy_existing()
+
+			if len(self.entries) > ENTRY_LIMIT:
+				raise ValueError(f"{self.filepath} would need Zip64, which isn't supported")
+
+			central_directory_offset = self.file.tell()
+			for central_header in self.entries.values():
+				self.file.write(central_header)
+			central_directory_size = self.file.tell() - central_directory_offset
+
+			self.file.write(END_OF_CENTRAL_DIRECTORY.pack(
+				END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0, 0, len(self.entries), len(self.entries),
+				central_directory_size, central_directory_offset, 0,
+			))
+			self.file.close()
+			os.replace(self.temporary_filepath, self.filepath)
+		except BaseException:
+			self.file.close()
+			self.temporary_filepath.unlink(missing_ok=True)
+			raise
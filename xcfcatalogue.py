@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Header-only catalogue of the XCF source documents.
+
+Only the headers of each document, its layers and their masks are read, never
+any tile data: documents are opened with the "structure" decode profile, which
+memory maps the file so only the pages holding the headers are read from
+disk. The catalogue records the size, precision and compression of each
+document and the name, size, offsets, group, mask, blend mode, opacity and
+visibility of each layer.
+
+The catalogue is kept as JSON in the source directory and refreshed
+incrementally: only documents whose modification time or size changed are
+scanned again. With it the texture definitions can be checked for missing
+documents and layer names without decoding anything.
+
+Example: python xcfcatalogue.py xcftotexture.yml --src src
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+import yaml
+
+from gimpformats.gimpXcfDocument import GimpDocument
+from gimpformats.GimpIOBase import GimpIOBase
+from xcftotexture import TEXTURE_VARIANTS, LogLevelMapperAction, ResolvePathAction
+
+
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+
+# Changing what is recorded for a document invalidates existing catalogues
+CATALOGUE_VERSION = 2
+
+CATALOGUE_FILENAME = '.xcfcatalogue.json'
+
+
+
+def mode_name(names: list[str], mode: int) -> str:
+	"""Get the name of a blend or compression mode, which may be newer than gimpformats."""
+	if 0 <= mode < len(names):
+		return names[mode]
+	return f"unknown ({mode})"
+
+
+
+def scan_document(filepath: Path) -> dict:
+	"""Read the headers of an XCF document into a catalogue entry."""
+	document = GimpDocument(str(filepath), profile='structure')
+
+	tree = document.layerTree
+	layers = []
+	for layer in document.layers:
+		parent = tree.parent(layer)
+		layers.append({
+			'name': layer.name,
+			'width': layer.width,
+			'height': layer.height,
+			'offsets': [layer.xOffset, layer.yOffset],
+			'group': None if parent is None else parent.name,
+			'is_group': bool(layer.isGroup),
+			'mask': layer.mask is not None,
+			'blend_mode': mode_name(GimpIOBase.BLEND_MODES, layer.blendMode),
+			'opacity': layer.opacity,
+			'visible': bool(layer.visible),
+		})
+
+	return {
+		'width': document.width,
+		'height': document.height,
+		'precision': str(document.precision),
+		'compression': mode_name(GimpIOBase.COMPRESSION_MODES, document.compression),
+		'layers': layers,
+	}
+
+
+
+class Catalogue:
+	def __init__(self, source_directory: Path, filepath: Path | None = None):
+		self.source_directory = source_directory
+		self.filepath = filepath or source_directory.joinpath(CATALOGUE_FILENAME)
+		self.documents = {}
+
+		try:
+			with open(self.filepath, 'r') as catalogue_file:
+				catalogue = json.load(catalogue_file)
+			if catalogue.get('version') == CATALOGUE_VERSION:
+				self.documents = catalogue['documents']
+		except FileNotFoundError:
+			pass
+		except ValueError:
+			log.warning(f"Ignoring unreadable catalogue {self.filepath}")
+
+	def refresh(self) -> bool:
+		"""Scan the documents that were added or changed since the last refresh.
+
+		Returns True if anything changed.
+		"""
+		changed = False
+		found = set()
+
+		with os.scandir(self.source_directory) as entries:
+			for entry in entries:
+				if not entry.name.endswith('.xcf') or not entry.is_file():
+					continue
+
+				name = entry.name[:-len('.xcf')]
+				found.add(name)
+				stat = entry.stat()
+				known = self.documents.get(name)
+				if known is not None and known['mtime_ns'] == stat.st_mtime_ns and known['size'] == stat.st_size:
+					continue
+
+				log.debug(f"Scanning {entry.path}")
+				try:
+					document = scan_document(Path(entry.path))
+				except Exception as e:
+					# Remember broken documents too so they aren't scanned every time
+					document = {'error': str(e)}
+
+				document['mtime_ns'] = stat.st_mtime_ns
+				document['size'] = stat.st_size
+				self.documents[name] = document
+				changed = True
+
+		for name in set(self.documents) - found:
+			del self.documents[name]
+			changed = True
+
+		return changed
+
+	def save(self):
+		# Write a new file and swap it in so a reader never sees half a catalogue
+		temporary_filepath = self.filepath.with_name(self.filepath.name + '.tmp')
+		with open(temporary_filepath, 'w') as catalogue_file:
+			json.dump({'version': CATALOGUE_VERSION, 'documents': self.documents}, catalogue_file)
+		os.replace(temporary_filepath, self.filepath)
+
+	def layer_names(self, name: str) -> set:
+		return {layer['name'] for layer in self.documents[name].get('layers', ())}
+
+
+
+def validate(definitions: dict, catalogue: Catalogue) -> list[str]:
+	"""List the problems with texture definitions: missing or unreadable documents and layers."""
+	problems = []
+
+	for texture_name, definition in definitions.items():
+		document_name = definition.get('src')
+		document = catalogue.documents.get(document_name)
+		if document is None:
+			problems.append(f"{texture_name}: no document {document_name!r}")
+			continue
+		if 'error' in document:
+			problems.append(f"{texture_name}: document {document_name!r} can't be read: {document['error']}")
+			continue
+
+		layer_names = catalogue.layer_names(document_name)
+		for variant_type in TEXTURE_VARIANTS:
+			variant_definition = definition.get(variant_type)
+			if variant_definition is None:
+				continue
+
+			if isinstance(variant_definition, str):
+				# matched like TextureVariant.visible_layers, any layer named after part of it
+				if not any(layer_name in variant_definition for layer_name in layer_names):
+					problems.append(f"{texture_name}: no {variant_type} layer in {variant_definition!r} in {document_name!r}")
+				continue
+
+			for layer_name in variant_definition:
+				if layer_name not in layer_names:
+					problems.append(f"{texture_name}: no {variant_type} layer {layer_name!r} in {document_name!r}")
+
+	return problems
+
+
+
+def format_document(name: str, document: dict) -> str:
+	if 'error' in document:
+		return f"{name}: {document['error']}"
+
+	lines = [f"{name}: {document['width']}x{document['height']} {document['precision']}, {document['compression']} compression"]
+	for layer in document['layers']:
+		flags = ', '.join(
+			flag
+			for flag, present
+			in (('group', layer['is_group']), ('mask', layer['mask']), ('hidden', not layer['visible']))
+			if present
+		)
+		lines.append(
+			f"\t{layer['name']!r} {layer['width']}x{layer['height']}"
+			f" at {layer['offsets'][0]},{layer['offsets'][1]}"
+			f" {layer['blend_mode']} {layer['opacity']:.0%}"
+			+ (f" in {layer['group']!r}" if layer['group'] is not None else "")
+			+ (f" ({flags})" if flags else "")
+		)
+	return '\n'.join(lines)
+
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(
+		description="Catalogue the layers of the XCF sources from their headers and check texture definitions against it.",
+	)
+	parser.add_argument(
+		"infile",
+		nargs="?",
+		type=Path,
+		help="Texture definition YAML file to check"
+	)
+	parser.add_argument(
+		"-s",
+		"--src",
+		default="src",
+		type=Path,
+		action=ResolvePathAction,
+		help="Directory containing the XCF source images (DEFAULT: src)"
+	)
+	parser.add_argument(
+		"-c",
+		"--catalogue",
+		default=None,
+		type=Path,
+		action=ResolvePathAction,
+		help=f"Catalogue file (DEFAULT: {CATALOGUE_FILENAME} in the source directory)"
+	)
+	parser.add_argument(
+		"--show",
+		default=[],
+		action="append",
+		help="Print the layers of a document, may be given more than once"
+	)
+	parser.add_argument(
+		"-l",
+		"--log-level",
+		default=logging.INFO,
+		action=LogLevelMapperAction,
+		help="Log level"
+	)
+	args = parser.parse_args()
+
+	log.setLevel(args.log_level)
+
+	catalogue = Catalogue(args.src, args.catalogue)
+	if catalogue.refresh():
+		catalogue.save()
+
+	for name in args.show:
+		if name in catalogue.documents:
+			print(format_document(name, catalogue.documents[name]))
+		else:
+			print(f"{name}: no such document")
+
+	if args.infile is not None:
+		with open(args.infile, 'r') as yaml_file:
+			texture_defs = yaml.load(yaml_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+		problems = validate(texture_defs, catalogue)
+		for problem in problems:
+			print(problem)
+
+		sys.exit(1 if problems else 0)
@@ -1,19 +1,29 @@
+from __future__ import annotations
+
+import copy
+import fnmatch
+import functools
+import hashlib
+import io
+import json
 import os
-import shutil
+import threading
+import time
 from argparse import ArgumentParser, Action, RawDescriptionHelpFormatter
 from pathlib import Path
 import logging
 import tracemalloc
 from typing import Union, TextIO, IO
-from copy import copy
+from collections import Counter, defaultdict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 
 import yaml
 from PIL import Image, ImageChops, ImageFilter, ImageOps
-from gimpformats.gimpXcfDocument import GimpDocument, flattenAll
+from gimpformats.gimpXcfDocument import PASS_THROUGH, GimpDocument, flattenAll
 from gimpformats.GimpLayer import GimpLayer
-
-import numpy as np
-import cv2
+from gimpformats.layerTree import LayerTree
+from gimpformats.tiledImage import cropWOffset
+from gimpformats.tileStore import TileStore
 
 
 
@@ -24,38 +34,65 @@ log.setLevel(logging.INFO)
 
 
 class Document(GimpDocument):
-	def __init__(self, filename):
+	def __init__(self, filename, tile_store: TileStore | None = None):
 		self.stat = os.stat(filename)
 
-		# gimpformats requires an explicit string otherwise it falls back to BytesIO
-		super().__init__(str(filename))
-
-		self.layer_tree = self.get_layers_as_tree()
-		apply_masks(self.layer_tree)
-
-	def get_layers_as_tree(self):
-		layer_tree = {
-			'children': [],
-		}
-		for idx, layer in enumerate(self.layers):
-			parent = layer_tree
-
-			if layer.itemPath:
-				layer.itemPath.pop()
-
-				parent = layer_tree
-				for level_idx in layer.itemPath:
-					parent = parent['children'][level_idx]
-
-			if layer.isGroup:
-				parent['children'].append({
-					'layer': layer,
-					'children': [],
-				})
-			else:
-				parent['children'].append(layer)
-
-		return layer_tree
+		# gimpformats requires an explicit string otherwise it falls back to BytesIO,
+		# and textures only need the pixels, not metadata like parasites
+		super().__init__(str(filename), profile='pixels', tileStore=tile_store)
+
+		self.layer_tree = self.layerTree.nested
+		self.group_masks = group_masks(self.layer_tree)
+		self._masked_layers = None
+		self._masked_layer_tree = None
+		self._pass_through_groups = {}
+		self._layer_hashes = None
+
+		# composites of groups and whole variants, shared by every texture of
+		# the document as the layers never change once masks are baked, until
+		# TextureBuilder has built them all
+		self.composites = {}
+
+	@property
+	def masked_layers(self) -> list:
+		"""The layers with their masks, and those of the groups they are in, baked in.
+
+		The masks are baked once, the first time this is used. Layers without
+		a mask are the decoded originals and the others copies of them, so the
+		originals are never modified.
+		"""
+		if self._masked_layers is None:
+			baked = bake_masks(self.layer_tree, self.group_masks)
+			self._masked_layers = [baked.get(layer, layer) for layer in self.layers]
+		return self._masked_layers
+
+	@property
+	def masked_layer_tree(self) -> list:
+		"""`layer_tree` with the layers of `masked_layers`, which variants are rendered from.
+
+		Each group is drawn through a copy of it in pass-through mode without
+		its mask, which is baked into its layers, or its opacity. Its layers
+		then draw as if they weren't in a group, as they do in `masked_layers`,
+		and the compositor can reuse the composite of a group between variants
+		that draw the same layers of it. The group itself is the top layer in
+		its copy, so it is still drawn when it is named.
+		"""
+		if self._masked_layer_tree is None:
+			self._masked_layer_tree = pass_through_tree(self.layerTree, self.masked_layers, self._pass_through_groups)
+		return self._masked_layer_tree
+
+	@property
+	def pass_through_groups(self) -> dict:
+		"""The copy of each group drawn in `masked_layer_tree`, by the index of the group."""
+		_ = self.masked_layer_tree
+		return self._pass_through_groups
+
+	@property
+	def layer_hashes(self) -> list[str]:
+		"""The `layer_hash` of every layer, in the same order as the layers."""
+		if self._layer_hashes is None:
+			self._layer_hashes = [layer_hash(layer) for layer in self.layers]
+		return self._layer_hashes
 
 
 
@@ -82,94 +119,191 @@ def get_document(name: str, cache: dict = DOCUMENT_CACHE) -> Document:
 
 	filepath = os.path.join('src', name + '.xcf')
 	document = Document(filepath)
-	apply_masks(document.layer_tree)
 	cache[name] = document
 	return document
 
 
 
 def get_layer(document: GimpDocument, name: str) -> Union[GimpLayer, None]:
-	for layer in document.layers:
-		if layer.name == name:
-			return layer
+	return document.layerTree.layer(name)
 
-	return None
 
 
+def layer_hash(layer: GimpLayer) -> str:
+	"""Hash everything about a layer that changes the textures it is in.
 
-def get_layer_tree(document: GimpDocument):
-	layer_tree = {
-		'children': [],
-	}
-	for idx, layer in enumerate(document.layers):
-		parent = layer_tree
+	That is how it is placed and blended, the tiles of its mask and, for
+	layers but not groups, the tiles of its pixels. A group is only drawn
+	through the layers in it, where its mask is baked in.
+	"""
+	from gimpformats import utils
 
-		if layer.itemPath:
-			layer.itemPath.pop()
+	layer_hasher = hashlib.blake2b(digest_size=16)
+	layer_hasher.update(repr((
+		bool(layer.isGroup),
+		layer.width,
+		layer.height,
+		layer.xOffset,
+		layer.yOffset,
+		layer.opacity,
+		layer.blendMode,
+	)).encode())
 
-			parent = layer_tree
-			for level_idx in layer.itemPath:
-				parent = parent['children'][level_idx]
+	for source in ((layer.mask,) if layer.isGroup else (layer, layer.mask)):
+		if source is None:
+			layer_hasher.update(b'-')
+			continue
 
-		if layer.isGroup:
-			parent['children'].append({
-				'layer': layer,
-				'children': [],
-			})
-		else:
-			parent['children'].append(layer)
+		for level in source.imageHierarchy.levels[:1]:
+			for tile in level.tiles:
+				layer_hasher.update(repr((tile.dtype.str, tile.shape)).encode())
+				# a constant tile is all the one pixel
+				layer_hasher.update(tile[:1, :1].tobytes() if utils.isConstantArray(tile) else tile.tobytes())
 
-	return layer_tree
+	return layer_hasher.hexdigest()
 
 
 
+def mask_array(layer: GimpLayer):
+	"""Get the mask of a layer as a (height, width) uint8 array, or None."""
+	import numpy as np
 
-def apply_masks(group: dict, parent_mask: Image = None):
-	group_mask = None
+	if layer.mask is None:
+		return None
+	return np.asarray(layer.mask.image)
 
-	if 'layer' in group:
-		group_mask = getattr(group['layer'], 'mask')
 
-	if parent_mask is None:
-		mask = getattr(group_mask, 'image', None)
-	else:
+
+def multiply_masks(mask, other):
+	"""Multiply two uint8 masks of the same size, truncating like ImageChops.multiply."""
+	import numpy as np
+
+	return (mask.astype(np.uint16) * other // 255).astype(np.uint8)
+
+
+
+def group_masks(layers: list, parent_mask: tuple | None = None, masks: dict | None = None) -> dict:
+	"""Combine the mask of every group with the masks of the groups it is in.
+
+	Each group is combined once, with the already combined mask of its parent.
+
+	Returns a dict of group layer to (mask, (x, y) offsets of the mask) for
+	every group that is masked by itself or a parent.
+	"""
+	if masks is None:
+		masks = {}
+
+	for layerOrGroup in layers:
+		if not isinstance(layerOrGroup, list):
+			continue
+
+		group, children = layerOrGroup
+		group_mask = mask_array(group)
+		offsets = (group.xOffset, group.yOffset)
+
 		if group_mask is None:
 			mask = parent_mask
+		elif parent_mask is None:
+			mask = (group_mask, offsets)
 		else:
-			mask = ImageChops.multiply(
-				parent_mask,
-				group_mask,
+			bounds = (*offsets, offsets[0] + group_mask.shape[1], offsets[1] + group_mask.shape[0])
+			mask = (
+				multiply_masks(cropWOffset(parent_mask[0], bounds, parent_mask[1]), group_mask),
+				offsets,
 			)
 
-	for layerOrGroup in group.get('children', []):
-		if isinstance(layerOrGroup, dict) and 'children' in layerOrGroup:
-			apply_masks(layerOrGroup, mask)
-		else:
-			if layerOrGroup.mask is not None:
-				layerOrGroup.image.putalpha(
-					layerOrGroup.mask.image
-				)
-
-			if mask is not None:
-				if layerOrGroup.image.mode == 'RGB':
-					layerOrGroup.image.putalpha(
-						mask
-					)
-				else:
-					layerOrGroup.image.putalpha(
-						ImageChops.multiply(
-							mask,
-							layerOrGroup.image.getchannel('A'),
-						)
-					)
+		if mask is not None:
+			masks[group] = mask
+		group_masks(children, mask, masks)
+
+	return masks
+
+
+
+def bake_masks(
+	layers: list,
+	masks: dict | None = None,
+	parent_mask: tuple | None = None,
+	baked: dict | None = None,
+) -> dict:
+	"""Bake the masks of layers, and of the groups they are in, into their alpha.
+
+	`masks` are the combined group masks from `group_masks`, which are found
+	if they aren't given.
+
+	Returns a dict of layer to a copy of it with the masks baked in, for every
+	layer that is masked. The layers themselves aren't modified.
+	"""
+	import numpy as np
+
+	if masks is None:
+		masks = group_masks(layers)
+	if baked is None:
+		baked = {}
 
-	if 'layer' in group:
-		group['layer'].visible = False
+	for layerOrGroup in layers:
+		if isinstance(layerOrGroup, list):
+			group, children = layerOrGroup
+			bake_masks(children, masks, masks.get(group), baked)
+			continue
 
+		layer = layerOrGroup
+		mask = mask_array(layer)
+		if mask is None and parent_mask is None:
+			continue
+
+		image = layer.image
+		if mask is None and 'A' in image.getbands():
+			mask = np.asarray(image.getchannel('A'))
+
+		if parent_mask is not None:
+			bounds = (layer.xOffset, layer.yOffset, layer.xOffset + image.width, layer.yOffset + image.height)
+			parent = cropWOffset(parent_mask[0], bounds, parent_mask[1])
+			mask = parent if mask is None else multiply_masks(parent, mask)
+
+		image = image.copy()
+		image.putalpha(Image.fromarray(np.ascontiguousarray(mask), 'L'))
+		baked[layer] = copy.copy(layer)
+		baked[layer].image = image
+
+	return baked
+
+
+
+
+def pass_through_tree(tree: LayerTree, layers: list, groups: dict, indices: tuple | None = None) -> list:
+	"""Nest `layers`, a list in the order of `tree`, like `tree.nested`, with groups in pass-through mode.
+
+	Each group is replaced by [copy of the group, [the group, *its children]],
+	see `Document.masked_layer_tree`. The copies are added to `groups` by the
+	index of the group.
+	"""
+	if indices is None:
+		indices = tree.roots
+
+	nested = []
+	for index in indices:
+		layer = layers[index]
+		if not layer.isGroup:
+			nested.append(layer)
+			continue
+
+		group = copy.copy(layer)
+		group.blendMode = PASS_THROUGH
+		group.opacity = 1.0
+		group.mask = None
+		groups[index] = group
+		nested.append([group, [layer, *pass_through_tree(tree, layers, groups, tree.children[index])]])
+
+	return nested
 
 
 
 def make_norm_texture(bump_image: Image) -> Image:
+	# numpy and cv2 dominate startup time so only load them once a normal map is needed
+	import numpy as np
+	import cv2
+
 	bump_scaled = bump_image.resize((bump_image.width * 2, bump_image.height * 2), Image.Resampling.LANCZOS)
 
 	# we need to invert the height map because the algorithm we're using creates an inverted normal map
@@ -212,36 +346,109 @@ class Texture:
 		self.width = document.width
 		self.height = document.height
 
-		apply_masks(self.document.layer_tree)
-
-	def render(self) -> dict:
-		variants = {}
+		# bake the masks up front rather than in the first variant to render
+		_ = self.document.masked_layer_tree
 
-		for variant_name, variant_definition in [
+	def variant_definitions(self) -> list:
+		return [
 			(k, v)
 			for k, v
 			in self.definition.items()
 			if k in TEXTURE_VARIANTS
-		]:
-			variants[variant_name] = TextureVariant(self.document, variant_definition).render()
+		]
 
+	def variant_signatures(self) -> dict:
+		"""Hash what each variant type is rendered from, see `TextureVariant.signature`.
+
+		The norm variant is made from the bump variant, and the default bump
+		and gloss variants only depend on the size of the texture.
+		"""
+		signatures = {}
+		for variant_name, variant_definition in self.variant_definitions():
+			signatures[variant_name] = TextureVariant(self.document, variant_definition).signature(variant_name)
 			if variant_name == 'bump':
-				# FTEQW refuses to load bump textures that are not grayscale
-				variants[variant_name] = ImageOps.grayscale(variants[variant_name])
+				signatures['norm'] = signatures['bump']
+
+		for variant_name in ('bump', 'gloss'):
+			if variant_name not in signatures:
+				signatures[variant_name] = hashlib.blake2b(
+					repr((variant_name, self.width, self.height)).encode(),
+					digest_size=16,
+				).hexdigest()
+
+		return signatures
+
+	def render(self, executor: Executor | None = None, variant_types: set | None = None) -> dict:
+		"""Render the variants of the texture, or only `variant_types` of them.
 
-				# Create a normal map texture from the bump map
-				log.debug("Creating norm texture")
-				variants['norm'] = make_norm_texture(variants['bump'])
-				log.info(variants['norm'])
+		The norm variant is made from the bump variant, so the bump variant is
+		rendered for either of them but only normal mapped for the norm variant.
+		"""
+		variant_definitions = [
+			(k, v)
+			for k, v
+			in self.variant_definitions()
+			if variant_types is None
+			or k in variant_types
+			or (k == 'bump' and 'norm' in variant_types)
+		]
+
+		make_norm = variant_types is None or 'norm' in variant_types
+
+		if executor is None:
+			rendered = [
+				self.render_variant(variant_name, variant_definition, make_norm)
+				for variant_name, variant_definition
+				in variant_definitions
+			]
+		else:
+			# Rendering never modifies the document so every variant can be rendered at
+			# once, numpy, cv2 and PIL release the GIL for the heavy lifting
+			futures = [
+				executor.submit(self.render_variant, variant_name, variant_definition, make_norm)
+				for variant_name, variant_definition
+				in variant_definitions
+			]
+			rendered = [future.result() for future in futures]
 
-		if 'bump' not in variants:
+		variants = {}
+		for variant_images in rendered:
+			variants.update(
+				(variant_name, variant_image)
+				for variant_name, variant_image
+				in variant_images.items()
+				if variant_types is None or variant_name in variant_types
+			)
+
+		if 'bump' not in self.definition and (variant_types is None or 'bump' in variant_types):
 			variants['bump'] = self.default_bump()
 
-		if 'gloss' not in variants:
+		if 'gloss' not in self.definition and (variant_types is None or 'gloss' in variant_types):
 			variants['gloss'] = self.default_gloss()
 
 		return variants
 
+	def render_variant(self, variant_name: str, variant_definition: list, make_norm: bool = True) -> dict:
+		variant_image = TextureVariant(self.document, variant_definition).render()
+
+		if variant_name != 'bump':
+			return {variant_name: variant_image}
+
+		# FTEQW refuses to load bump textures that are not grayscale
+		bump_image = ImageOps.grayscale(variant_image)
+		if not make_norm:
+			return {'bump': bump_image}
+
+		# Create a normal map texture from the bump map
+		log.debug("Creating norm texture")
+		norm_image = make_norm_texture(bump_image)
+		log.info(norm_image)
+
+		return {
+			'bump': bump_image,
+			'norm': norm_image,
+		}
+
 	def has_variant(self, variant_type) -> bool:
 		if variant_type in self.variants:
 			return True
@@ -273,21 +480,70 @@ class TextureVariant:
 		self.width = document.width
 		self.height = document.height
 
-	def render(self) -> Image:
-		document = copy(self.document)
+	def visible_indices(self) -> list[int]:
+		"""The indices of the layers that are drawn, in document order."""
+		tree = self.document.layerTree
 
-		for layer in document.layers:
-			if layer.name == 'Background' or layer.name in self.definition:
-				layer.visible = True
-			else:
-				layer.visible = False
+		if isinstance(self.definition, str):
+			# a single name also matches layers named after part of it, e.g. the
+			# "sliplite" layer for "sliplite.tga"
+			layers = [layer for layer in tree.layers if layer.name in self.definition]
+		else:
+			layers = [layer for name in self.definition for layer in tree.layersNamed(name)]
+
+		return sorted({tree.index(layer) for layer in layers + list(tree.layersNamed('Background'))})
+
+	def visible_layers(self) -> set:
+		"""The layers of `Document.masked_layer_tree` that are drawn, with the groups they are in."""
+		tree = self.document.layerTree
+		masked_layers = self.document.masked_layers
+		pass_through_groups = self.document.pass_through_groups
+
+		visible_layers = set()
+		for index in self.visible_indices():
+			visible_layers.add(masked_layers[index])
+			parent = tree.parents[index]
+			while parent is not None:
+				visible_layers.add(pass_through_groups[parent])
+				parent = tree.parents[parent]
+		return visible_layers
+
+	def signature(self, variant_name: str = '') -> str:
+		"""Hash everything the variant is rendered from.
+
+		That is the size of the document and the `layer_hash` of each visible
+		layer and of the groups it is in, whose masks are baked into it. A
+		change to any other layer leaves the signature as it is.
+		"""
+		tree = self.document.layerTree
+		layer_hashes = self.document.layer_hashes
+
+		signature_hasher = hashlib.blake2b(digest_size=16)
+		signature_hasher.update(repr((variant_name, self.width, self.height, str(self.document.precision))).encode())
+		for index in self.visible_indices():
+			ancestors = []
+			parent = tree.parents[index]
+			while parent is not None:
+				ancestors.append(layer_hashes[parent])
+				parent = tree.parents[parent]
+			signature_hasher.update(repr((layer_hashes[index], ancestors)).encode())
+
+		return signature_hasher.hexdigest()
+
+	def render(self, visible_layers: set | None = None) -> Image:
+		# Visibility is passed to the compositor rather than set on the layers,
+		# which are shared with every other variant and texture of the document
+		if visible_layers is None:
+			visible_layers = self.visible_layers()
 
 		return flattenAll(
-			document,
+			self.document.masked_layer_tree,
 			(
 				self.width,
 				self.height,
-			)
+			),
+			visibleLayers=visible_layers,
+			composites=self.document.composites,
 		)
 
 
@@ -309,24 +565,398 @@ class DocumentCache:
 	def __init__(self, source_directory: Path):
 		self.source_directory = source_directory
 		self.cache = {}
+		# identical tiles, within a document or across documents, are only kept once
+		self.tile_store = TileStore()
 
 	def _make_filepath(self, name: str) -> Path:
 		log.debug(Path(self.source_directory, f"{name}.xcf"))
 		return Path(self.source_directory, f"{name}.xcf")
 
+	def stat(self, name: str) -> os.stat_result:
+		if name in self.cache:
+			return self.cache[name].stat
+		return os.stat(self._make_filepath(name))
+
 	def get(self, name: str) -> Document:
 		if name in self.cache:
 			return self.cache[name]
 		log.debug(f"name: {name}")
 		filepath = self._make_filepath(name)
 		log.debug(f"filepath: {filepath}")
-		document = Document(filepath)
+		document = Document(filepath, self.tile_store)
 
 		# log.debug(dir(document))
 		self.cache[name] = document
 
 		return document
 
+	def drop_composites(self, name: str):
+		"""Forget the group composites of a document once its textures are built."""
+		if name in self.cache:
+			self.cache[name].composites.clear()
+
+	def evict(self, name: str):
+		"""Forget a document that has changed, it is decoded again when it is next used."""
+		self.cache.pop(name, None)
+
+
+
+# Changing what is recorded for a build invalidates existing manifests
+MANIFEST_VERSION = 1
+
+MANIFEST_FILENAME = '.xcftotexture.json'
+
+
+
+def source_signature(stat: os.stat_result) -> list:
+	return [stat.st_mtime_ns, stat.st_size]
+
+
+
+class BuildManifest:
+	"""What the textures in an output directory were last built from.
+
+	For each document the `layer_hash` of every layer is recorded, and for
+	each texture its definition, the modification time and size of its
+	document and the `TextureVariant.signature` of each variant saved. When a
+	document changes only the variants with a different signature, those
+	drawing a changed layer, need to be rendered again.
+	"""
+
+	def __init__(self, filepath: Path):
+		self.filepath = filepath
+		self.documents = {}
+		self.textures = {}
+
+		try:
+			with open(self.filepath, 'r') as manifest_file:
+				manifest = json.load(manifest_file)
+			if manifest.get('version') == MANIFEST_VERSION:
+				self.documents = manifest['documents']
+				self.textures = manifest['textures']
+		except FileNotFoundError:
+			pass
+		except ValueError:
+			log.warning(f"Ignoring unreadable build manifest {self.filepath}")
+
+	def record_document(self, name: str, document: Document) -> list[str]:
+		"""Record the layers of a document, returning the names of those that changed."""
+		layers = [[layer.name, layer_hash] for layer, layer_hash in zip(document.layers, document.layer_hashes)]
+
+		known = self.documents.get(name)
+		changed = []
+		if known is not None:
+			known_layers = {tuple(layer) for layer in known['layers']}
+			changed = [layer_name for layer_name, layer_hash in layers if (layer_name, layer_hash) not in known_layers]
+
+		self.documents[name] = {'source': source_signature(document.stat), 'layers': layers}
+		return changed
+
+	def save(self):
+		# Write a new file and swap it in so a reader never sees half a manifest
+		self.filepath.parent.mkdir(parents=True, exist_ok=True)
+		temporary_filepath = self.filepath.with_name(self.filepath.name + '.tmp')
+		with open(temporary_filepath, 'w') as manifest_file:
+			json.dump(
+				{'version': MANIFEST_VERSION, 'documents': self.documents, 'textures': self.textures},
+				manifest_file,
+			)
+		os.replace(temporary_filepath, self.filepath)
+
+
+
+
+class Profiler:
+	"""Profile the main thread and every worker thread of a build with cProfile."""
+
+	def __init__(self):
+		import cProfile
+
+		self.profiles = [cProfile.Profile()]
+		self.lock = threading.Lock()
+
+	def start(self):
+		self.profiles[0].enable()
+
+	def stop(self):
+		self.profiles[0].disable()
+
+	def wrap(self, fn):
+		import cProfile
+
+		def profiled(*args, **kwargs):
+			profile = cProfile.Profile()
+			try:
+				profile.enable()
+			except ValueError:
+				# From Python 3.12 only one profiler can be active, and it sees every thread
+				return fn(*args, **kwargs)
+
+			try:
+				return fn(*args, **kwargs)
+			finally:
+				profile.disable()
+				with self.lock:
+					self.profiles.append(profile)
+
+		return profiled
+
+	def stats(self):
+		import pstats
+
+		stats = pstats.Stats(self.profiles[0])
+		for profile in self.profiles[1:]:
+			stats.add(profile)
+		return stats
+
+	def save(self, filepath: Path):
+		"""Write the merged pstats to `filepath` and collapsed stacks next to it."""
+		stats = self.stats()
+		stats.dump_stats(filepath)
+
+		collapsed_filepath = filepath.with_name(filepath.name + '.collapsed')
+		with open(collapsed_filepath, 'w') as collapsed_file:
+			for stack, seconds in sorted(collapsed_stacks(stats).items()):
+				microseconds = round(seconds * 1e6)
+				if microseconds:
+					collapsed_file.write(f"{stack} {microseconds}\n")
+
+		log.info(f"Saved profile to {filepath} and {collapsed_filepath}")
+
+
+
+def collapsed_stacks(stats, min_seconds: float = 1e-4) -> dict[str, float]:
+	"""Turn profile statistics into collapsed stacks for flamegraph tools.
+
+	cProfile only records which function called which, so the time of a
+	function is shared between its callers in proportion to the time spent in
+	each call. Paths contributing less than `min_seconds` are dropped.
+	"""
+	callees = defaultdict(list)
+	for function, (_, _, _, _, callers) in stats.stats.items():
+		for caller, (_, _, _, cumulative) in callers.items():
+			callees[caller].append((function, cumulative))
+
+	stacks = defaultdict(float)
+
+	def label(function):
+		filename, line, name = function
+		if filename == '~':
+			return name
+		return f"{name} ({Path(filename).name}:{line})"
+
+	def walk(function, stack, fraction):
+		_, _, own, cumulative, _ = stats.stats[function]
+		stack = stack + [function]
+		stacks[';'.join(label(f) for f in stack)] += own * fraction
+
+		for callee, callee_time in callees[function]:
+			total = stats.stats[callee][3]
+			# skip recursion and anything too small to show up
+			if callee in stack or not total or fraction * callee_time < min_seconds:
+				continue
+			walk(callee, stack, fraction * callee_time / total)
+
+	for function, (_, _, _, _, callers) in stats.stats.items():
+		if not callers:
+			walk(function, [], 1.0)
+
+	return stacks
+
+
+
+class ProfiledExecutor(Executor):
+	"""Run everything submitted to `executor` under the profiler."""
+
+	def __init__(self, executor: Executor, profiler: Profiler):
+		self.executor = executor
+		self.profiler = profiler
+
+	def submit(self, fn, /, *args, **kwargs) -> Future:
+		return self.executor.submit(self.profiler.wrap(fn), *args, **kwargs)
+
+	def shutdown(self, wait=True, *, cancel_futures=False):
+		self.executor.shutdown(wait, cancel_futures=cancel_futures)
+
+
+
+class TextureSelection:
+	"""Which textures and variants to build, everything by default.
+
+	Textures are selected by name or by the name of their source document,
+	either of which may be a glob, and by the maps that use them (see
+	`map_textures`). A texture is built if it matches any of the patterns
+	given of each kind and is used by any of the maps.
+	"""
+
+	def __init__(
+		self,
+		textures=(),
+		documents=(),
+		variant_types: set | None = None,
+		maps: dict[str, set] | None = None,
+	):
+		self.textures = tuple(textures)
+		self.documents = tuple(documents)
+		self.variant_types = variant_types
+		self.maps = maps
+
+	def includes(self, name: str, definition: dict) -> bool:
+		return (
+			(not self.textures or matches_any(name, self.textures))
+			and (not self.documents or matches_any(definition['src'], self.documents))
+			and (self.maps is None or self.used_by_maps(name))
+		)
+
+	def used_by_maps(self, name: str) -> bool:
+		# textures in a directory named after a map only replace those of that map
+		map_name, _, texture_name = name.lower().rpartition('/')
+		texture_name = texture_key(texture_name)
+		return any(
+			texture_name in textures
+			for bsp_map_name, textures in self.maps.items()
+			if not map_name or map_name == bsp_map_name
+		)
+
+	def undefined_map_textures(self, texture_definitions: dict) -> dict[str, list]:
+		"""List the textures each map uses that have no definition."""
+		undefined = {}
+		for map_name, textures in (self.maps or {}).items():
+			defined = set()
+			for name in texture_definitions:
+				definition_map_name, _, texture_name = name.lower().rpartition('/')
+				if not definition_map_name or definition_map_name == map_name:
+					defined.add(texture_key(texture_name))
+			undefined[map_name] = sorted(textures - defined)
+		return undefined
+
+	def includes_variant(self, variant_type: str) -> bool:
+		return self.variant_types is None or variant_type in self.variant_types
+
+
+
+def texture_key(name: str) -> str:
+	"""Fold a texture name the way Quake engines look them up, ignoring case.
+
+	Liquid textures start with * in maps, which DarkPlaces replaces with #
+	when loading replacement textures.
+	"""
+	name = name.lower()
+	if name.startswith('#'):
+		name = '*' + name[1:]
+	return name
+
+
+
+def map_textures(bsp_filepaths) -> dict[str, set]:
+	"""Get the `texture_key` of every texture used by each map, by the name of the map."""
+	from bspfile import miptex_names
+
+	return {
+		bsp_filepath.stem.lower(): {texture_key(name) for name in miptex_names(bsp_filepath)}
+		for bsp_filepath in bsp_filepaths
+	}
+
+
+
+def matches_any(name: str, patterns) -> bool:
+	# texture names often start with glob characters, e.g. *water0 and +0button
+	return any(name == pattern or fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+
+def save_variant_image(variant_image: Image, fp, filename: str):
+	"""Save a variant to a path or file object in the format of its filename."""
+	extension = os.path.splitext(filename)[1].lower()
+	image_format = Image.registered_extensions()[extension]
+
+	if extension == ".jpg":
+		if variant_image.mode == 'RGBA':
+			log.info("Converting to RGB")
+			variant_image = variant_image.convert('RGB')
+
+		variant_image.save(fp, format=image_format, quality=100, optimize=True)
+	else:
+		variant_image.save(fp, format=image_format)
+
+
+
+def encode_variant_image(variant_image: Image, filename: str) -> bytes:
+	variant_file = io.BytesIO()
+	save_variant_image(variant_image, variant_file, filename)
+	return variant_file.getvalue()
+
+
+
+# Outputs with these extensions are written into an archive rather than a directory
+ARCHIVE_SUFFIXES = ('.pk3', '.zip')
+
+
+
+class DirectoryOutput:
+	"""Save textures as files in a directory."""
+
+	def __init__(self, directory: Path):
+		self.directory = directory
+		self.manifest_filepath = directory.joinpath(MANIFEST_FILENAME)
+
+	def exists(self, filename: str) -> bool:
+		return self.directory.joinpath(filename).exists()
+
+	def modified(self, filename: str) -> float:
+		"""Get the modification time of a texture, raising FileNotFoundError if there isn't one."""
+		return os.stat(self.directory.joinpath(filename)).st_mtime
+
+	def write(self, filename: str, variant_image: Image):
+		variant_filepath = self.directory.joinpath(filename)
+
+		try:
+			os.mkdir(variant_filepath.parent)
+		except FileExistsError:
+			pass
+
+		log.info(f"Saving {variant_filepath.resolve()}")
+		log.info(variant_image)
+		save_variant_image(variant_image, variant_filepath.resolve(), filename)
+
+	def close(self):
+		pass
+
+
+
+class ArchiveOutput:
+	"""Save textures into a zip/PK3 archive, see `pk3file.ArchiveWriter`.
+
+	Textures are encoded and compressed on the executor and streamed into the
+	archive, and textures that aren't saved again are kept from the existing
+	archive. Nothing changes until the output is closed. The build manifest
+	is kept next to the archive.
+	"""
+
+	def __init__(self, filepath: Path, executor: Executor, prefix: str = 'textures/'):
+		from pk3file import ArchiveWriter
+
+		self.writer = ArchiveWriter(filepath, executor)
+		self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+		self.manifest_filepath = filepath.with_name(filepath.name + MANIFEST_FILENAME)
+
+	def exists(self, filename: str) -> bool:
+		return self.prefix + filename in self.writer
+
+	def modified(self, filename: str) -> float:
+		try:
+			date_time = self.writer.date_time(self.prefix + filename)
+		except KeyError:
+			raise FileNotFoundError(filename) from None
+		return time.mktime(date_time + (0, 0, -1))
+
+	def write(self, filename: str, variant_image: Image):
+		log.info(f"Saving {self.prefix + filename} to {self.writer.filepath}")
+		log.info(variant_image)
+		self.writer.submit(self.prefix + filename, functools.partial(encode_variant_image, variant_image, filename))
+
+	def close(self):
+		self.writer.close()
 
 
 
@@ -335,60 +965,164 @@ class TextureBuilder:
 		self,
 		texture_definitions: dict,
 		source_directory: Path,
+		jobs: int | None = None,
+		profiler: Profiler | None = None,
+		selection: TextureSelection | None = None,
 	):
 		self.texture_definitions = texture_definitions
 		self.cache = DocumentCache(source_directory)
+		self.jobs = jobs
+		self.profiler = profiler
+		self.selection = selection or TextureSelection()
 
-	def save(self, destination_directory: Path, extension: str = "tga"):
-		for name, definition in self.texture_definitions.items():
-			xcf_document_name = definition['src']
-			xcf_document = self.cache.get(xcf_document_name)
+	def save(
+		self,
+		destination: Path,
+		extension: str = "tga",
+		names: set | None = None,
+		archive_prefix: str = 'textures/',
+	):
+		"""Build the selected textures, or only those of them in `names`, that are out of date.
+
+		Only the documents of those textures are opened. The textures are saved
+		in the `destination` directory, or into an archive under
+		`archive_prefix` if `destination` ends in .pk3 or .zip.
+		"""
+		with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+			if self.profiler is not None:
+				executor = ProfiledExecutor(executor, self.profiler)
+
+			if destination.suffix.lower() in ARCHIVE_SUFFIXES:
+				output = ArchiveOutput(destination, executor, archive_prefix)
+			else:
+				output = DirectoryOutput(destination)
+			manifest = BuildManifest(output.manifest_filepath)
 
-			diffuse_filepath = self.get_variant_filepath(
-				name,
-				'diffuse',
-				extension,
-				destination_directory,
-			)
+			try:
+				self._save(output, extension, executor, manifest, names)
+			finally:
+				# keep what was built even if a later texture failed, the manifest
+				# is only saved once the output has everything it records
+				output.close()
+				manifest.save()
+
+		if self.cache.tile_store.lookups:
+			log.info(self.cache.tile_store)
+
+	def _save(
+		self,
+		output: DirectoryOutput | ArchiveOutput,
+		extension: str,
+		executor: Executor,
+		manifest: BuildManifest,
+		names: set | None = None,
+	):
+		recorded_documents = set()
 
+		selected = [
+			(name, definition)
+			for name, definition
+			in self.texture_definitions.items()
+			if (names is None or name in names) and self.selection.includes(name, definition)
+		]
+		remaining = Counter(definition['src'] for _, definition in selected)
+
+		for name, definition in selected:
 			try:
-				diffuse_mtime = os.stat(diffuse_filepath).st_mtime
+				self._save_texture(output, extension, executor, manifest, recorded_documents, name, definition)
+			finally:
+				# group composites are only reused by the textures of one document
+				remaining[definition['src']] -= 1
+				if not remaining[definition['src']]:
+					self.cache.drop_composites(definition['src'])
+
+	def _save_texture(
+		self,
+		output: DirectoryOutput | ArchiveOutput,
+		extension: str,
+		executor: Executor,
+		manifest: BuildManifest,
+		recorded_documents: set,
+		name: str,
+		definition: dict,
+	):
+		xcf_document_name = definition['src']
+		built = manifest.textures.get(name)
 
-				# If the source file hasn't changed, don't re-render
-				if diffuse_mtime > xcf_document.stat.st_mtime:
-					log.debug(f"Skipping {diffuse_filepath}")
-					continue
-			except FileNotFoundError:
-				pass
+		if built is None:
+			diffuse_filename = self.get_variant_filename(name, 'diffuse', extension)
 
-			texture = Texture(name, xcf_document, definition).render()
+			# Without a manifest entry fall back to comparing modification times
+			try:
+				diffuse_mtime = output.modified(diffuse_filename)
 
-			for variant_type, variant_image in texture.items():
-				variant_filepath = self.get_variant_filepath(
-					name,
-					variant_type,
-					extension,
-					destination_directory,
-				)
+				# If the source file hasn't changed, don't re-render (or even decode it)
+				if diffuse_mtime > self.cache.stat(xcf_document_name).st_mtime:
+					log.debug(f"Skipping {diffuse_filename}")
+					return
+			except FileNotFoundError:
+				pass
+		elif (
+			built['definition'] == definition
+			and built['source'] == source_signature(self.cache.stat(xcf_document_name))
+			and all(
+				output.exists(self.get_variant_filename(name, variant_type, extension))
+				for variant_type in built['variants']
+			)
+		):
+			# Nothing it is built from has changed, so don't decode the document
+			log.debug(f"Skipping {name}")
+			return
+
+		xcf_document = self.cache.get(xcf_document_name)
+		if xcf_document_name not in recorded_documents:
+			recorded_documents.add(xcf_document_name)
+			changed_layers = manifest.record_document(xcf_document_name, xcf_document)
+			if changed_layers:
+				log.info(f"Changed layers in {xcf_document_name}: {', '.join(changed_layers)}")
+
+		texture = Texture(name, xcf_document, definition)
+		signatures = texture.variant_signatures()
+		built_signatures = built['variants'] if built is not None else {}
+		variant_types = {
+			variant_type
+			for variant_type, signature in signatures.items()
+			if self.selection.includes_variant(variant_type)
+			and (
+				built_signatures.get(variant_type) != signature
+				or not output.exists(self.get_variant_filename(name, variant_type, extension))
+			)
+		}
 
-				try:
-					os.mkdir(variant_filepath.parent)
-				except FileExistsError:
-					pass
+		# Variants that weren't selected keep what they were built from, and
+		# while any of them are out of date the texture has to be checked again
+		variant_signatures = {
+			**built_signatures,
+			**{
+				variant_type: signature
+				for variant_type, signature in signatures.items()
+				if self.selection.includes_variant(variant_type)
+			},
+		}
+		up_to_date = all(variant_signatures.get(variant_type) == signature for variant_type, signature in signatures.items())
+		built = {
+			'definition': definition if up_to_date else None,
+			'source': source_signature(xcf_document.stat) if up_to_date else None,
+			'variants': variant_signatures,
+		}
+		if not variant_types:
+			log.debug(f"Skipping {name}, none of its layers changed")
+			manifest.textures[name] = built
+			return
 
-				log.info(f"Saving {variant_filepath.resolve()}")
-				log.info(variant_image)
+		variants = texture.render(executor, variant_types)
 
-				if str(variant_filepath)[-3:] == "jpg":
-					if variant_image.mode == 'RGBA':
-						log.info("Converting to RGB")
-						variant_image = variant_image.convert('RGB')
+		for variant_type, variant_image in variants.items():
+			output.write(self.get_variant_filename(name, variant_type, extension), variant_image)
 
-					variant_image.save(variant_filepath.resolve(), quality=100, optimize=True)
-				else:
-					variant_image.save(variant_filepath.resolve())
+		manifest.textures[name] = built
 
-	def get_variant_filepath(self, name, variant_type, extension, destination_directory):
+	def get_variant_filename(self, name, variant_type, extension) -> str:
 		if variant_type == 'diffuse':
 			if name.startswith("{"):
 				filename = f"{name}.tga"
@@ -399,8 +1133,79 @@ class TextureBuilder:
 		else:
 			filename = f"{name}_{variant_type}.{extension}"
 
-		return destination_directory.joinpath(filename)
+		return filename
+
+
+
+
+def texture_dependents(texture_definitions: dict) -> dict[str, set]:
+	"""Map the name of each source document to the textures made from it."""
+	dependents = defaultdict(set)
+	for name, definition in texture_definitions.items():
+		dependents[definition['src']].add(name)
+	return dependents
+
+
+
+def watch(
+	infile: Path,
+	texture_builder: TextureBuilder,
+	destination: Path,
+	extension: str,
+	archive_prefix: str = 'textures/',
+	poll: bool = False,
+):
+	"""Rebuild textures as their documents and definitions change, until interrupted.
+
+	Documents stay decoded between builds, only those that changed are
+	decoded again. When the definitions change only the textures whose
+	definition changed are built.
+	"""
+	from xcfwatch import make_watcher
 
+	source_directory = texture_builder.cache.source_directory
+	watcher = make_watcher({source_directory, infile.parent}, poll)
+	dependents = texture_dependents(texture_builder.texture_definitions)
+	log.info(f"Watching {source_directory} and {infile} for changes")
+
+	try:
+		while True:
+			changed = watcher.wait()
+			names = set()
+
+			if infile in changed:
+				try:
+					with open(infile, 'r') as yaml_file:
+						texture_defs = yaml.safe_load(yaml_file)
+					if not isinstance(texture_defs, dict):
+						raise ValueError("expected a mapping of texture names to definitions")
+				except (OSError, ValueError, yaml.YAMLError) as e:
+					log.error(f"Can't load {infile}, keeping the previous definitions: {e}")
+				else:
+					names |= {
+						name
+						for name, definition in texture_defs.items()
+						if texture_builder.texture_definitions.get(name) != definition
+					}
+					texture_builder.texture_definitions = texture_defs
+					dependents = texture_dependents(texture_defs)
+
+			for filepath in changed:
+				if filepath.parent == source_directory and filepath.suffix == '.xcf':
+					texture_builder.cache.evict(filepath.stem)
+					names |= dependents.get(filepath.stem, set())
+
+			if not names:
+				continue
+
+			log.info(f"Rebuilding {', '.join(sorted(names))}")
+			try:
+				texture_builder.save(destination, extension, names, archive_prefix)
+			except Exception:
+				# a document may have been caught half written, it will change again
+				log.exception("Build failed, waiting for the next change")
+	finally:
+		watcher.close()
 
 
 
@@ -434,7 +1239,7 @@ if __name__ == "__main__":
 		"outdir",
 		type=Path,
 		action=ResolvePathAction,
-		help="Output directory"
+		help="Output directory, or a .pk3 or .zip archive to create or update"
 	)
 	parser.add_argument(
 		"-s",
@@ -444,12 +1249,34 @@ if __name__ == "__main__":
 		action=ResolvePathAction,
 		help="Directory containing the XCF source images (DEFAULT: src)"
 	)
+	parser.add_argument(
+		"-t",
+		"--texture",
+		default=[],
+		action="append",
+		help="Only build textures with a name matching this glob, may be given more than once"
+	)
+	parser.add_argument(
+		"-d",
+		"--document",
+		default=[],
+		action="append",
+		help="Only build textures made from an XCF source with a name matching this glob, may be given more than once"
+	)
+	parser.add_argument(
+		"-b",
+		"--bsp",
+		default=[],
+		type=Path,
+		action="append",
+		help="Only build textures used by this map, read from the miptex lump of the BSP file, may be given more than once"
+	)
 	parser.add_argument(
 		"-v",
 		"--variants",
 		default="all",
 		type=str,
-		help="Comma-separated list of texture variants to build (DEFAULT: all)"
+		help=f"Comma-separated list of texture variants to build, from {', '.join(VARIANT_TYPES)} (DEFAULT: all)"
 	)
 	parser.add_argument(
 		"-f",
@@ -458,6 +1285,38 @@ if __name__ == "__main__":
 		type=str,
 		help="Image format to use. (TODO)"
 	)
+	parser.add_argument(
+		"-j",
+		"--jobs",
+		default=None,
+		type=int,
+		help="Number of threads used to render the variants of a texture (DEFAULT: automatic)"
+	)
+	parser.add_argument(
+		"--cprofile",
+		default=None,
+		type=Path,
+		action=ResolvePathAction,
+		help="Profile the build, including the worker threads, and save the merged pstats to this file "
+			"and collapsed stacks for flamegraph tools to the same name with .collapsed appended. "
+			"With --watch only the first build is profiled",
+	)
+	parser.add_argument(
+		"--archive-prefix",
+		default="textures/",
+		type=str,
+		help="Directory in the archive to save textures in, when writing to an archive (DEFAULT: textures/)"
+	)
+	parser.add_argument(
+		"--watch",
+		action="store_true",
+		help="After building, keep rebuilding the textures whose XCF source or definition changes"
+	)
+	parser.add_argument(
+		"--poll",
+		action="store_true",
+		help="Watch by polling for changes rather than with inotify, e.g. on network filesystems"
+	)
 	parser.add_argument(
 		"-l",
 		"--log-level",
@@ -467,17 +1326,68 @@ if __name__ == "__main__":
 	)
 	args = parser.parse_args()
 
+	variant_types = None
+	if args.variants != "all":
+		variant_types = {variant_type.strip() for variant_type in args.variants.split(',') if variant_type.strip()}
+		unknown_variant_types = variant_types - set(VARIANT_TYPES)
+		if unknown_variant_types:
+			parser.error(f"unknown variants {', '.join(sorted(unknown_variant_types))}, expected some of {', '.join(VARIANT_TYPES)}")
+
 	log.setLevel(args.log_level)
 
 	tracemalloc.start()
 
+	profiler = Profiler() if args.cprofile else None
+	if profiler is not None:
+		profiler.start()
+
 	with open(args.infile, 'r') as yaml_file:
 		texture_defs = yaml.safe_load(yaml_file)
 
-	texture_builder = TextureBuilder(texture_defs, args.src)
-	texture_builder.save(args.outdir, extension=args.format)
+	maps = None
+	if args.bsp:
+		try:
+			maps = map_textures(args.bsp)
+		except (OSError, ValueError) as e:
+			parser.error(str(e))
+
+	if args.outdir.suffix.lower() in ARCHIVE_SUFFIXES and args.outdir.exists():
+		from pk3file import read_entries
+
+		# a broken archive would otherwise only fail once the build has started
+		try:
+			read_entries(args.outdir)
+		except (OSError, ValueError) as e:
+			parser.error(str(e))
+
+	selection = TextureSelection(args.texture, args.document, variant_types, maps)
+	for map_name, texture_names in selection.undefined_map_textures(texture_defs).items():
+		if texture_names:
+			log.warning(f"{map_name} uses textures without a definition: {', '.join(texture_names)}")
+
+	texture_builder = TextureBuilder(
+		texture_defs,
+		args.src,
+		jobs=args.jobs,
+		profiler=profiler,
+		selection=selection,
+	)
+	texture_builder.save(args.outdir, extension=args.format, archive_prefix=args.archive_prefix)
+
+	if profiler is not None:
+		profiler.stop()
+		profiler.save(args.cprofile)
 
 	current, peak = tracemalloc.get_traced_memory()
 	tracemalloc.stop()
 
 	print(f"Current memory usage is {current / 10**6}MB; Peak was {peak / 10**6}MB")
+
+	if args.watch:
+		# the profile covers the first build, which has already been saved, so
+		# rebuilds aren't profiled into a list that would grow until exit
+		texture_builder.profiler = None
+		try:
+			watch(args.infile, texture_builder, args.outdir, args.format, args.archive_prefix, poll=args.poll)
+		except KeyboardInterrupt:
+			pass
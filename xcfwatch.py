@@ -0,0 +1,159 @@
+"""Watch directories for files that are saved, moved or deleted.
+
+On Linux inotify tells us as soon as a file is written and closed, or moved
+into place as many editors save by renaming a new file over the old one. It
+is used through ctypes so there is nothing to install. Where it isn't
+available, or doesn't work like on some network filesystems, the directories
+are polled for changes to the modification time and size of their files.
+
+Only the files directly in each directory are watched, not subdirectories.
+"""
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+
+
+
+log = logging.getLogger(__name__)
+
+
+
+# inotify events, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+# wd, mask, cookie and length of the name that follows of each inotify event
+EVENT_HEADER = struct.Struct('iIII')
+
+# Seconds between scans of the directories when polling
+POLL_INTERVAL = 0.5
+
+# Changes less than this many seconds apart are reported together, a save
+# can be several events
+SETTLE_TIME = 0.2
+
+
+
+class InotifyWatcher:
+	def __init__(self, directories):
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+		self.fd = libc.inotify_init1(IN_CLOEXEC)
+		if self.fd < 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno))
+
+		self.directories = {}
+		for directory in directories:
+			wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+			if wd < 0:
+				errno = ctypes.get_errno()
+				self.close()
+				raise OSError(errno, os.strerror(errno), str(directory))
+			self.directories[wd] = Path(directory)
+
+	def _read(self, timeout: float | None) -> set[Path]:
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return set()
+
+		data = os.read(self.fd, 64 * 1024)
+		changed = set()
+		offset = 0
+		while offset < len(data):
+			wd, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+			offset += EVENT_HEADER.size
+			name = data[offset:offset + length].rstrip(b'\0')
+			offset += length
+
+			if name and wd in self.directories:
+				changed.add(self.directories[wd].joinpath(os.fsdecode(name)))
+
+		return changed
+
+	def wait(self, timeout: float | None = None) -> set[Path]:
+		"""Wait for files to change, returning their paths, or an empty set after `timeout` seconds."""
+		changed = self._read(timeout)
+		while changed:
+			more = self._read(SETTLE_TIME)
+			if not more:
+				break
+			changed |= more
+		return changed
+
+	def close(self):
+		os.close(self.fd)
+
+
+
+class PollingWatcher:
+	def __init__(self, directories, interval: float = POLL_INTERVAL):
+		self.directories = [Path(directory) for directory in directories]
+		self.interval = interval
+		self.files = self._scan()
+
+	def _scan(self) -> dict:
+		files = {}
+		for directory in self.directories:
+			try:
+				with os.scandir(directory) as entries:
+					for entry in entries:
+						if entry.is_file():
+							stat = entry.stat()
+							files[Path(entry.path)] = (stat.st_mtime_ns, stat.st_size)
+			except FileNotFoundError:
+				pass
+		return files
+
+	def _changes(self) -> set[Path]:
+		files = self._scan()
+		changed = {path for path in files.keys() | self.files.keys() if files.get(path) != self.files.get(path)}
+		self.files = files
+		return changed
+
+	def wait(self, timeout: float | None = None) -> set[Path]:
+		"""Wait for files to change, returning their paths, or an empty set after `timeout` seconds."""
+		deadline = None if timeout is None else time.monotonic() + timeout
+
+		changed = set()
+		while not changed:
+			if deadline is not None and time.monotonic() >= deadline:
+				return changed
+			time.sleep(self.interval)
+			changed = self._changes()
+
+		# wait for files still being written to stop changing
+		while True:
+			time.sleep(self.interval)
+			more = self._changes()
+			if not more:
+				return changed
+			changed |= more
+
+	def close(self):
+		pass
+
+
+
+def make_watcher(directories, poll: bool = False) -> InotifyWatcher | PollingWatcher:
+	"""Watch directories with inotify where it is available, otherwise by polling them."""
+	if not poll and sys.platform.startswith('linux'):
+		try:
+			return InotifyWatcher(directories)
+		except (OSError, AttributeError) as e:
+			log.info(f"inotify isn't available ({e}), polling for changes instead")
+
+	return PollingWatcher(directories)